@@ -1,23 +1,101 @@
-import openai
-from flask import Flask, request, jsonify
+import startup  # first, so that the import times below are measured
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-from sqlalchemy import create_engine, text
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.pool import QueuePool
 import uuid
 import os
+import json
+import hashlib
+import base64
+import functools
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import orjson
+import zstandard
 from dotenv import load_dotenv
 import urllib.parse
+import click
+from datetime import datetime, timezone
+
+import metrics
+from llm_gateway import GatewayBusy, LLMGateway
+from llm_router import LLMRouter, load_deployments, load_routes
+from write_behind import WriteBehindQueue
 
 load_dotenv()
 
 app = Flask(__name__)
-CORS(app, resources={r"/*": {"origins": ["https://nice-hill-06bb87c0f.4.azurestaticapps.net", "https://victorious-plant-018c0aa0f.4.azurestaticapps.net"]}})
+ALLOWED_ORIGINS = ["https://nice-hill-06bb87c0f.4.azurestaticapps.net", "https://victorious-plant-018c0aa0f.4.azurestaticapps.net"]
+EXPOSE_HEADERS = ["X-Next-After", "X-Recommendation-Cache", "Idempotent-Replayed", "Retry-After"]
+CORS(app, resources={r"/*": {"origins": ALLOWED_ORIGINS}}, expose_headers=EXPOSE_HEADERS)
+
+
+json_serializations = metrics.Counter(
+    "json_serializations_total", "JSON documents serialized, by serializer (orjson or the json module).", ("serializer",)
+)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """
+    Default JSON provider that reports serialization time as the 'serialize' phase.
+    """
+
+    def dumps(self, obj, **kwargs):
+        json_serializations.inc(serializer="json")
+        with metrics.timed_phase("serialize"):
+            return super().dumps(obj, **kwargs)
+
+
+class OrjsonProvider(TimedJSONProvider):
+    """
+    JSON provider backed by orjson. Keys are sorted like the default provider, and
+    datetimes and types orjson does not know (Decimal, ...) go through the default
+    provider's hook, so the output matches it.
+    Calls with options orjson does not support fall back to the default provider.
+    """
+
+    def dumps(self, obj, **kwargs):
+        ensure_ascii = kwargs.pop("ensure_ascii", None)
+        indent = kwargs.pop("indent", None)
+        sort_keys = kwargs.pop("sort_keys", self.sort_keys)
+        # response() (i.e. jsonify) always asks for compact separators or an indent;
+        # orjson's output is compact already
+        if kwargs.get("separators") == (",", ":"):
+            kwargs.pop("separators")
+        if kwargs:
+            if ensure_ascii is not None:
+                kwargs["ensure_ascii"] = ensure_ascii
+            return super().dumps(obj, indent=indent, sort_keys=sort_keys, **kwargs)
+
+        # Datetimes keep the default provider's HTTP-date format
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        json_serializations.inc(serializer="orjson")
+        with metrics.timed_phase("serialize"):
+            return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+
+# JSON_PROVIDER=default keeps Flask's json-module provider
+app.json = OrjsonProvider(app) if os.getenv("JSON_PROVIDER", "orjson").lower() == "orjson" else TimedJSONProvider(app)
 #CORS(app, resources={r"/*": {"origins": ["https://nice-hill-06bb87c0f.4.azurestaticapps.net", "https://victorious-plant-018c0aa0f.4.azurestaticapps.net"]}})
 
-# Azure Open AI setup
-openai.api_key = os.getenv("AZURE_OPENAI_KEY")
-openai.api_base = os.getenv("AZURE_OPENAI_ENDPOINT")
-openai.api_type = "azure"
-openai.api_version = "2024-10-21"  # or whichever API version you're using
+# Azure Open AI setup (clients are built by llm_router.py)
+AZURE_OPENAI_API_VERSION = "2024-10-21"  # or whichever API version you're using
+MAX_FOLLOWUPS = 20
 AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
 
 # Database credentials
@@ -28,6 +106,8 @@ password = os.getenv("SQL_PASSWORD")
 
 # ODBC driver
 driver = 'ODBC Driver 18 for SQL Server'
+# Only for local SQL Server containers with a self-signed certificate (e.g. bench/)
+trust_server_certificate = "yes" if os.getenv("SQL_TRUST_SERVER_CERTIFICATE", "no").lower() == "yes" else "no"
 
 if not all([server, database, username, password]):
     raise ValueError("Database configuration not fully provided.")
@@ -41,62 +121,857 @@ odbc_conn_str = (
     f'UID={username};'
     f'PWD={password};'
     f'Encrypt=yes;'
-    f'TrustServerCertificate=no;'
+    f'TrustServerCertificate={trust_server_certificate};'
     f'Connection Timeout=30;'
 )
 
 # URL-encode
 odbc_conn_str_encoded = urllib.parse.quote_plus(odbc_conn_str)
 
+# ----------------------------- CONNECTION POOL -----------------------------
+# Azure SQL silently drops idle connections, so connections are pinged before use
+# and recycled well before the gateway's idle timeout.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", 1))
+DB_POOL_WARMUP_RETRY = float(os.getenv("DB_POOL_WARMUP_RETRY", 5))
+
+pool_wait_stats = {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "timeouts": 0}
+_pool_wait_lock = threading.Lock()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that records how long callers wait to check out a connection.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with _pool_wait_lock:
+                pool_wait_stats["timeouts"] += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with _pool_wait_lock:
+                pool_wait_stats["count"] += 1
+                pool_wait_stats["total_seconds"] += waited
+                pool_wait_stats["max_seconds"] = max(pool_wait_stats["max_seconds"], waited)
+
+
 # Create SQLAlchemy engine
+# fast_executemany sends multi-row inserts (submit, feature rankings) as one batch
 connection_string = f"mssql+pyodbc:///?odbc_connect={odbc_conn_str_encoded}"
-engine = create_engine(connection_string)
+engine = create_engine(
+    connection_string,
+    fast_executemany=True,
+    poolclass=TimedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=DB_POOL_PRE_PING
+)
+
+
+# The start time lives on the statement's execution context, so a failed statement
+# cannot leave a stale entry behind on the pooled connection
+@event.listens_for(engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, "_query_start", None)
+    if start is not None:
+        metrics.add_phase("db", time.perf_counter() - start)
+
+
+@event.listens_for(engine, "handle_error")
+def _handle_error(exception_context):
+    # Time spent on a failed statement is database time too
+    start = getattr(exception_context.execution_context, "_query_start", None)
+    if start is not None:
+        metrics.add_phase("db", time.perf_counter() - start)
+
+
+def get_pool_metrics():
+    """
+    Returns a snapshot of the connection pool: size, checked-out, idle and
+    overflow connections plus checkout wait-time statistics.
+    """
+    pool = engine.pool
+    with _pool_wait_lock:
+        waits = dict(pool_wait_stats)
+    return {
+        "pool_size": pool.size(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "checked_out": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "wait_count": waits["count"],
+        "wait_seconds_total": round(waits["total_seconds"], 6),
+        "wait_seconds_avg": round(waits["total_seconds"] / waits["count"], 6) if waits["count"] else 0.0,
+        "wait_seconds_max": round(waits["max_seconds"], 6),
+        "wait_timeouts": waits["timeouts"]
+    }
+
+
+def warm_up_pool(connections=DB_POOL_WARMUP):
+    """
+    Opens (and returns to the pool) a few connections so the first requests
+    do not pay the login handshake.
+    """
+    opened = []
+    try:
+        for _ in range(min(connections, DB_POOL_SIZE)):
+            connection = engine.connect()
+            connection.execute(text("SELECT 1"))
+            opened.append(connection)
+    except Exception as e:
+        print("Error warming up the connection pool:", str(e))
+        return False
+    finally:
+        for connection in opened:
+            connection.close()
+    return True
+
+
+def warm_up_pool_until_ready():
+    """
+    Warms up the pool, retrying until the database answers, then passes the
+    'db_pool' readiness check.
+    """
+    with startup.phase("db_pool"):
+        while not warm_up_pool():
+            startup.failed("db_pool", "database unreachable")
+            time.sleep(DB_POOL_WARMUP_RETRY)
+    startup.passed("db_pool")
+
+
+if DB_POOL_WARMUP > 0:
+    # In the background so a slow database does not block worker boot; /ready waits for it
+    startup.expect("db_pool")
+    threading.Thread(target=warm_up_pool_until_ready, name="db-pool-warmup", daemon=True).start()
+
+
+# ----------------------------- TELEMETRY WRITE-BEHIND -----------------------------
+# Login/logout/session/feedback/help events are fire-and-forget: they are queued in
+# memory and written in bulk by a background thread (see write_behind.py).
+# When the queue is full, or TELEMETRY_WRITE_BEHIND=false, they are written inline.
+TELEMETRY_WRITE_BEHIND = os.getenv("TELEMETRY_WRITE_BEHIND", "true").lower() == "true"
+TELEMETRY_QUEUE_SIZE = int(os.getenv("TELEMETRY_QUEUE_SIZE", 10000))
+TELEMETRY_BATCH_SIZE = int(os.getenv("TELEMETRY_BATCH_SIZE", 200))
+TELEMETRY_FLUSH_INTERVAL = float(os.getenv("TELEMETRY_FLUSH_INTERVAL", 1.0))
+TELEMETRY_SPILL_DIR = os.getenv("TELEMETRY_SPILL_DIR")  # opt-in crash-safe journal
+# Events that still fail after this many flushes are moved to the dead-letter file
+TELEMETRY_MAX_ATTEMPTS = int(os.getenv("TELEMETRY_MAX_ATTEMPTS", 3))
+TELEMETRY_DEAD_LETTER_FILE = os.getenv(
+    "TELEMETRY_DEAD_LETTER_FILE", os.path.join(TELEMETRY_SPILL_DIR or ".", "telemetry-dead-letter.jsonl")
+)
+
+TELEMETRY_STATEMENTS = {
+    "login": """
+        INSERT INTO Connections (email, event_type, event_timestamp)
+        VALUES (:email, 'login', :event_timestamp)
+    """,
+    "logout": """
+        INSERT INTO Connections (email, event_type, event_timestamp)
+        VALUES (:email, 'logout', :event_timestamp)
+    """,
+    "session_created": """
+        INSERT INTO Connections (email, event_type, session_id, session_name, event_timestamp)
+        VALUES (:email, 'session_created', :session_id, :session_name, :event_timestamp)
+    """,
+    "session_upsert": """
+        MERGE Sessions WITH (HOLDLOCK) AS target
+        USING (SELECT :session_id AS session_id) AS source
+        ON target.session_id = source.session_id
+        WHEN MATCHED THEN
+            UPDATE SET email = COALESCE(:email, target.email),
+                       session_name = COALESCE(:session_name, target.session_name)
+        WHEN NOT MATCHED THEN
+            INSERT (session_id, email, session_name, created_at, is_deleted)
+            VALUES (:session_id, :email, :session_name, :event_timestamp, 0);
+    """,
+    "feedback": """
+        INSERT INTO Feedback (session_id, feedback, comments)
+        VALUES (:session_id, :feedback, :comments)
+    """,
+    "help": """
+        INSERT INTO Get_Help (session_id, timestamp)
+        VALUES (:session_id, :timestamp)
+    """,
+    "llm_call": """
+        INSERT INTO LLMCalls (session_id, endpoint, deployment, streamed, status,
+                              prompt_tokens, completion_tokens, cached_tokens,
+                              latency_ms, ttft_ms, retry_count, created_at)
+        VALUES (:session_id, :endpoint, :deployment, :streamed, :status,
+                :prompt_tokens, :completion_tokens, :cached_tokens,
+                :latency_ms, :ttft_ms, :retry_count, :created_at)
+    """
+}
+
+telemetry_writer = None
+if TELEMETRY_WRITE_BEHIND:
+    telemetry_writer = WriteBehindQueue(
+        engine,
+        TELEMETRY_STATEMENTS,
+        max_size=TELEMETRY_QUEUE_SIZE,
+        batch_size=TELEMETRY_BATCH_SIZE,
+        flush_interval=TELEMETRY_FLUSH_INTERVAL,
+        spill_dir=TELEMETRY_SPILL_DIR,
+        max_attempts=TELEMETRY_MAX_ATTEMPTS,
+        dead_letter_path=TELEMETRY_DEAD_LETTER_FILE
+    ).start()
+
+
+def event_timestamp():
+    """
+    Event time captured when the request arrives, not when the batch is flushed.
+    Millisecond precision and no UTC offset, so it also fits DATETIME columns.
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None).isoformat(timespec="milliseconds")
+
+
+def record_event(kind, params):
+    """
+    Queues a telemetry insert, or writes it right away when write-behind
+    is disabled or the queue is full.
+    """
+    if telemetry_writer is not None and telemetry_writer.submit(kind, params):
+        return
+    with engine.begin() as connection:
+        connection.execute(text(TELEMETRY_STATEMENTS[kind]), params)
+
+
+# ----------------------------- FEATURE TABLE CACHE -----------------------------
+# The rendered feature table is shared by every request thread in this process.
+# Each worker process keeps its own copy: the table is a few KB and read on every
+# recommendation, so a local copy costs nothing and needs no shared store, and the
+# version probe below bounds how stale any worker can be (FEATURE_TABLE_CACHE_TTL).
+# It is served from memory until the TTL expires; after that a cheap version
+# probe decides whether the table really has to be re-read and re-rendered.
+FEATURE_TABLE_CACHE_TTL = int(os.getenv("FEATURE_TABLE_CACHE_TTL", 300))
+
+_feature_table_cache = {"table": None, "version": None, "expires_at": 0.0}
+_feature_table_lock = threading.Lock()
+
+# Whether a table has a row_version ROWVERSION column (sql/008_table_row_versions.sql),
+# looked up once per table and process
+_row_version_tables = {}
+
+
+def get_table_version(connection, table_name):
+    """
+    Returns a cheap fingerprint of a small reference table.
+    With a row_version column: row count + highest rowversion. Every insert and
+    update raises the latter and a delete lowers the count, so any change shows.
+    Without one: row count + CHECKSUM_AGG(BINARY_CHECKSUM(*)), which ignores
+    text/ntext/xml columns and can collide, so some edits may go unnoticed.
+    """
+    if table_name not in _row_version_tables:
+        _row_version_tables[table_name] = connection.execute(
+            text("SELECT COL_LENGTH(:table_name, 'row_version')"), {"table_name": table_name}
+        ).scalar() is not None
+
+    if _row_version_tables[table_name]:
+        row = connection.execute(text(f"""
+            SELECT COUNT(*) AS row_count, CONVERT(VARCHAR(18), MAX(row_version), 1) AS checksum
+            FROM {table_name}
+        """)).fetchone()
+    else:
+        row = connection.execute(text(f"""
+            SELECT COUNT(*) AS row_count, CHECKSUM_AGG(BINARY_CHECKSUM(*)) AS checksum
+            FROM {table_name}
+        """)).fetchone()
+    return f"{row.row_count}:{row.checksum}"
+
+
+def get_feature_table_version(connection):
+    return get_table_version(connection, "FeatureComparison_Detailed")
+
+
+def render_feature_table(rows):
+    """
+    Renders FeatureComparison_Detailed rows as a Markdown table string.
+    """
+    table = "| Feature               | Azure AI Search | Azure Cosmos DB NoSQL | Azure Cosmos DB MongoDB vCore  | Azure SQL DB     | Azure PostgreSQL |\n"
+    table += "|-----------------------|-----------------|----------------------|--------------------------------|------------------|------------------|\n"
+
+    for row in rows:
+        row_data = row._mapping
+        table += (
+            f"| {row_data['Feature']} | {row_data['AI_Search']} "
+            f"| {row_data['Azure_Cosmos_DB_NoSQL']} | {row_data['Azure_Cosmos_DB_MongoDB_vCore']} | {row_data['Azure_SQL_DB']} "
+            f"| {row_data['Azure_PostgreSQL']} |\n"
+        )
+
+    return table
+
+
+def invalidate_feature_table_cache():
+    """
+    Drops the cached feature table so the next request re-reads it.
+    """
+    with _feature_table_lock:
+        _feature_table_cache.update({"table": None, "version": None, "expires_at": 0.0})
 
 
 def get_feature_comparison_from_db():
     """
     Fetches a table called 'FeatureComparison_Detailed' from your DB
     and returns a Markdown-friendly table string.
+    The result is cached in-process (see FEATURE_TABLE_CACHE_TTL).
     """
-    try:
-        with engine.connect() as connection:
-            result = connection.execute(text("SELECT * FROM FeatureComparison_Detailed"))
+    now = time.monotonic()
+    cached = _feature_table_cache
+    if cached["table"] is not None and now < cached["expires_at"]:
+        return cached["table"]
+
+    # Only one thread refreshes; the others wait and reuse its result.
+    with _feature_table_lock:
+        cached = _feature_table_cache
+        now = time.monotonic()
+        if cached["table"] is not None and now < cached["expires_at"]:
+            return cached["table"]
 
-            table = "| Feature               | Azure AI Search | Azure Cosmos DB NoSQL | Azure Cosmos DB MongoDB vCore  | Azure SQL DB     | Azure PostgreSQL |\n"
-            table += "|-----------------------|-----------------|----------------------|--------------------------------|------------------|------------------|\n"
+        try:
+            with engine.connect() as connection:
+                version = get_feature_table_version(connection)
+
+                if cached["table"] is not None and version == cached["version"]:
+                    # TTL expired but the table did not change: just extend it.
+                    cached["expires_at"] = now + FEATURE_TABLE_CACHE_TTL
+                    return cached["table"]
 
-            for row in result:
-                row_data = row._mapping
-                table += (
-                    f"| {row_data['Feature']} | {row_data['AI_Search']} "
-                    f"| {row_data['Azure_Cosmos_DB_NoSQL']} | {row_data['Azure_Cosmos_DB_MongoDB_vCore']} | {row_data['Azure_SQL_DB']} "
-                    f"| {row_data['Azure_PostgreSQL']} |\n"
-                )
+                result = connection.execute(text("SELECT * FROM FeatureComparison_Detailed"))
+                table = render_feature_table(result)
 
+            _feature_table_cache.update({
+                "table": table,
+                "version": version,
+                "expires_at": now + FEATURE_TABLE_CACHE_TTL
+            })
             return table
-    except Exception as e:
-        print("Error fetching feature comparison:", str(e))
-        return "Error fetching the feature comparison table."
+        except Exception as e:
+            print("Error fetching feature comparison:", str(e))
+            if cached["table"] is not None:
+                # Serve the last good copy rather than an error string,
+                # and back off briefly instead of retrying on every request.
+                cached["expires_at"] = now + min(30, FEATURE_TABLE_CACHE_TTL)
+                return cached["table"]
+            return "Error fetching the feature comparison table."
 
 
 # ----------------------------- QUESTIONS ENDPOINT -----------------------------
+# The serialized question list is cached with a content hash that doubles as its ETag.
+# After QUESTIONS_CACHE_TTL seconds a version probe on new_questions3 decides
+# whether it has to be re-read.
+QUESTIONS_CACHE_TTL = int(os.getenv("QUESTIONS_CACHE_TTL", 60))
+
+_questions_cache = {"body": None, "etag": None, "version": None, "expires_at": 0.0}
+_questions_lock = threading.Lock()
+
+
+def get_questions_payload():
+    """
+    Returns (body, etag) for the current question list, refreshing the cache if needed.
+    """
+    now = time.monotonic()
+    cached = _questions_cache
+    if cached["body"] is not None and now < cached["expires_at"]:
+        return cached["body"], cached["etag"]
+
+    with _questions_lock:
+        now = time.monotonic()
+        if cached["body"] is not None and now < cached["expires_at"]:
+            return cached["body"], cached["etag"]
+
+        with engine.connect() as connection:
+            version = get_table_version(connection, "new_questions3")
+
+            if cached["body"] is not None and version == cached["version"]:
+                cached["expires_at"] = now + QUESTIONS_CACHE_TTL
+                return cached["body"], cached["etag"]
+
+            result = connection.execute(text("SELECT * FROM new_questions3"))
+            questions = [dict(row._mapping) for row in result]
+
+        body = app.json.dumps(questions).encode("utf-8")
+        etag = hashlib.sha256(body).hexdigest()
+        _questions_cache.update({
+            "body": body,
+            "etag": etag,
+            "version": version,
+            "expires_at": now + QUESTIONS_CACHE_TTL
+        })
+        return body, etag
+
+
 @app.route('/questions', methods=['GET'])
 def get_questions():
     """
     Fetch the question list from new_questions3 table.
+    Supports conditional GET: a matching If-None-Match gets 304 Not Modified.
     """
     try:
-        with engine.connect() as connection:
-            result = connection.execute(text("SELECT * FROM new_questions3"))
-            questions = [dict(row._mapping) for row in result]
-        return jsonify(questions)
+        body, etag = get_questions_payload()
+        response = app.response_class(body, mimetype="application/json")
+        response.set_etag(etag)
+        # Let browsers keep the list but revalidate it on every use
+        response.headers["Cache-Control"] = "no-cache"
+        return response.make_conditional(request)
     except Exception as e:
         print("Error fetching questions:", str(e))
         return jsonify({"error": "An error occurred while fetching questions."}), 500
 
 
+# ----------------------------- IDEMPOTENCY -----------------------------
+# Requests sent with an Idempotency-Key header run once per (path, key). The first
+# request claims the key in IdempotencyKeys (see sql/006_idempotency_keys.sql) and
+# stores its response when done, for IDEMPOTENCY_TTL seconds. A retry with the same
+# key and body gets that response replayed (Idempotent-Replayed: true). A retry that
+# arrives while the first request is still running waits up to IDEMPOTENCY_WAIT
+# seconds for its result; if the first request fails (5xx, broken stream) the key
+# is released so the retry does the work. Claims of a crashed worker are taken
+# over after IDEMPOTENCY_LOCK_TIMEOUT seconds.
+IDEMPOTENCY_ENABLED = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() == "true"
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 3600))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", 300))
+IDEMPOTENCY_WAIT = float(os.getenv("IDEMPOTENCY_WAIT", 60))
+IDEMPOTENCY_CLEANUP_INTERVAL = 300
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+_idempotency_last_cleanup = {"at": 0.0}
+
+
+def idempotency_scope(path, key):
+    return hashlib.sha256(f"{path}\n{key}".encode("utf-8")).hexdigest()
+
+
+def idempotency_request_hash(body, query_string):
+    return hashlib.sha256(bytes(body) + b"\n" + bytes(query_string)).hexdigest()
+
+
+def claim_idempotency_key(scope, request_hash):
+    """
+    Tries to claim a key for this request. Returns (state, row):
+    'claimed' (run the request), 'replay' (row holds the stored response),
+    'in_progress' (another request holds the key) or 'mismatch' (the key was
+    used with a different request body).
+    """
+    for _ in range(3):
+        try:
+            with engine.begin() as connection:
+                connection.execute(text("""
+                    INSERT INTO IdempotencyKeys (scope, request_hash, status, created_at, expires_at)
+                    VALUES (:scope, :request_hash, 'in_progress', SYSUTCDATETIME(),
+                            DATEADD(second, :lock_timeout, SYSUTCDATETIME()))
+                """), {"scope": scope, "request_hash": request_hash, "lock_timeout": IDEMPOTENCY_LOCK_TIMEOUT})
+            return "claimed", None
+        except exc.IntegrityError:
+            pass
+
+        with engine.begin() as connection:
+            # Expired results and abandoned claims are reused
+            taken_over = connection.execute(text("""
+                UPDATE IdempotencyKeys
+                SET request_hash = :request_hash, status = 'in_progress',
+                    status_code = NULL, content_type = NULL, response_body = NULL,
+                    created_at = SYSUTCDATETIME(),
+                    expires_at = DATEADD(second, :lock_timeout, SYSUTCDATETIME())
+                WHERE scope = :scope AND expires_at < SYSUTCDATETIME()
+            """), {"scope": scope, "request_hash": request_hash, "lock_timeout": IDEMPOTENCY_LOCK_TIMEOUT}).rowcount
+            if taken_over:
+                return "claimed", None
+            row = connection.execute(text("""
+                SELECT request_hash, status, status_code, content_type, response_body
+                FROM IdempotencyKeys
+                WHERE scope = :scope
+            """), {"scope": scope}).fetchone()
+
+        if row is None:
+            # Released in the meantime; try to claim it again
+            continue
+        if row.request_hash != request_hash:
+            return "mismatch", None
+        if row.status == "done":
+            return "replay", row
+        return "in_progress", None
+    return "in_progress", None
+
+
+def complete_idempotency_key(scope, status_code, content_type, body):
+    """
+    Stores the response of a claimed key; server errors release it instead.
+    """
+    if status_code >= 500:
+        release_idempotency_key(scope)
+        return
+    try:
+        with engine.begin() as connection:
+            connection.execute(text("""
+                UPDATE IdempotencyKeys
+                SET status = 'done', status_code = :status_code, content_type = :content_type,
+                    response_body = :response_body,
+                    expires_at = DATEADD(second, :ttl, SYSUTCDATETIME())
+                WHERE scope = :scope
+            """), {
+                "scope": scope,
+                "status_code": status_code,
+                "content_type": content_type,
+                "response_body": bytes(body),
+                "ttl": IDEMPOTENCY_TTL
+            })
+        cleanup_idempotency_keys()
+    except Exception as e:
+        print("Error storing idempotent response:", str(e))
+
+
+def release_idempotency_key(scope):
+    try:
+        with engine.begin() as connection:
+            connection.execute(text("""
+                DELETE FROM IdempotencyKeys
+                WHERE scope = :scope AND status = 'in_progress'
+            """), {"scope": scope})
+    except Exception as e:
+        print("Error releasing idempotency key:", str(e))
+
+
+def cleanup_idempotency_keys():
+    """
+    Deletes a batch of expired keys, at most every IDEMPOTENCY_CLEANUP_INTERVAL seconds per worker.
+    """
+    now = time.monotonic()
+    if now - _idempotency_last_cleanup["at"] < IDEMPOTENCY_CLEANUP_INTERVAL:
+        return
+    _idempotency_last_cleanup["at"] = now
+    with engine.begin() as connection:
+        connection.execute(text("""
+            DELETE TOP (1000) FROM IdempotencyKeys
+            WHERE expires_at < SYSUTCDATETIME()
+        """))
+
+
+def wait_for_idempotency_key(scope, request_hash):
+    """
+    Claims a key, or waits (with backoff) while another request holds it.
+    Returns the last (state, row) of claim_idempotency_key().
+    """
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    delay = 0.1
+    while True:
+        state, row = claim_idempotency_key(scope, request_hash)
+        remaining = deadline - time.monotonic()
+        if state != "in_progress" or remaining <= 0:
+            return state, row
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 2.0)
+
+
+def is_failed_stream(body):
+    """
+    True when a recorded SSE stream ended with an 'error' event.
+    """
+    return b"event: error\n" in body
+
+
+class RecordedStream:
+    """
+    Passes a streamed response through, storing it for replay once it completes.
+    A stream that breaks off (or never starts) or ends with an error event releases
+    the key: Werkzeug calls close() once the response is over, in every case.
+    """
+
+    def __init__(self, scope, chunks, content_type):
+        self.scope = scope
+        self.chunks = chunks
+        self.content_type = content_type
+        self.parts = []
+        self.completed = False
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.parts.append(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            yield chunk
+        self.completed = True
+        # Store the result right away, so retries do not wait for the connection to close
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+        body = b"".join(self.parts)
+        if self.completed and not is_failed_stream(body):
+            complete_idempotency_key(self.scope, 200, self.content_type, body)
+        else:
+            release_idempotency_key(self.scope)
+
+
+def idempotency_error(state):
+    if state == "mismatch":
+        return {"error": "This Idempotency-Key was already used with a different request."}, 422
+    return {"error": "A request with this Idempotency-Key is still in progress."}, 409
+
+
+def idempotent(view):
+    """
+    Makes a route honour the Idempotency-Key header (see IDEMPOTENCY above).
+    When the key store is unavailable the request simply runs.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if not key or not IDEMPOTENCY_ENABLED:
+            return view(*args, **kwargs)
+        if len(key) > MAX_IDEMPOTENCY_KEY_LENGTH:
+            return jsonify({"error": "Idempotency-Key is too long."}), 400
+
+        scope = idempotency_scope(request.path, key)
+        try:
+            state, row = wait_for_idempotency_key(
+                scope, idempotency_request_hash(request.get_data(), request.query_string)
+            )
+        except Exception as e:
+            print("Error claiming idempotency key:", str(e))
+            return view(*args, **kwargs)
+
+        if state == "replay":
+            return Response(
+                bytes(row.response_body),
+                status=row.status_code,
+                content_type=row.content_type,
+                headers={"Idempotent-Replayed": "true"}
+            )
+        if state != "claimed":
+            body, status = idempotency_error(state)
+            response = jsonify(body)
+            if status == 409:
+                response.headers["Retry-After"] = "5"
+            return response, status
+
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            release_idempotency_key(scope)
+            raise
+
+        if response.is_streamed:
+            response.response = RecordedStream(scope, response.response, response.content_type)
+        else:
+            complete_idempotency_key(scope, response.status_code, response.content_type, response.get_data())
+        return response
+
+    return wrapper
+
+
+# ----------------------------- REQUEST COALESCING -----------------------------
+# Identical LLM requests that are in flight at the same time in this process (same
+# path, body and query: double-clicks, client retries) are coalesced: the first
+# one (the leader) runs, the others (followers) wait and get the leader's response.
+# Followers of a streamed answer receive it live, chunk by chunk. If the leader's
+# client goes away while followers are attached, the leader still drains the
+# generation so they get the whole answer. Followers fall back to running the
+# request themselves if the leader fails before responding; a shared stream that
+# breaks off ends with an 'error' event. coalesced_requests_total only counts
+# followers actually served from the leader's result.
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+COALESCE_WAIT = float(os.getenv("COALESCE_WAIT", 300))
+
+coalesced_requests = metrics.Counter(
+    "coalesced_requests_total",
+    "Requests served from an identical in-flight request instead of a new generation.",
+    ["endpoint"]
+)
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+class Flight:
+    """
+    One in-flight request: its response status and type, and the body chunks
+    produced so far, shared with the followers.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.followers = 0
+        self.ready = False
+        self.done = False
+        self.failed = False
+        self.status = None
+        self.content_type = None
+        self.streamed = False
+        self.chunks = []
+
+    def start(self, status, content_type, streamed):
+        with self.condition:
+            self.status, self.content_type, self.streamed = status, content_type, streamed
+            self.ready = True
+            self.condition.notify_all()
+
+    def append(self, chunk):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def finish(self, failed=False):
+        with self.condition:
+            self.done = True
+            self.failed = failed
+            self.ready = True
+            self.condition.notify_all()
+
+    def wait_ready(self, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.ready, timeout) and not (self.failed and not self.chunks)
+
+    def wait_done(self, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.done, timeout) and not self.failed
+
+    def iter_chunks(self):
+        index = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: index < len(self.chunks) or self.done)
+                new_chunks = self.chunks[index:]
+                finished = self.done
+            index += len(new_chunks)
+            yield from new_chunks
+            if finished and index >= len(self.chunks):
+                if self.failed:
+                    # The leader's stream broke off: end the followers' streams the way a failed generation does
+                    yield llm_error_event()
+                return
+
+
+def _follow_stream(flight, endpoint):
+    """
+    A follower's copy of a streamed flight; counted as coalesced once it has
+    been served to the end without the leader's stream failing.
+    """
+    yield from flight.iter_chunks()
+    if not flight.failed:
+        coalesced_requests.inc(endpoint=endpoint)
+
+
+def _land_flight(key, flight, failed=False):
+    flight.finish(failed)
+    with _flights_lock:
+        if _flights.get(key) is flight:
+            del _flights[key]
+
+
+class FlightStream:
+    """
+    The leader's streamed body: every chunk is shared with the flight. When the
+    leader's client disconnects early and followers are attached, close() keeps
+    reading the generation to the end for them.
+    """
+
+    def __init__(self, key, flight, chunks):
+        self.key = key
+        self.flight = flight
+        self.chunks = iter(chunks)
+        self.source = chunks
+        self.closed = False
+        self.failed = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.chunks:
+                self.flight.append(chunk)
+                yield chunk
+        except Exception:
+            self.failed = True
+            self.close()
+            raise
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        failed = self.failed
+        try:
+            if self.flight.followers:
+                for chunk in self.chunks:
+                    self.flight.append(chunk)
+        except Exception as e:
+            print("Error finishing coalesced stream:", str(e))
+            failed = True
+        finally:
+            if hasattr(self.source, "close"):
+                self.source.close()
+            _land_flight(self.key, self.flight, failed)
+
+
+def coalesced(view):
+    """
+    Coalesces identical concurrent requests to a route (see REQUEST COALESCING above).
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not COALESCE_ENABLED:
+            return view(*args, **kwargs)
+
+        key = (request.path, hashlib.sha256(request.get_data() + b"\n" + request.query_string).hexdigest())
+        with _flights_lock:
+            flight = _flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = Flight()
+            else:
+                flight.followers += 1
+
+        if not leader:
+            if not flight.wait_ready(COALESCE_WAIT):
+                return view(*args, **kwargs)
+            if flight.streamed:
+                return Response(_follow_stream(flight, request.path), status=flight.status, content_type=flight.content_type,
+                                headers={"X-Coalesced": "true", "X-Accel-Buffering": "no"})
+            if not flight.wait_done(COALESCE_WAIT):
+                return view(*args, **kwargs)
+            coalesced_requests.inc(endpoint=request.path)
+            return Response(b"".join(flight.chunks), status=flight.status, content_type=flight.content_type,
+                            headers={"X-Coalesced": "true"})
+
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            _land_flight(key, flight, failed=True)
+            raise
+
+        if response.is_streamed:
+            flight.start(response.status_code, response.content_type, streamed=True)
+            response.response = FlightStream(key, flight, response.response)
+        else:
+            flight.start(response.status_code, response.content_type, streamed=False)
+            flight.append(response.get_data())
+            _land_flight(key, flight, failed=response.status_code >= 500)
+        return response
+
+    return wrapper
+
+
 # ----------------------------- SUBMIT ENDPOINT -----------------------------
 @app.route('/submit', methods=['POST'])
+@idempotent
 def submit_responses():
     """
     Saves the user's questionnaire responses into the 'responses' table,
@@ -106,49 +981,9 @@ def submit_responses():
     data = request.json
     session_id = str(uuid.uuid4())  # unique session
 
-    # We'll look for these pieces of info among the responses
-    company_name = None
-    use_case = None
-
     try:
-        with engine.begin() as connection:
-            for response in data:
-                question_text = response.get('question')
-                answer_text = response.get('answer')
-                question_id = response.get('question_id')
-
-                if not question_text or answer_text is None:
-                    continue
-
-                # 1) Insert into 'responses'
-                insert_query = text('''
-                    INSERT INTO responses (question_id, response_text, session_id)
-                    VALUES (:question_id, :response_text, :session_id)
-                ''')
-                connection.execute(insert_query, {
-                    'question_id': question_id,
-                    'response_text': answer_text,
-                    'session_id': session_id
-                })
-
-                # 2) Identify special questions by text
-                if "Customer Name" in question_text:
-                    company_name = answer_text.strip()
-
-                if "use cases" in question_text:
-                    use_case = answer_text.strip()
-
-        # 3) Build a session_name
-        from datetime import datetime
-        date_str = datetime.utcnow().strftime("%Y-%m-%d")
-        if company_name and use_case:
-            session_name = f"{company_name} - {use_case} - {date_str}"
-        elif company_name:
-            session_name = f"{company_name} - {date_str}"
-        elif use_case:
-            session_name = f"{use_case} - {date_str}"
-        else:
-            session_name = session_id
+        rows, session_name = prepare_submission(session_id, data)
+        save_assessment(session_id, rows, session_name)
 
         # Return the session_id and session_name to the front-end
         return jsonify({
@@ -161,76 +996,830 @@ def submit_responses():
         return jsonify({"error": "An error occurred while saving responses."}), 500
 
 
-# ----------------------------- FOLLOWUP ENDPOINT -----------------------------
-@app.route('/followup', methods=['POST'])
-def followup():
+def prepare_submission(session_id, responses):
     """
-    Additional user follow-up questions after the recommendation is generated.
+    Returns the 'responses' rows for a questionnaire submission and the session_name
+    derived from it (customer name and use cases, if answered).
     """
-    data = request.json
-    session_id = data.get("session_id")
-    user_message = data.get("message")
+    # We'll look for these pieces of info among the responses
+    company_name = None
+    use_case = None
 
-    if not session_id or not user_message:
-        return jsonify({"error": "session_id and message are required."}), 400
+    rows = []
+    for response in responses:
+        question_text = response.get('question')
+        answer_text = response.get('answer')
+        question_id = response.get('question_id')
+
+        if not question_text or answer_text is None:
+            continue
+
+        # 1) Collect the row for 'responses'
+        rows.append({
+            'question_id': question_id,
+            'response_text': answer_text,
+            'session_id': session_id
+        })
+
+        # 2) Identify special questions by text
+        if "Customer Name" in question_text:
+            company_name = answer_text.strip()
+
+        if "use cases" in question_text:
+            use_case = answer_text.strip()
+
+    # 3) Build a session_name
+    date_str = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    if company_name and use_case:
+        session_name = f"{company_name} - {use_case} - {date_str}"
+    elif company_name:
+        session_name = f"{company_name} - {date_str}"
+    elif use_case:
+        session_name = f"{use_case} - {date_str}"
+    else:
+        session_name = session_id
+
+    return rows, session_name
+
+
+def feature_ranking_rows(session_id, feature_rankings):
+    return [
+        {
+            'session_id': session_id,
+            'rank_position': fr.get("rank_position"),
+            'feature_name': fr.get("feature_name")
+        }
+        for fr in feature_rankings
+        if fr.get("rank_position") is not None and fr.get("feature_name")
+    ]
+
+
+def save_assessment(session_id, rows, session_name, email=None, ranking_rows=None):
+    """
+    Inserts every answer in a single executemany round trip, together with the
+    session's row in Sessions and, when given, its feature rankings, in one transaction.
+    Without an email the session's owner is set later by /recordSession.
+    """
+    with engine.begin() as connection:
+        if rows:
+            insert_query = text('''
+                INSERT INTO responses (question_id, response_text, session_id)
+                VALUES (:question_id, :response_text, :session_id)
+            ''')
+            connection.execute(insert_query, rows)
+        connection.execute(text(TELEMETRY_STATEMENTS["session_upsert"]), {
+            'session_id': session_id,
+            'email': email,
+            'session_name': session_name,
+            'event_timestamp': event_timestamp()
+        })
+        if ranking_rows:
+            connection.execute(text('''
+                INSERT INTO FeatureRankings (session_id, rank_position, feature_name)
+                VALUES (:session_id, :rank_position, :feature_name)
+            '''), ranking_rows)
+
+
+# ----------------------------- LLM GATEWAY -----------------------------
+# Every Azure OpenAI call goes through the gateway (llm_gateway.py): at most
+# LLM_MAX_IN_FLIGHT calls per process, up to LLM_MAX_QUEUE more waiting up to
+# LLM_QUEUE_TIMEOUT seconds for a slot, and 429/5xx/timeouts retried up to
+# LLM_MAX_ATTEMPTS times, on another deployment when one is available, otherwise
+# honouring Retry-After. Calls it cannot place get a 503 with Retry-After instead of a 500.
+#
+# LLM_MAX_IN_FLIGHT bounds the Flask worker's threads, each of which blocks on its call;
+# under asgi.py the calls are coroutines on one event loop, which can wait on many more
+# at once, so they get their own LLM_MAX_IN_FLIGHT_ASYNC limit.
+#
+# Deployments come from AZURE_OPENAI_DEPLOYMENTS (JSON list, see llm_router.py) or the
+# single AZURE_OPENAI_ENDPOINT/KEY/DEPLOYMENT; LLM_ROUTES maps endpoints to deployment groups.
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", 16))
+LLM_MAX_IN_FLIGHT_ASYNC = int(os.getenv("LLM_MAX_IN_FLIGHT_ASYNC", 64))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 64))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 30))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", 4))
+LLM_MAX_RETRY_WAIT = float(os.getenv("LLM_MAX_RETRY_WAIT", 20))
+LLM_BUSY_MESSAGE = "The assistant is busy right now. Please try again shortly."
+
+llm_router = LLMRouter(
+    load_deployments(os.getenv("AZURE_OPENAI_ENDPOINT"), os.getenv("AZURE_OPENAI_KEY"), AZURE_OPENAI_DEPLOYMENT,
+                     AZURE_OPENAI_API_VERSION),
+    load_routes()
+)
+llm_gateway = LLMGateway(
+    llm_router,
+    max_in_flight=LLM_MAX_IN_FLIGHT,
+    max_in_flight_async=LLM_MAX_IN_FLIGHT_ASYNC,
+    max_queue=LLM_MAX_QUEUE,
+    queue_timeout=LLM_QUEUE_TIMEOUT,
+    max_attempts=LLM_MAX_ATTEMPTS,
+    max_retry_wait=LLM_MAX_RETRY_WAIT
+)
+metrics.Gauge("llm_in_flight", "Azure OpenAI calls in flight.", lambda: llm_gateway.stats()["in_flight"])
+metrics.Gauge("llm_queue_depth", "Azure OpenAI calls waiting for a slot.", lambda: llm_gateway.stats()["waiting"])
+
+# The clients (and the openai package, deferred with STARTUP_MODE=lazy) are loaded in
+# the background at startup, and with LLM_WARMUP_CONNECT each endpoint gets a first
+# connection (GET /models), so the first call does not pay for the import or the TLS handshake.
+LLM_WARMUP = os.getenv("LLM_WARMUP", "true").lower() == "true"
+LLM_WARMUP_CONNECT = os.getenv("LLM_WARMUP_CONNECT", "true").lower() == "true"
+LLM_WARMUP_TIMEOUT = float(os.getenv("LLM_WARMUP_TIMEOUT", 5))
+
+
+def warm_up_llm_clients():
+    """
+    Builds every deployment's clients, opens a connection to each, then passes
+    the 'llm_clients' readiness check. Connection errors are only logged: the
+    gateway fails over on its own and the rest of the API does not need Azure OpenAI.
+    """
+    with startup.phase("llm_clients"):
+        for deployment in llm_router.deployments:
+            client = deployment.client
+            deployment.async_client
+            if not LLM_WARMUP_CONNECT:
+                continue
+            try:
+                # with_options shares the client's connection pool
+                client.with_options(timeout=LLM_WARMUP_TIMEOUT).models.list()
+            except Exception as e:
+                print(f"Error warming up Azure OpenAI deployment {deployment.name}:", str(e))
+    startup.passed("llm_clients")
+
+
+if LLM_WARMUP:
+    startup.expect("llm_clients")
+    threading.Thread(target=warm_up_llm_clients, name="llm-warmup", daemon=True).start()
+
+
+def llm_busy_response(error, extra=None):
+    """
+    503 for a call the gateway could not place, with its Retry-After hint.
+    """
+    response = jsonify(dict(extra or {}, error=LLM_BUSY_MESSAGE))
+    response.status_code = 503
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+# ----------------------------- LLM CALL TELEMETRY -----------------------------
+# Every Azure OpenAI call is recorded in LLMCalls (token usage, latency,
+# time-to-first-token when streaming, deployment, retries), see sql/003_llm_calls.sql.
+# LLMCallsDaily rolls them up per day.
+llm_tokens = metrics.Counter("llm_tokens_total", "Tokens used by Azure OpenAI calls.", ("endpoint", "kind"))
+llm_calls = metrics.Counter("llm_calls_total", "Azure OpenAI calls.", ("endpoint", "status"))
+llm_ttft = metrics.Histogram("llm_time_to_first_token_seconds", "Time to first streamed token.", ("endpoint",))
+
+
+def record_llm_call(endpoint, session_id, model, usage, latency, ttft=None, retries=0, streamed=False, status="ok"):
+    """
+    Queues one LLMCalls row and updates the token/call metrics.
+    usage is the OpenAI usage object (None when the call failed).
+    """
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None)
+
+    llm_calls.inc(endpoint=endpoint, status=status)
+    for kind, count in (("prompt", prompt_tokens), ("completion", completion_tokens), ("cached", cached_tokens)):
+        if count:
+            llm_tokens.inc(count, endpoint=endpoint, kind=kind)
+    if ttft is not None:
+        llm_ttft.observe(ttft, endpoint=endpoint)
+
+    try:
+        record_event("llm_call", {
+            "session_id": session_id,
+            "endpoint": endpoint,
+            "deployment": model,
+            "streamed": 1 if streamed else 0,
+            "status": status,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+            "latency_ms": int(latency * 1000),
+            "ttft_ms": int(ttft * 1000) if ttft is not None else None,
+            "retry_count": retries,
+            "created_at": event_timestamp()
+        })
+    except Exception as e:
+        print("Error recording LLM call:", str(e))
+
+
+def chat_completion(endpoint, session_id, **kwargs):
+    """
+    Blocking Azure OpenAI call; returns the answer text and records the call.
+    """
+    with llm_gateway.slot(endpoint) as call:
+        start = time.perf_counter()
+        try:
+            with metrics.timed_phase("llm"):
+                raw = llm_gateway.create(call, **kwargs)
+                response = raw.parse()
+        except Exception as e:
+            record_llm_call(endpoint, session_id, call.deployment_name, None, time.perf_counter() - start,
+                            retries=call.retries, status="throttled" if isinstance(e, GatewayBusy) else "error")
+            raise
+
+    record_llm_call(
+        endpoint, session_id, call.deployment_name, response.usage, time.perf_counter() - start, retries=call.retries
+    )
+    return response.choices[0].message.content.strip()
+
+
+# ----------------------------- SERVER-SENT EVENTS -----------------------------
+def wants_stream(data=None):
+    """
+    Streaming is opt-in: ?stream=1, "stream": true in the JSON body,
+    or an Accept: text/event-stream header.
+    """
+    if request.args.get("stream", "").lower() in ("1", "true", "yes"):
+        return True
+    if isinstance(data, dict) and data.get("stream") is True:
+        return True
+    return "text/event-stream" in request.headers.get("Accept", "")
+
+
+def sse_event(payload, event=None):
+    """
+    Formats one Server-Sent Event carrying a JSON payload.
+    """
+    message = f"event: {event}\n" if event else ""
+    message += f"data: {json.dumps(payload)}\n\n"
+    return message
+
+
+def sse_response(generator):
+    """
+    Wraps a generator of SSE strings in a non-buffered streaming response.
+    """
+    return Response(
+        stream_with_context(generator),
+        mimetype="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
+
+def llm_error_event(error=None):
+    """
+    The SSE 'error' event for a failed generation (error=None: no details).
+    """
+    if isinstance(error, GatewayBusy):
+        return sse_event({"error": LLM_BUSY_MESSAGE, "retry_after": error.retry_after}, event="error")
+    return sse_event({"error": "Error with Azure OpenAI generation."}, event="error")
+
+
+def stream_chat_completion(session_id, on_complete, **kwargs):
+    """
+    Calls Azure OpenAI with stream=True and yields SSE 'token' events as deltas arrive.
+    Once the stream finishes, on_complete(full_text) persists the answer and the
+    final 'done' event carries the full text plus whatever on_complete returned.
+    """
+    parts = []
+    endpoint = request.url_rule.rule if request.url_rule else request.path
+    call = None
+    start = None
+    ttft = None
+    usage = None
+    try:
+        # The slot is held until the whole answer has been read
+        with llm_gateway.slot(endpoint) as call:
+            start = time.perf_counter()
+            raw = llm_gateway.create(call, stream=True, stream_options={"include_usage": True}, **kwargs)
+            for chunk in raw.parse():
+                # The last chunk carries the usage and no choices
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                # Azure sends a first chunk with no choices (content filter results)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    parts.append(delta)
+                    yield sse_event({"delta": delta}, event="token")
+    except Exception as e:
+        print("Error streaming from Azure OpenAI:", str(e))
+        # start is unset when the call never got a slot, i.e. never reached Azure
+        if start is not None:
+            record_llm_call(endpoint, session_id, call.deployment_name, usage, time.perf_counter() - start,
+                            ttft=ttft, retries=call.retries, streamed=True,
+                            status="throttled" if isinstance(e, GatewayBusy) else "error")
+        yield llm_error_event(e)
+        return
+
+    # The response has already been sent, so this is recorded outside the request hooks
+    latency = time.perf_counter() - start
+    metrics.observe_phase(endpoint, "llm_stream", latency)
+    record_llm_call(endpoint, session_id, call.deployment_name, usage, latency,
+                    ttft=ttft, retries=call.retries, streamed=True)
+
+    full_text = "".join(parts).strip()
+    extra = on_complete(full_text) or {}
+    yield sse_event(dict({"text": full_text}, **extra), event="done")
+
+
+# ----------------------------- PROMPT STORAGE -----------------------------
+# Recommendation prompts end with a large static context (instructions, feature
+# comparison table and resources) that is identical across sessions. It is stored
+# once per version in PromptContexts, keyed by its SHA-256, and LLMResponses only
+# keeps the per-session part plus that hash (see sql/005_prompt_storage.sql).
+# Both parts are zstd-compressed unless PROMPT_COMPRESSION is 'none'.
+# Rows written with PROMPT_STORAGE=inline, or before the migration, keep the full
+# prompt in LLMResponses.prompt and are read back unchanged.
+PROMPT_STORAGE = os.getenv("PROMPT_STORAGE", "compact").lower()
+PROMPT_COMPRESSION = os.getenv("PROMPT_COMPRESSION", "zstd").lower()
+PROMPT_COMPRESSION_LEVEL = int(os.getenv("PROMPT_COMPRESSION_LEVEL", 10))
+
+# The static context of build_recommendation_prompt() starts with this line
+PROMPT_CONTEXT_MARKER = "\n        Provide a personalized recommendation between"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+_prompt_contexts = OrderedDict()
+_prompt_contexts_lock = threading.Lock()
+_PROMPT_CONTEXTS_MAX = 16
+
+
+def compress_text(value):
+    """
+    Encodes text for a VARBINARY column: a zstd frame, or plain UTF-8 when compression is off.
+    """
+    data = value.encode("utf-8")
+    if PROMPT_COMPRESSION == "zstd":
+        return zstandard.compress(data, PROMPT_COMPRESSION_LEVEL)
+    return data
+
+
+def decompress_text(data):
+    """
+    Decodes a value written by compress_text(); zstd frames are recognized by their magic number.
+    """
+    data = bytes(data)
+    if data.startswith(ZSTD_MAGIC):
+        data = zstandard.decompress(data)
+    return data.decode("utf-8")
+
+
+def split_prompt(prompt):
+    """
+    Splits a recommendation prompt into (variable part, static context),
+    or returns None when the prompt has no recognizable static context.
+    """
+    index = prompt.rfind(PROMPT_CONTEXT_MARKER) if prompt else -1
+    if index < 0:
+        return None
+    return prompt[:index], prompt[index:]
+
+
+def remember_prompt_context(context_hash, context):
+    """
+    Caches a context that is known to be stored in PromptContexts.
+    """
+    with _prompt_contexts_lock:
+        _prompt_contexts[context_hash] = context
+        _prompt_contexts.move_to_end(context_hash)
+        while len(_prompt_contexts) > _PROMPT_CONTEXTS_MAX:
+            _prompt_contexts.popitem(last=False)
+
+
+def store_prompt(connection, prompt):
+    """
+    Stores the static context of a prompt (once per version) on the given connection.
+    Returns (columns, context): the LLMResponses column values, i.e. the full prompt
+    when compact storage is off or the prompt cannot be split, else the compressed
+    variable part and the context hash; and the context text, to pass to
+    remember_prompt_context() once the transaction has committed.
+    """
+    parts = split_prompt(prompt) if PROMPT_STORAGE == "compact" else None
+    if parts is None:
+        return {"prompt": prompt, "prompt_vars": None, "prompt_context_hash": None}, None
+
+    variable_part, context = parts
+    context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()
+    with _prompt_contexts_lock:
+        known = context_hash in _prompt_contexts
+    if not known:
+        connection.execute(text("""
+            MERGE PromptContexts WITH (HOLDLOCK) AS target
+            USING (SELECT :context_hash AS context_hash) AS source
+            ON target.context_hash = source.context_hash
+            WHEN NOT MATCHED THEN
+                INSERT (context_hash, body, created_at)
+                VALUES (:context_hash, :body, SYSUTCDATETIME());
+        """), {"context_hash": context_hash, "body": compress_text(context)})
+
+    return {
+        "prompt": None,
+        "prompt_vars": compress_text(variable_part),
+        "prompt_context_hash": context_hash
+    }, context
+
+
+def get_prompt_context(connection, context_hash):
+    """
+    Returns the static context text for a hash, from memory when possible.
+    """
+    with _prompt_contexts_lock:
+        context = _prompt_contexts.get(context_hash)
+    if context is not None:
+        return context
+
+    row = connection.execute(
+        text("SELECT body FROM PromptContexts WHERE context_hash = :context_hash"),
+        {"context_hash": context_hash}
+    ).fetchone()
+    if row is None:
+        return ""
+    context = decompress_text(row.body)
+    remember_prompt_context(context_hash, context)
+    return context
+
+
+def rebuild_prompt(connection, prompt, prompt_vars, context_hash):
+    """
+    Returns the full prompt of an LLMResponses row, whichever way it was stored.
+    """
+    if prompt is not None or prompt_vars is None:
+        return prompt or ""
+    return decompress_text(prompt_vars) + (get_prompt_context(connection, context_hash) if context_hash else "")
+
+
+@app.cli.command("compact-prompts")
+@click.option("--batch-size", default=500, show_default=True)
+def compact_prompts_command(batch_size):
+    """
+    Moves the full prompts of existing LLMResponses rows to compact storage.
+    """
+    compacted = 0
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(text("""
+                SELECT TOP (:batch_size) id, prompt
+                FROM LLMResponses
+                WHERE id > :last_id AND prompt IS NOT NULL
+                ORDER BY id
+            """), {"batch_size": batch_size, "last_id": last_id}).fetchall()
+            if not rows:
+                break
+            updates = []
+            contexts = {}
+            for row in rows:
+                stored, context = store_prompt(connection, row.prompt)
+                if context is not None:
+                    updates.append(dict(stored, id=row.id))
+                    contexts[stored["prompt_context_hash"]] = context
+            if updates:
+                connection.execute(text("""
+                    UPDATE LLMResponses
+                    SET prompt = :prompt, prompt_vars = :prompt_vars, prompt_context_hash = :prompt_context_hash
+                    WHERE id = :id
+                """), updates)
+            compacted += len(updates)
+            last_id = rows[-1].id
+        for context_hash, context in contexts.items():
+            remember_prompt_context(context_hash, context)
+    click.echo(f"Compacted {compacted} prompts.")
+
+
+# ----------------------------- SESSION LOADER -----------------------------
+def load_session(session_id, include_prompt=False):
+    """
+    Loads everything stored for a session (Q&A, latest recommendation, follow-ups
+    and feature rankings) in a single round trip: one UNION ALL query whose
+    'kind' column tells the row types apart. The original prompt and the follow-up
+    summary are only selected when include_prompt is set, since only follow-ups need them.
+    """
+    prompt_column = "prompt" if include_prompt else "NULL"
+    stored_prompt_columns = "prompt_vars, prompt_context_hash" if include_prompt else "NULL, NULL"
+    summary_query = """
+        UNION ALL
+        SELECT 'summary', summarized_turns, NULL, summary, NULL, NULL, NULL
+        FROM FollowUpSummaries
+        WHERE session_id = :session_id""" if include_prompt and FOLLOWUP_SUMMARY_ENABLED else ""
+    query = text(f"""
+        SELECT 'qa' AS kind, r.id AS ord, r.question_id AS num,
+               q.question AS text1, r.response_text AS text2,
+               CAST(NULL AS VARBINARY(MAX)) AS data, CAST(NULL AS CHAR(64)) AS ref
+        FROM responses r
+        LEFT JOIN new_questions3 q ON r.question_id = q.id
+        WHERE r.session_id = :session_id
+        UNION ALL
+        SELECT 'llm', id, NULL, {prompt_column}, response_text, {stored_prompt_columns}
+        FROM LLMResponses
+        WHERE session_id = :session_id
+        UNION ALL
+        SELECT 'followup', id, NULL, user_message, assistant_message, NULL, NULL
+        FROM FollowUps
+        WHERE session_id = :session_id
+        UNION ALL
+        SELECT 'ranking', id, rank_position, feature_name, NULL, NULL, NULL
+        FROM FeatureRankings
+        WHERE session_id = :session_id{summary_query}
+        ORDER BY kind, ord
+    """)
 
-    # Check how many followups so far
     with engine.connect() as connection:
-        followup_count_result = connection.execute(text("""
-            SELECT COUNT(*) as cnt FROM FollowUps WHERE session_id = :session_id
-        """), {'session_id': session_id}).fetchone()
-        followup_count = followup_count_result.cnt if followup_count_result else 0
+        rows = connection.execute(query, {"session_id": session_id}).fetchall()
+        latest_llm = next((row for row in reversed(rows) if row.kind == "llm"), None)
+        prompt = ""
+        if include_prompt and latest_llm is not None:
+            prompt = rebuild_prompt(connection, latest_llm.text1, latest_llm.data, latest_llm.ref)
+
+    session = {
+        "qa": [],
+        "prompt": prompt,
+        "recommendation": None,
+        "followups": [],
+        "feature_rankings": [],
+        "summary": None,
+        "summarized_turns": 0
+    }
+    for row in rows:
+        if row.kind == "qa":
+            session["qa"].append({
+                "question_id": row.num,
+                "question": row.text1,
+                "response_text": row.text2
+            })
+        elif row.kind == "llm":
+            # Rows are ordered by id, so the last one is the latest recommendation
+            session["recommendation"] = row.text2
+        elif row.kind == "followup":
+            session["followups"].append({
+                "user_message": row.text1,
+                "assistant_message": row.text2
+            })
+        elif row.kind == "ranking":
+            session["feature_rankings"].append({
+                "rank_position": row.num,
+                "feature_name": row.text1
+            })
+        elif row.kind == "summary":
+            session["summary"] = row.text1
+            session["summarized_turns"] = row.ord
+
+    session["feature_rankings"].sort(key=lambda fr: fr["rank_position"])
+    return session
+
+
+# ----------------------------- CONVERSATION CACHE -----------------------------
+# Bounded LRU of assembled follow-up conversations, so a new turn only appends
+# to the cached context instead of reloading the whole session from SQL.
+# The cache is per process, so every hit is checked against a one-row version probe
+# (follow-up counter, summarized turns, latest recommendation id): a turn, summary or
+# recommendation written by another worker or instance drops the entry. The probe is
+# deliberately paid on every hit: it is still far cheaper than reloading the session,
+# and skipping it would serve stale turns from other workers. Entries also
+# expire after CONVERSATION_CACHE_TTL seconds and are dropped locally when a session
+# is deleted or gets a new recommendation.
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", 256))
+CONVERSATION_CACHE_TTL = int(os.getenv("CONVERSATION_CACHE_TTL", 600))
+
+_conversation_cache = OrderedDict()
+_conversation_lock = threading.Lock()
 
-        if followup_count >= 20:
-            return jsonify({"error": "Maximum of 20 follow-up questions reached."}), 400
 
-    # Retrieve original Q&A and recommendation
+def conversation_version(session_id):
+    """
+    What a cached conversation depends on, in one cheap round trip: the
+    FollowUpCounters count, the turns folded into the summary and the id of the
+    latest recommendation. Any worker saving a turn, refreshing the summary or
+    storing a new recommendation changes it.
+    """
+    summarized_turns = "(SELECT summarized_turns FROM FollowUpSummaries WHERE session_id = :session_id)" \
+        if FOLLOWUP_SUMMARY_ENABLED else "NULL"
     with engine.connect() as connection:
-        qa_results = connection.execute(text("""
-            SELECT q.Question, r.response_text
-            FROM responses r
-            JOIN new_questions3 q ON r.question_id = q.id
-            WHERE r.session_id = :session_id AND r.question_id != -1
-        """), {'session_id': session_id}).fetchall()
-
-        free_form_result = connection.execute(text("""
-            SELECT response_text FROM responses
-            WHERE session_id = :session_id AND question_id = -1
-        """), {'session_id': session_id}).fetchone()
-        free_form = free_form_result.response_text if free_form_result else ""
-
-        llm_resp_result = connection.execute(text("""
-            SELECT prompt, response_text
-            FROM LLMResponses
-            WHERE session_id = :session_id
-        """), {'session_id': session_id}).fetchone()
-        original_prompt = llm_resp_result.prompt if llm_resp_result else ""
-        recommendation = llm_resp_result.response_text if llm_resp_result else ""
-
-        prev_followups = connection.execute(text("""
-            SELECT user_message, assistant_message
-            FROM FollowUps
-            WHERE session_id = :session_id
-            ORDER BY id ASC
-        """), {'session_id': session_id}).fetchall()
+        row = connection.execute(text(f"""
+            SELECT
+                (SELECT followup_count FROM FollowUpCounters WHERE session_id = :session_id) AS followups,
+                {summarized_turns} AS summarized_turns,
+                (SELECT MAX(id) FROM LLMResponses WHERE session_id = :session_id) AS recommendation_id
+        """), {"session_id": session_id}).fetchone()
+    # A session without follow-ups has no counter row yet: that is a count of 0
+    return {"followups": row.followups or 0, "summarized_turns": row.summarized_turns,
+            "recommendation_id": row.recommendation_id}
+
+
+def get_followup_context(session_id):
+    """
+    Returns (messages, followup_count) for a session, from the cache when it is
+    still current. The returned list is a copy and can be extended by the caller.
+    """
+    now = time.monotonic()
+    # Probed before loading: a write that lands in between leaves an older version
+    # on the entry, so the next call reloads
+    version = conversation_version(session_id)
+    with _conversation_lock:
+        entry = _conversation_cache.get(session_id)
+        if entry is not None and now < entry["expires_at"] and entry["version"] == version:
+            _conversation_cache.move_to_end(session_id)
+            return list(entry["messages"]), entry["followup_count"]
+        _conversation_cache.pop(session_id, None)
+
+    session = load_session(session_id, include_prompt=True)
+    messages = build_followup_context(session)
+    followup_count = len(session["followups"])
+
+    with _conversation_lock:
+        _conversation_cache[session_id] = {
+            "messages": messages,
+            "followup_count": followup_count,
+            "version": version,
+            "expires_at": now + CONVERSATION_CACHE_TTL
+        }
+        _conversation_cache.move_to_end(session_id)
+        while len(_conversation_cache) > CONVERSATION_CACHE_SIZE:
+            _conversation_cache.popitem(last=False)
+
+    return list(messages), followup_count
+
+
+def append_to_cached_conversation(session_id, user_message, assistant_message, counter):
+    """
+    Appends a saved follow-up turn to the cached conversation, if there is one.
+    counter is the FollowUpCounters value after the insert; when it is not the
+    next one after the cached version, another worker saved a turn in between
+    and the entry is dropped instead.
+    """
+    with _conversation_lock:
+        entry = _conversation_cache.get(session_id)
+        if entry is None:
+            return
+        if (entry["version"]["followups"] or 0) + 1 != counter:
+            _conversation_cache.pop(session_id, None)
+            return
+        entry["messages"].append({"role": "user", "content": user_message})
+        entry["messages"].append({"role": "assistant", "content": assistant_message})
+        entry["followup_count"] += 1
+        entry["version"] = dict(entry["version"], followups=counter)
+        entry["expires_at"] = time.monotonic() + CONVERSATION_CACHE_TTL
+
+
+def invalidate_conversation(session_id):
+    """
+    Drops the cached conversation of a session.
+    """
+    with _conversation_lock:
+        _conversation_cache.pop(session_id, None)
+
+
+# ----------------------------- FOLLOW-UP SUMMARIES -----------------------------
+# Keeps follow-up context bounded (sql/007_followup_summaries.sql). Once a session has
+# more than FOLLOWUP_SUMMARY_TURNS unsummarized turns, or they add up to more than
+# FOLLOWUP_SUMMARY_TOKENS (estimated), all but the FOLLOWUP_RECENT_TURNS latest are
+# folded into a rolling summary that replaces them in the prompt. The summary is
+# refreshed incrementally (old summary + newly folded turns) on a background thread
+# after a turn is saved, so no follow-up waits for it. Summaries are LLM calls on the
+# "/followup/summary" route (see LLM_ROUTES).
+FOLLOWUP_SUMMARY_ENABLED = os.getenv("FOLLOWUP_SUMMARY_ENABLED", "true").lower() == "true"
+FOLLOWUP_SUMMARY_TURNS = int(os.getenv("FOLLOWUP_SUMMARY_TURNS", 6))
+FOLLOWUP_SUMMARY_TOKENS = int(os.getenv("FOLLOWUP_SUMMARY_TOKENS", 4000))
+FOLLOWUP_RECENT_TURNS = int(os.getenv("FOLLOWUP_RECENT_TURNS", 2))
+FOLLOWUP_SUMMARY_MAX_TOKENS = int(os.getenv("FOLLOWUP_SUMMARY_MAX_TOKENS", 500))
+
+FOLLOWUP_SUMMARY_PROMPT = (
+    "You keep a running summary of a follow-up conversation about choosing Azure data services "
+    "for an intelligent application. Merge the new turns into the summary so far. "
+    "Keep every requirement, constraint, number, decision and open question the user raised, "
+    "and what was recommended in reply. Leave out greetings and repetition. "
+    "Answer with the updated summary only, in at most 300 words."
+)
+
+followup_summaries = metrics.Counter("followup_summaries_total", "Rolling follow-up summary refreshes.", ("status",))
+
+_summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="followup-summary")
+_summarizing = set()
+_summarizing_lock = threading.Lock()
+
+
+def estimate_tokens(text_value):
+    """
+    Rough token count (4 characters per token), good enough for thresholds.
+    """
+    return len(text_value or "") // 4
+
+
+def turns_to_fold(turns):
+    """
+    How many of the oldest unsummarized turns should go into the summary (0 while
+    they are under both the turn and the token threshold).
+    """
+    if len(turns) <= FOLLOWUP_RECENT_TURNS:
+        return 0
+    size = sum(estimate_tokens(t["user_message"]) + estimate_tokens(t["assistant_message"]) for t in turns)
+    if len(turns) <= FOLLOWUP_SUMMARY_TURNS and size <= FOLLOWUP_SUMMARY_TOKENS:
+        return 0
+    return len(turns) - FOLLOWUP_RECENT_TURNS
+
+
+def schedule_summary_refresh(session_id, followup_count):
+    """
+    Queues a summary refresh for a session after one of its turns was saved
+    (at most one per session at a time; a skipped one is caught up on the next turn).
+    """
+    if not FOLLOWUP_SUMMARY_ENABLED or followup_count <= FOLLOWUP_RECENT_TURNS:
+        return
+    with _summarizing_lock:
+        if session_id in _summarizing:
+            return
+        _summarizing.add(session_id)
+    _summary_executor.submit(refresh_followup_summary, session_id)
+
+
+def refresh_followup_summary(session_id):
+    """
+    Folds the turns over the thresholds into the session's summary. The write only
+    applies if no other worker moved the summary on in the meantime.
+    """
+    try:
+        with engine.connect() as connection:
+            current = connection.execute(text("""
+                SELECT summary, summarized_turns FROM FollowUpSummaries WHERE session_id = :session_id
+            """), {"session_id": session_id}).fetchone()
+            rows = connection.execute(text("""
+                SELECT user_message, assistant_message FROM FollowUps WHERE session_id = :session_id ORDER BY id
+            """), {"session_id": session_id}).fetchall()
+
+        summary, summarized = (current.summary, current.summarized_turns) if current else (None, 0)
+        pending = [{"user_message": r.user_message, "assistant_message": r.assistant_message} for r in rows[summarized:]]
+        fold = turns_to_fold(pending)
+        if not fold:
+            return
+
+        transcript = "\n\n".join(
+            f"User: {t['user_message']}\nAssistant: {t['assistant_message']}" for t in pending[:fold]
+        )
+        new_summary = chat_completion(
+            "/followup/summary",
+            session_id,
+            messages=[
+                {"role": "system", "content": FOLLOWUP_SUMMARY_PROMPT},
+                {"role": "user", "content": f"Summary so far:\n{summary or '(none yet)'}\n\nNew turns:\n{transcript}"}
+            ],
+            max_tokens=FOLLOWUP_SUMMARY_MAX_TOKENS,
+            temperature=0.2
+        )
+
+        with engine.begin() as connection:
+            connection.execute(text("""
+                MERGE FollowUpSummaries WITH (HOLDLOCK) AS target
+                USING (SELECT :session_id AS session_id) AS source
+                ON target.session_id = source.session_id
+                WHEN MATCHED AND target.summarized_turns = :previous_turns THEN
+                    UPDATE SET summary = :summary, summarized_turns = :summarized_turns, updated_at = SYSUTCDATETIME()
+                WHEN NOT MATCHED AND :previous_turns = 0 THEN
+                    INSERT (session_id, summary, summarized_turns) VALUES (:session_id, :summary, :summarized_turns);
+            """), {
+                "session_id": session_id,
+                "summary": new_summary,
+                "summarized_turns": summarized + fold,
+                "previous_turns": summarized
+            })
+        invalidate_conversation(session_id)
+        followup_summaries.inc(status="ok")
+    except Exception as e:
+        print("Error refreshing follow-up summary:", str(e))
+        followup_summaries.inc(status="error")
+    finally:
+        with _summarizing_lock:
+            _summarizing.discard(session_id)
+
+
+# ----------------------------- FOLLOWUP ENDPOINT -----------------------------
+FOLLOWUP_SYSTEM_PROMPT = (
+    "You are an expert recommendation system for data storage in the context of Intelligent Applications. "
+    "Provide guidance based on the previously given recommendation and Q&As. "
+    "Do not repeat the entire recommendation unless asked. "
+    "Do not answer topics not related to AI or Data Storage."
+)
+
+
+def build_followup_context(session):
+    """
+    Returns the conversation so far (system prompt, original context and previous
+    follow-ups) for a session loaded with load_session(session_id, include_prompt=True).
+    Follow-ups already folded into the rolling summary are replaced by that summary.
+    """
+    qa_results = [qa for qa in session["qa"] if qa["question_id"] != -1 and qa["question"] is not None]
+    free_form = next((qa["response_text"] for qa in session["qa"] if qa["question_id"] == -1), "")
+    original_prompt = session["prompt"]
+    recommendation = session["recommendation"] or ""
+    prev_followups = session["followups"]
 
     # Build conversation
     messages = [
-        {
-            "role": "system",
-            "content": (
-                "You are an expert recommendation system for data storage in the context of Intelligent Applications. "
-                "Provide guidance based on the previously given recommendation and Q&As. "
-                "Do not repeat the entire recommendation unless asked. "
-                "Do not answer topics not related to AI or Data Storage."
-            )
-        },
+        {"role": "system", "content": FOLLOWUP_SYSTEM_PROMPT},
         {
             "role": "user",
             "content": (
                 f"Original prompt:\n\n{original_prompt}\n\n"
                 "Initial Q&A responses:\n"
-                + "\n".join([f"{row.Question}: {row.response_text}" for row in qa_results])
+                + "\n".join([f"{qa['question']}: {qa['response_text']}" for qa in qa_results])
                 + f"\n\nFree-form details: {free_form}\n\n"
                 "Previous recommendation:\n"
                 + recommendation
@@ -238,65 +1827,130 @@ def followup():
         }
     ]
 
-    for fup in prev_followups:
-        messages.append({"role": "user", "content": fup.user_message})
-        messages.append({"role": "assistant", "content": fup.assistant_message})
+    if session["summary"]:
+        messages.append({
+            "role": "system",
+            "content": "Summary of the earlier follow-up conversation:\n" + session["summary"]
+        })
+
+    for fup in prev_followups[session["summarized_turns"]:]:
+        messages.append({"role": "user", "content": fup["user_message"]})
+        messages.append({"role": "assistant", "content": fup["assistant_message"]})
+
+    return messages
+
+
+def save_followup(session_id, user_message, followup_answer):
+    """
+    Persists one follow-up turn into the FollowUps table.
+    The per-session counter in FollowUpCounters is bumped in the same transaction,
+    only while it is below MAX_FOLLOWUPS, so concurrent turns cannot both slip
+    past the limit. Returns False when the limit was already reached.
+    """
+    try:
+        with engine.begin() as connection:
+            counter = connection.execute(text("""
+                MERGE FollowUpCounters WITH (HOLDLOCK) AS target
+                USING (SELECT :session_id AS session_id) AS source
+                ON target.session_id = source.session_id
+                WHEN MATCHED AND target.followup_count < :max_followups THEN
+                    UPDATE SET followup_count = target.followup_count + 1
+                WHEN NOT MATCHED THEN
+                    INSERT (session_id, followup_count) VALUES (:session_id, 1)
+                OUTPUT inserted.followup_count;
+            """), {'session_id': session_id, 'max_followups': MAX_FOLLOWUPS}).fetchone()
+
+            if counter is None:
+                invalidate_conversation(session_id)
+                return False
+
+            insert_query = text('''
+                INSERT INTO FollowUps (session_id, user_message, assistant_message)
+                VALUES (:session_id, :user_message, :assistant_message)
+            ''')
+            connection.execute(insert_query, {
+                'session_id': session_id,
+                'user_message': user_message,
+                'assistant_message': followup_answer
+            })
+        append_to_cached_conversation(session_id, user_message, followup_answer, counter.followup_count)
+        schedule_summary_refresh(session_id, counter.followup_count)
+    except Exception as e:
+        print("Error saving followup:", str(e))
+        invalidate_conversation(session_id)
+    return True
+
+
+def finish_followup(session_id, user_message, followup_answer):
+    """
+    Saves a streamed follow-up; the returned dict is merged into the final SSE event.
+    """
+    if not save_followup(session_id, user_message, followup_answer):
+        return {"error": f"Maximum of {MAX_FOLLOWUPS} follow-up questions reached."}
+    return {}
+
+
+@app.route('/followup', methods=['POST'])
+@idempotent
+@coalesced
+def followup():
+    """
+    Additional user follow-up questions after the recommendation is generated.
+    Pass ?stream=1 (or "stream": true) to receive the answer as Server-Sent Events.
+    """
+    data = request.json
+    session_id = data.get("session_id")
+    user_message = data.get("message")
+
+    if not session_id or not user_message:
+        return jsonify({"error": "session_id and message are required."}), 400
+
+    # Cached conversation, or one round trip for the whole session.
+    # The count is only an early check; save_followup() enforces the limit atomically.
+    with metrics.timed_phase("prompt"):
+        messages, followup_count = get_followup_context(session_id)
+
+    if followup_count >= MAX_FOLLOWUPS:
+        return jsonify({"error": f"Maximum of {MAX_FOLLOWUPS} follow-up questions reached."}), 400
 
     # Add the new user follow-up
     messages.append({"role": "user", "content": user_message})
 
+    if wants_stream(data):
+        return sse_response(stream_chat_completion(
+            session_id,
+            lambda answer: finish_followup(session_id, user_message, answer),
+            messages=messages,
+            max_tokens=1000,
+            temperature=0.7
+        ))
+
     try:
-        response = openai.chat.completions.create(
-            model=AZURE_OPENAI_DEPLOYMENT,
+        followup_answer = chat_completion(
+            "/followup",
+            session_id,
             messages=messages,
             max_tokens=1000,
             temperature=0.7
         )
-        followup_answer = response.choices[0].message.content.strip()
+    except GatewayBusy as e:
+        print("Azure OpenAI busy:", str(e))
+        return llm_busy_response(e)
     except Exception as e:
         print("Error calling Azure OpenAI:", str(e))
         return jsonify({"error": "Error with Azure OpenAI generation."}), 500
 
-    # Save the new followup
-    try:
-        with engine.begin() as connection:
-            insert_query = text('''
-                INSERT INTO FollowUps (session_id, user_message, assistant_message)
-                VALUES (:session_id, :user_message, :assistant_message)
-            ''')
-            connection.execute(insert_query, {
-                'session_id': session_id,
-                'user_message': user_message,
-                'assistant_message': followup_answer
-            })
-    except Exception as e:
-        print("Error saving followup:", str(e))
+    # Save the new followup (a concurrent turn may have used the last slot)
+    if not save_followup(session_id, user_message, followup_answer):
+        return jsonify({"error": f"Maximum of {MAX_FOLLOWUPS} follow-up questions reached."}), 400
 
     return jsonify({"answer": followup_answer})
 
 
 # ----------------------------- RECOMMENDATION ENDPOINT -----------------------------
-@app.route('/recommendation', methods=['POST'])
-def get_recommendation():
-    """
-    Generates a final recommendation using Azure OpenAI
-    based on questionnaire responses + optional top5 features.
-    """
-    try:
-        data = request.json
-        responses = data.get("responses", [])
-        session_id = data.get("session_id")
-        top5_features = data.get("top5_features", [])
-
-        # free-form response
-        free_form_response = ""
-        for r in responses:
-            if r.get("question_id") == -1:
-                free_form_response = r.get("answer", "")
-
-        feature_table = get_feature_comparison_from_db()
+RECOMMENDATION_SYSTEM_PROMPT = "You are an expert data storage recommendation system. Be concise and helpful."
 
-        database_resources = """
+DATABASE_RESOURCES = """
         Resources for Azure AI Search:
         - Accelerator: 
             - https://github.com/Azure-Samples/chat-with-your-data-solution-accelerator
@@ -330,22 +1984,37 @@ def get_recommendation():
         - Internal resources for AI Design Win: https://microsoft.sharepoint.com/sites/AIDesignWins
         """
 
-        # Build prompt
-        prompt = "The user has completed a questionnaire.\nHere are their responses:\n"
-        for resp in responses:
-            question = resp.get('question')
-            answer = resp.get('answer')
-            prompt += f"- {question}: {answer}\n"
 
-        if top5_features:
-            prompt += "\nThey identified these TOP 5 Requirements:\n"
-            for idx, feat in enumerate(top5_features, 1):
-                prompt += f"#{idx}: {feat}\n"
-
-        if free_form_response:
-            prompt += f"\nAdditional free-form details:\n{free_form_response}\n"
-
-        prompt += f"""
+def build_recommendation_prompt(responses, top5_features):
+    """
+    Builds the recommendation prompt from the questionnaire responses,
+    the optional top 5 features and the cached feature comparison table.
+    """
+    # free-form response
+    free_form_response = ""
+    for r in responses:
+        if r.get("question_id") == -1:
+            free_form_response = r.get("answer", "")
+
+    feature_table = get_feature_comparison_from_db()
+    database_resources = DATABASE_RESOURCES
+
+    # Build prompt
+    prompt = "The user has completed a questionnaire.\nHere are their responses:\n"
+    for resp in responses:
+        question = resp.get('question')
+        answer = resp.get('answer')
+        prompt += f"- {question}: {answer}\n"
+
+    if top5_features:
+        prompt += "\nThey identified these TOP 5 Requirements:\n"
+        for idx, feat in enumerate(top5_features, 1):
+            prompt += f"#{idx}: {feat}\n"
+
+    if free_form_response:
+        prompt += f"\nAdditional free-form details:\n{free_form_response}\n"
+
+    prompt += f"""
         Provide a personalized recommendation between Azure AI Search, Azure SQL Database, Azure Cosmos DB, and Azure PostgreSQL for each scenario that the user has selected.
         Try to use the same data source across scenarios if possible. Include relevant resources.
 
@@ -369,44 +2038,291 @@ def get_recommendation():
         For example, what framework does the customer use? Do they have an existing database skill/preference? But most important, use your judgement based on the application and data scenarios used.
         """
 
-        print("LLM Prompt:\n", prompt)
+    return prompt
 
-        response = openai.chat.completions.create(
-            model=AZURE_OPENAI_DEPLOYMENT,
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "You are an expert data storage recommendation system. Be concise and helpful."
-                    )
-                },
-                {"role": "user", "content": prompt}
-            ],
+
+def save_llm_response(session_id, prompt, recommendation):
+    """
+    Persists the generated recommendation and its prompt into LLMResponses
+    (in compact form, see PROMPT STORAGE).
+    """
+    try:
+        with engine.begin() as connection:
+            stored, context = store_prompt(connection, prompt)
+            insert_query = text('''
+                INSERT INTO LLMResponses (session_id, prompt, prompt_vars, prompt_context_hash, response_text)
+                VALUES (:session_id, :prompt, :prompt_vars, :prompt_context_hash, :response_text)
+            ''')
+            connection.execute(insert_query, dict(stored, session_id=session_id, response_text=recommendation))
+        if context is not None:
+            remember_prompt_context(stored["prompt_context_hash"], context)
+    except Exception as e:
+        print("Error saving LLM response:", str(e))
+    invalidate_conversation(session_id)
+
+
+# ----------------------------- RECOMMENDATION CACHE -----------------------------
+# Optional cache of generated recommendations keyed by a canonical fingerprint of the
+# questionnaire (normalized answers, top 5 features, feature-table version and model).
+# Backed by the RecommendationCache table (see sql/001_recommendation_cache.sql),
+# which also keeps per-entry hit and miss counters.
+RECOMMENDATION_CACHE_ENABLED = os.getenv("RECOMMENDATION_CACHE_ENABLED", "false").lower() == "true"
+RECOMMENDATION_CACHE_TTL = int(os.getenv("RECOMMENDATION_CACHE_TTL", 7 * 24 * 3600))
+
+recommendation_cache_stats = {"hits": 0, "misses": 0}
+_recommendation_cache_stats_lock = threading.Lock()
+
+
+def _normalize_answer(value):
+    return " ".join(str(value if value is not None else "").split()).lower()
+
+
+def recommendation_fingerprint(responses, top5_features, endpoint="/recommendation"):
+    """
+    Returns a SHA-256 fingerprint of the normalized questionnaire and the models the
+    endpoint is routed to, or None when caching is disabled or the feature-table version is unknown.
+    Call it after build_recommendation_prompt() so the table version is current.
+    """
+    feature_table_version = _feature_table_cache["version"]
+    if not RECOMMENDATION_CACHE_ENABLED or feature_table_version is None:
+        return None
+
+    canonical = {
+        "responses": sorted(
+            [str(r.get("question_id")), _normalize_answer(r.get("question")), _normalize_answer(r.get("answer"))]
+            for r in responses
+        ),
+        "top5_features": [_normalize_answer(feat) for feat in top5_features],
+        "feature_table_version": feature_table_version,
+        "model": ",".join(llm_router.route_models(endpoint))
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def lookup_cached_recommendation(fingerprint):
+    """
+    Returns the cached recommendation for a fingerprint (bumping its hit counter), or None.
+    """
+    if not fingerprint:
+        return None
+
+    try:
+        with engine.begin() as connection:
+            row = connection.execute(text("""
+                UPDATE RecommendationCache
+                SET hit_count = hit_count + 1, last_hit_at = SYSUTCDATETIME()
+                OUTPUT inserted.response_text
+                WHERE fingerprint = :fingerprint AND expires_at > SYSUTCDATETIME()
+            """), {"fingerprint": fingerprint}).fetchone()
+    except Exception as e:
+        print("Error reading recommendation cache:", str(e))
+        return None
+
+    with _recommendation_cache_stats_lock:
+        recommendation_cache_stats["hits" if row else "misses"] += 1
+    return row.response_text if row else None
+
+
+def store_cached_recommendation(fingerprint, recommendation):
+    """
+    Stores (or refreshes) a generated recommendation under its fingerprint.
+    """
+    if not fingerprint or not recommendation:
+        return
+
+    try:
+        with engine.begin() as connection:
+            connection.execute(text("""
+                MERGE RecommendationCache WITH (HOLDLOCK) AS target
+                USING (SELECT :fingerprint AS fingerprint) AS source
+                ON target.fingerprint = source.fingerprint
+                WHEN MATCHED THEN
+                    UPDATE SET response_text = :response_text,
+                               miss_count = target.miss_count + 1,
+                               created_at = SYSUTCDATETIME(),
+                               expires_at = DATEADD(second, :ttl, SYSUTCDATETIME())
+                WHEN NOT MATCHED THEN
+                    INSERT (fingerprint, response_text, hit_count, miss_count, created_at, expires_at)
+                    VALUES (:fingerprint, :response_text, 0, 1, SYSUTCDATETIME(),
+                            DATEADD(second, :ttl, SYSUTCDATETIME()));
+            """), {
+                "fingerprint": fingerprint,
+                "response_text": recommendation,
+                "ttl": RECOMMENDATION_CACHE_TTL
+            })
+    except Exception as e:
+        print("Error writing recommendation cache:", str(e))
+
+
+def finish_recommendation(session_id, prompt, fingerprint, recommendation):
+    """
+    Persists a freshly generated recommendation for the session and in the cache.
+    """
+    save_llm_response(session_id, prompt, recommendation)
+    store_cached_recommendation(fingerprint, recommendation)
+
+
+def cached_recommendation_stream(recommendation):
+    """
+    SSE events for a cache hit: the whole text as one token, then 'done'.
+    """
+    yield sse_event({"delta": recommendation}, event="token")
+    yield sse_event({"text": recommendation, "cached": True}, event="done")
+
+
+def with_prelude(prelude, generator):
+    """
+    Prepends a 'session' SSE event to a stream, when there is something to announce.
+    """
+    if prelude:
+        yield sse_event(prelude, event="session")
+    yield from generator
+
+
+def recommendation_response(data, session_id, responses, top5_features, extra=None):
+    """
+    Generates (or reuses) the recommendation for a session and returns the response:
+    JSON, or Server-Sent Events when the request asks to stream. 'extra' fields are
+    added to the JSON body, or sent first as a 'session' event when streaming.
+    """
+    extra = extra or {}
+
+    with metrics.timed_phase("prompt"):
+        prompt = build_recommendation_prompt(responses, top5_features)
+
+    # Identical questionnaires reuse a stored recommendation (when enabled)
+    fingerprint = recommendation_fingerprint(responses, top5_features, request.url_rule.rule)
+    cached = lookup_cached_recommendation(fingerprint)
+    if cached is not None:
+        save_llm_response(session_id, prompt, cached)
+        if wants_stream(data):
+            return sse_response(with_prelude(extra, cached_recommendation_stream(cached)))
+        response = jsonify(dict(extra, recommendation=cached))
+        response.headers["X-Recommendation-Cache"] = "hit"
+        return response
+
+    print("LLM Prompt:\n", prompt)
+
+    messages = [
+        {"role": "system", "content": RECOMMENDATION_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+    if wants_stream(data):
+        return sse_response(with_prelude(extra, stream_chat_completion(
+            session_id,
+            lambda recommendation: finish_recommendation(session_id, prompt, fingerprint, recommendation),
+            messages=messages,
             max_tokens=1000,
             temperature=1
-        )
-        recommendation = response.choices[0].message.content.strip()
+        )))
+
+    recommendation = chat_completion(
+        request.url_rule.rule,
+        session_id,
+        messages=messages,
+        max_tokens=1000,
+        temperature=1
+    )
+
+    # Save LLM response
+    finish_recommendation(session_id, prompt, fingerprint, recommendation)
+
+    return jsonify(dict(extra, recommendation=recommendation))
 
-        # Save LLM response
-        try:
-            with engine.begin() as connection:
-                insert_query = text('''
-                    INSERT INTO LLMResponses (session_id, prompt, response_text)
-                    VALUES (:session_id, :prompt, :response_text)
-                ''')
-                connection.execute(insert_query, {
-                    'session_id': session_id,
-                    'prompt': prompt,
-                    'response_text': recommendation
-                })
-        except Exception as e:
-            print("Error saving LLM response:", str(e))
 
-        return jsonify({"recommendation": recommendation})
+@app.route('/recommendation', methods=['POST'])
+@idempotent
+@coalesced
+def get_recommendation():
+    """
+    Generates a final recommendation using Azure OpenAI
+    based on questionnaire responses + optional top5 features.
+    Pass ?stream=1 (or "stream": true) to receive the answer as Server-Sent Events.
+    """
+    try:
+        data = request.json
+        return recommendation_response(
+            data,
+            data.get("session_id"),
+            data.get("responses", []),
+            data.get("top5_features", [])
+        )
+    except GatewayBusy as e:
+        print("Azure OpenAI busy:", str(e))
+        return llm_busy_response(e)
     except Exception as e:
         print("Error generating recommendation:", str(e))
         return jsonify({"error": "An error occurred while generating the recommendation."}), 500
 
+
+# ----------------------------- ASSESS ENDPOINT -----------------------------
+def start_assessment(data):
+    """
+    Persists a completed questionnaire in one transaction: responses, the session
+    (owned by 'email' when given) and the top 5 features as rankings. Also logs the
+    session_created event that /recordSession would. Returns (session_id, session_name).
+    """
+    session_id = str(uuid.uuid4())  # unique session
+    email = data.get("email") or None
+    rows, session_name = prepare_submission(session_id, data.get("responses", []))
+    ranking_rows = feature_ranking_rows(session_id, [
+        {"rank_position": idx, "feature_name": feat}
+        for idx, feat in enumerate(data.get("top5_features", []), 1)
+    ])
+
+    save_assessment(session_id, rows, session_name, email=email, ranking_rows=ranking_rows)
+
+    if email:
+        record_event("session_created", {
+            "email": email,
+            "session_id": session_id,
+            "session_name": session_name,
+            "event_timestamp": event_timestamp()
+        })
+    return session_id, session_name
+
+
+@app.route('/assess', methods=['POST'])
+@idempotent
+@coalesced
+def assess():
+    """
+    One-shot version of /submit + /recordSession + /featureRanking + /recommendation.
+    Expects {"email", "responses", "top5_features"} and returns session_id,
+    session_name and the recommendation. With ?stream=1 (or "stream": true) the
+    answer is streamed, preceded by a 'session' event with session_id and session_name.
+    """
+    data = request.json
+    if not isinstance(data, dict) or not isinstance(data.get("responses"), list) or not data["responses"]:
+        return jsonify({"error": "responses are required"}), 400
+
+    try:
+        session_id, session_name = start_assessment(data)
+    except Exception as e:
+        print("Error occurred while saving assessment:", str(e))
+        return jsonify({"error": "An error occurred while saving responses."}), 500
+
+    try:
+        return recommendation_response(
+            data,
+            session_id,
+            data["responses"],
+            data.get("top5_features", []),
+            extra={"session_id": session_id, "session_name": session_name}
+        )
+    except GatewayBusy as e:
+        print("Azure OpenAI busy:", str(e))
+        return llm_busy_response(e, extra={"session_id": session_id, "session_name": session_name})
+    except Exception as e:
+        print("Error generating recommendation:", str(e))
+        # The answers are saved; the client can retry /recommendation for this session
+        return jsonify({
+            "error": "An error occurred while generating the recommendation.",
+            "session_id": session_id,
+            "session_name": session_name
+        }), 500
+
 # ----------------------------- FEEDBACK ENDPOINT -----------------------------
 @app.route('/feedback', methods=['POST'])
 def submit_feedback():
@@ -423,16 +2339,11 @@ def submit_feedback():
         if not session_id or not feedback:
             return jsonify({"error": "Session ID and feedback are required"}), 400
 
-        with engine.begin() as connection:
-            insert_query = text('''
-                INSERT INTO Feedback (session_id, feedback, comments)
-                VALUES (:session_id, :feedback, :comments)
-            ''')
-            connection.execute(insert_query, {
-                'session_id': session_id,
-                'feedback': feedback,
-                'comments': comments
-            })
+        record_event("feedback", {
+            'session_id': session_id,
+            'feedback': feedback,
+            'comments': comments
+        })
 
         return jsonify({"message": "Feedback recorded successfully!"})
     except Exception as e:
@@ -449,12 +2360,7 @@ def record_login():
         return jsonify({"error": "Email is required"}), 400
 
     try:
-        with engine.begin() as connection:
-            query = text("""
-                INSERT INTO Connections (email, event_type)
-                VALUES (:email, 'login')
-            """)
-            connection.execute(query, {"email": email})
+        record_event("login", {"email": email, "event_timestamp": event_timestamp()})
         return jsonify({"message": "Login recorded"}), 200
     except Exception as e:
         print("Error recording login:", str(e))
@@ -469,12 +2375,7 @@ def record_logout():
         return jsonify({"error": "Email is required"}), 400
 
     try:
-        with engine.begin() as connection:
-            query = text("""
-                INSERT INTO Connections (email, event_type)
-                VALUES (:email, 'logout')
-            """)
-            connection.execute(query, {"email": email})
+        record_event("logout", {"email": email, "event_timestamp": event_timestamp()})
         return jsonify({"message": "Logout recorded"}), 200
     except Exception as e:
         print("Error recording logout:", str(e))
@@ -484,7 +2385,9 @@ def record_logout():
 @app.route('/recordSession', methods=['POST'])
 def record_session():
     """
-    Tracks session creation in the Connections table with event_type='session_created'.
+    Tracks session creation in the Connections table with event_type='session_created'
+    and assigns the session to the user in Sessions.
+    Written behind the response, like the other telemetry events.
     """
     data = request.json
     email = data.get("email")
@@ -495,16 +2398,14 @@ def record_session():
         return jsonify({"error": "Email and session_id are required"}), 400
 
     try:
-        with engine.begin() as connection:
-            query = text("""
-                INSERT INTO Connections (email, event_type, session_id, session_name)
-                VALUES (:email, 'session_created', :session_id, :session_name)
-            """)
-            connection.execute(query, {
-                "email": email,
-                "session_id": session_id,
-                "session_name": session_name
-            })
+        params = {
+            "email": email,
+            "session_id": session_id,
+            "session_name": session_name,
+            "event_timestamp": event_timestamp()
+        }
+        record_event("session_created", params)
+        record_event("session_upsert", params)
         return jsonify({"message": "Session recorded"}), 200
     except Exception as e:
         print("Error recording session:", str(e))
@@ -522,20 +2423,14 @@ def feature_ranking():
         return jsonify({"error": "session_id and feature_rankings are required"}), 400
 
     try:
-        with engine.begin() as connection:
-            insert_query = text('''
-                INSERT INTO FeatureRankings (session_id, rank_position, feature_name)
-                VALUES (:session_id, :rank_position, :feature_name)
-            ''')
-            for fr in feature_rankings:
-                rank_position = fr.get("rank_position")
-                feature_name = fr.get("feature_name")
-                if rank_position is not None and feature_name:
-                    connection.execute(insert_query, {
-                        'session_id': session_id,
-                        'rank_position': rank_position,
-                        'feature_name': feature_name
-                    })
+        rows = feature_ranking_rows(session_id, feature_rankings)
+        if rows:
+            with engine.begin() as connection:
+                insert_query = text('''
+                    INSERT INTO FeatureRankings (session_id, rank_position, feature_name)
+                    VALUES (:session_id, :rank_position, :feature_name)
+                ''')
+                connection.execute(insert_query, rows)
 
         return jsonify({"message": "Feature rankings saved successfully!"}), 200
     except Exception as e:
@@ -544,28 +2439,64 @@ def feature_ranking():
 
 
 # ----------------------------- MY SESSIONS -----------------------------
+def encode_sessions_cursor(created_at, session_id):
+    raw = json.dumps([created_at.isoformat() if created_at else None, session_id])
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_sessions_cursor(cursor):
+    created_at, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return datetime.fromisoformat(created_at), session_id
+
+
 @app.route('/mySessions', methods=['GET'])
 def my_sessions():
     """
-    Returns a list of session IDs + session_name for the user’s email.
+    Returns a list of session IDs + session_name for the user’s email,
+    newest first, from the Sessions table.
+    Optional keyset pagination: ?limit=N returns one page and, when there are more,
+    an X-Next-After header to pass back as ?after= for the next page.
     """
     email = request.args.get("email")
     if not email:
         return jsonify({"error": "Missing email parameter"}), 400
 
+    try:
+        limit = request.args.get("limit", type=int)
+        after = request.args.get("after")
+        params = {"email": email}
+
+        keyset_filter = ""
+        if after:
+            params["after_created_at"], params["after_session_id"] = decode_sessions_cursor(after)
+            keyset_filter = """
+                  AND (created_at < :after_created_at
+                       OR (created_at = :after_created_at AND session_id < :after_session_id))
+            """
+        top = ""
+        if limit:
+            # One extra row tells whether there is a next page
+            params["limit"] = min(max(limit, 1), 500) + 1
+            top = "TOP (:limit)"
+    except Exception:
+        return jsonify({"error": "Invalid limit or after parameter"}), 400
+
     try:
         with engine.connect() as conn:
-            query = text("""
-                SELECT session_id, session_name, MIN(event_timestamp) as session_created
-                FROM Connections
+            query = text(f"""
+                SELECT {top} session_id, session_name, created_at
+                FROM Sessions
                 WHERE email = :email
-                  AND session_id IS NOT NULL
-                  AND event_type = 'session_created'
-                  AND (is_deleted = 0)
-                GROUP BY session_id, session_name
-                ORDER BY MIN(event_timestamp) DESC
+                  AND is_deleted = 0
+                  {keyset_filter}
+                ORDER BY created_at DESC, session_id DESC
             """)
-            rows = conn.execute(query, {"email": email}).fetchall()
+            rows = conn.execute(query, params).fetchall()
+
+        next_after = None
+        if limit and len(rows) == params["limit"]:
+            rows = rows[:-1]
+            next_after = encode_sessions_cursor(rows[-1].created_at, rows[-1].session_id)
 
         sessions = []
         for row in rows:
@@ -573,10 +2504,13 @@ def my_sessions():
             sessions.append({
                 "session_id": row.session_id,
                 "session_name": the_name,
-                "created_at": str(row.session_created) if row.session_created else None
+                "created_at": str(row.created_at) if row.created_at else None
             })
 
-        return jsonify(sessions), 200
+        response = jsonify(sessions)
+        if next_after:
+            response.headers["X-Next-After"] = next_after
+        return response, 200
     except Exception as e:
         print("Error in /mySessions:", e)
         return jsonify({"error": "Could not retrieve sessions"}), 500
@@ -586,7 +2520,7 @@ def my_sessions():
 @app.route('/deleteSession/<session_id>', methods=['POST'])
 def delete_session(session_id):
     """
-    Soft-delete a session by setting is_deleted=1 in Connections.
+    Soft-delete a session by setting is_deleted=1 in Connections and Sessions.
     """
     data = request.json or {}
     email = data.get("email")  # optional if you want to verify ownership
@@ -602,6 +2536,12 @@ def delete_session(session_id):
                   AND event_type = 'session_created'
             """)
             conn.execute(up_query, {'sid': session_id})
+            conn.execute(text("""
+                UPDATE Sessions
+                SET is_deleted = 1
+                WHERE session_id = :sid
+            """), {'sid': session_id})
+        invalidate_conversation(session_id)
 
         return jsonify({"message": "Session soft-deleted."}), 200
     except Exception as e:
@@ -610,6 +2550,27 @@ def delete_session(session_id):
 
 
 # ----------------------------- LOAD SESSION DATA -----------------------------
+def format_qa(qa_rows):
+    """
+    Q&A rows as shown to users: question text (or a placeholder) and answer.
+    """
+    qa = []
+    for row in qa_rows:
+        if row["question_id"] == -1:
+            # Free-form question
+            qa.append({
+                "question": "Free-form question",
+                "answer": row["response_text"]
+            })
+        else:
+            q_text = row["question"] if row["question"] else "Question"
+            qa.append({
+                "question": q_text,
+                "answer": row["response_text"]
+            })
+    return qa
+
+
 @app.route('/sessionData/<session_id>', methods=['GET'])
 def get_session_data(session_id):
     """
@@ -617,83 +2578,271 @@ def get_session_data(session_id):
     AND feature rankings for a given session_id.
     """
     try:
-        with engine.connect() as conn:
-            # 1) Pull Q&As (from responses + new_questions3)
-            qa_rows = conn.execute(text("""
-                SELECT q.question, r.response_text, r.question_id
-                FROM responses r
-                LEFT JOIN new_questions3 q ON r.question_id = q.id
-                WHERE r.session_id = :session_id
-                ORDER BY r.id ASC
-            """), {"session_id": session_id}).fetchall()
-
-            # 2) Final recommendation from LLMResponses
-            llm_row = conn.execute(text("""
-                SELECT response_text
-                FROM LLMResponses
-                WHERE session_id = :session_id
-                ORDER BY id DESC
-            """), {"session_id": session_id}).fetchone()
-            recommendation = llm_row.response_text if llm_row else None
-
-            # 3) Follow-ups from FollowUps table
-            fup_rows = conn.execute(text("""
-                SELECT user_message, assistant_message
-                FROM FollowUps
-                WHERE session_id = :session_id
-                ORDER BY id ASC
-            """), {"session_id": session_id}).fetchall()
-
-            # 4) Feature Rankings
-            fr_rows = conn.execute(text("""
-                SELECT rank_position, feature_name
-                FROM FeatureRankings
-                WHERE session_id = :session_id
-                ORDER BY rank_position
-            """), {"session_id": session_id}).fetchall()
+        session = load_session(session_id)
 
         # Build JSON response
         session_data = {
-            "qa": [],
-            "recommendation": recommendation,
-            "followups": [],
-            "feature_rankings": []
+            "qa": format_qa(session["qa"]),
+            "recommendation": session["recommendation"],
+            "followups": session["followups"],
+            "feature_rankings": session["feature_rankings"]
         }
 
-        # Populate Q&A
-        for row in qa_rows:
-            if row.question_id == -1:
-                # Free-form question
-                session_data["qa"].append({
-                    "question": "Free-form question",
-                    "answer": row.response_text
-                })
-            else:
-                q_text = row.question if row.question else "Question"
-                session_data["qa"].append({
-                    "question": q_text,
-                    "answer": row.response_text
-                })
-
-        # Populate follow-ups
-        for f in fup_rows:
-            session_data["followups"].append({
-                "user_message": f.user_message,
-                "assistant_message": f.assistant_message
-            })
-
-        # Populate feature rankings
-        for fr in fr_rows:
-            session_data["feature_rankings"].append({
-                "rank_position": fr.rank_position,
-                "feature_name": fr.feature_name
-            })
-
         return jsonify(session_data), 200
     except Exception as e:
         print("Error in /sessionData:", e)
         return jsonify({"error": "Could not retrieve session data"}), 500
 
+# ----------------------------- SESSION EXPORT -----------------------------
+# Bulk export of sessions for analytics, one NDJSON line per session, oldest first.
+# Sessions are read in keyset pages of EXPORT_FETCH_SIZE on IX_Sessions_created_at
+# (sql/009_sessions_created_at.sql): one query per page fetches the page's sessions
+# with their Q&A, recommendation, follow-ups, rankings and feedback, and only that
+# page is sorted and held in memory, so memory and time to first line stay bounded
+# whatever the range. (pyodbc buffers a whole result set, so one query streaming
+# the entire range would not.)
+# Each line carries a 'cursor'; pass the last one back as 'after' to resume.
+# The HTTP endpoint is disabled unless EXPORT_API_KEY is set.
+EXPORT_API_KEY = os.getenv("EXPORT_API_KEY")
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", 500))
+
+EXPORT_QUERY = """
+    WITH s AS (
+        SELECT TOP (:page_size) session_id, email, session_name, created_at, is_deleted
+        FROM Sessions
+        WHERE created_at >= :start AND created_at < :end
+          {deleted_filter}
+          {keyset_filter}
+        ORDER BY created_at, session_id
+    )
+    SELECT s.created_at, s.session_id, s.email, s.session_name, s.is_deleted,
+           'session' AS kind, 0 AS ord, NULL AS num, NULL AS text1, NULL AS text2
+    FROM s
+    UNION ALL
+    SELECT s.created_at, s.session_id, s.email, s.session_name, s.is_deleted,
+           'qa', r.id, r.question_id, q.question, r.response_text
+    FROM s
+    JOIN responses r ON r.session_id = s.session_id
+    LEFT JOIN new_questions3 q ON r.question_id = q.id
+    UNION ALL
+    SELECT s.created_at, s.session_id, s.email, s.session_name, s.is_deleted,
+           'llm', l.id, NULL, NULL, l.response_text
+    FROM s
+    JOIN LLMResponses l ON l.session_id = s.session_id
+    UNION ALL
+    SELECT s.created_at, s.session_id, s.email, s.session_name, s.is_deleted,
+           'followup', f.id, NULL, f.user_message, f.assistant_message
+    FROM s
+    JOIN FollowUps f ON f.session_id = s.session_id
+    UNION ALL
+    SELECT s.created_at, s.session_id, s.email, s.session_name, s.is_deleted,
+           'ranking', fr.id, fr.rank_position, fr.feature_name, NULL
+    FROM s
+    JOIN FeatureRankings fr ON fr.session_id = s.session_id
+    UNION ALL
+    SELECT s.created_at, s.session_id, s.email, s.session_name, s.is_deleted,
+           'feedback', fb.id, NULL, fb.feedback, fb.comments
+    FROM s
+    JOIN Feedback fb ON fb.session_id = s.session_id
+    ORDER BY created_at, session_id, kind, ord
+"""
+
+
+def _new_export_record(row):
+    return {
+        "session_id": row.session_id,
+        "session_name": row.session_name,
+        "email": row.email,
+        "created_at": str(row.created_at) if row.created_at else None,
+        "is_deleted": bool(row.is_deleted),
+        "qa": [],
+        "recommendation": None,
+        "followups": [],
+        "feature_rankings": [],
+        "feedback": [],
+        "cursor": encode_sessions_cursor(row.created_at, row.session_id)
+    }
+
+
+def _finish_export_record(record):
+    record["qa"] = format_qa(record["qa"])
+    record["feature_rankings"].sort(key=lambda fr: fr["rank_position"])
+    return record
+
+
+def _fold_export_rows(rows):
+    """
+    Folds the rows of one export page, ordered by session, into one record per session.
+    """
+    record = None
+    for row in rows:
+        if record is None or row.session_id != record["session_id"]:
+            if record is not None:
+                yield _finish_export_record(record)
+            record = _new_export_record(row)
+
+        if row.kind == "qa":
+            record["qa"].append({
+                "question_id": row.num,
+                "question": row.text1,
+                "response_text": row.text2
+            })
+        elif row.kind == "llm":
+            # Rows are ordered by id, so the last one is the latest recommendation
+            record["recommendation"] = row.text2
+        elif row.kind == "followup":
+            record["followups"].append({
+                "user_message": row.text1,
+                "assistant_message": row.text2
+            })
+        elif row.kind == "ranking":
+            record["feature_rankings"].append({
+                "rank_position": row.num,
+                "feature_name": row.text1
+            })
+        elif row.kind == "feedback":
+            record["feedback"].append({
+                "feedback": row.text1,
+                "comments": row.text2
+            })
+    if record is not None:
+        yield _finish_export_record(record)
+
+
+def iter_session_exports(start, end, after=None, include_deleted=False):
+    """
+    Yields one export record per session created in [start, end), oldest first,
+    continuing after the given cursor. Reads EXPORT_FETCH_SIZE sessions per query.
+    """
+    deleted_filter = "" if include_deleted else "AND is_deleted = 0"
+    first_page = text(EXPORT_QUERY.format(deleted_filter=deleted_filter, keyset_filter=""))
+    next_page = text(EXPORT_QUERY.format(deleted_filter=deleted_filter, keyset_filter="""
+          AND (created_at > :after_created_at
+               OR (created_at = :after_created_at AND session_id > :after_session_id))
+    """))
+
+    params = {"start": start, "end": end, "page_size": EXPORT_FETCH_SIZE}
+    if after:
+        params["after_created_at"], params["after_session_id"] = decode_sessions_cursor(after)
+    while True:
+        # The connection goes back to the pool between pages, while the caller writes
+        with engine.connect() as connection:
+            rows = connection.execute(next_page if "after_session_id" in params else first_page, params).fetchall()
+
+        sessions = 0
+        for record in _fold_export_rows(rows):
+            sessions += 1
+            yield record
+        if sessions < EXPORT_FETCH_SIZE:
+            return
+        params["after_created_at"], params["after_session_id"] = rows[-1].created_at, rows[-1].session_id
+
+
+def _naive_utc(value):
+    """
+    Sessions.created_at is a naive UTC DATETIME2: values with an offset are
+    converted to UTC and compared without it.
+    """
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return value.replace(tzinfo=None)
+
+
+def parse_export_range(start, end):
+    """
+    Parses ISO dates/datetimes for an export range; defaults to everything up to now.
+    """
+    return (
+        _naive_utc(datetime.fromisoformat(start)) if start else datetime(1900, 1, 1),
+        _naive_utc(datetime.fromisoformat(end) if end else datetime.now(timezone.utc))
+    )
+
+
+@app.route('/exportSessions', methods=['GET'])
+def export_sessions():
+    """
+    Streams sessions created in [?from=, ?to=) as NDJSON, oldest first.
+    Requires the X-Export-Key header to match EXPORT_API_KEY. Resume an interrupted
+    export with ?after=<cursor of the last line received>; ?include_deleted=1
+    also exports deleted sessions.
+    """
+    if not EXPORT_API_KEY:
+        return jsonify({"error": "Export is not enabled"}), 404
+    if not hmac.compare_digest(request.headers.get("X-Export-Key", ""), EXPORT_API_KEY):
+        return jsonify({"error": "Invalid export key"}), 403
+
+    try:
+        start, end = parse_export_range(request.args.get("from"), request.args.get("to"))
+        after = request.args.get("after")
+        if after:
+            decode_sessions_cursor(after)
+    except Exception:
+        return jsonify({"error": "Invalid from, to or after parameter"}), 400
+    include_deleted = request.args.get("include_deleted", "0").lower() in ("1", "true")
+
+    def generate():
+        try:
+            for record in iter_session_exports(start, end, after, include_deleted):
+                yield app.json.dumps(record) + "\n"
+        except Exception as e:
+            # Headers are already sent; the client resumes from the last cursor it received
+            print("Error in /exportSessions:", e)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="application/x-ndjson",
+        headers={"X-Accel-Buffering": "no"}
+    )
+
+
+@app.cli.command("export-sessions")
+@click.option("--from", "start", help="ISO date or datetime (inclusive).")
+@click.option("--to", "end", help="ISO date or datetime (exclusive), default now.")
+@click.option("--output", type=click.Path(dir_okay=False), required=True, help="NDJSON file to write (appended to when resuming).")
+@click.option("--checkpoint", type=click.Path(dir_okay=False), help="File recording export progress; the export resumes from it.")
+@click.option("--include-deleted", is_flag=True)
+def export_sessions_command(start, end, output, checkpoint, include_deleted):
+    """
+    Exports sessions as NDJSON to a file, resumably: the checkpoint holds the last
+    exported cursor and the output size at that point, and a resumed export first
+    truncates the output back to it.
+    """
+    start, end = parse_export_range(start, end)
+    progress = {"cursor": None, "offset": 0}
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint, encoding="utf-8") as f:
+            progress = json.load(f)
+        if progress["cursor"] and not os.path.exists(output):
+            click.echo(f"{output} does not exist; ignoring the checkpoint and starting over.")
+            progress = {"cursor": None, "offset": 0}
+        elif progress["cursor"] and os.path.getsize(output) < progress["offset"]:
+            raise click.ClickException(
+                f"{output} is shorter than the checkpoint says ({progress['offset']} bytes); "
+                f"it was truncated or replaced since. Remove {checkpoint} to start over."
+            )
+
+    def save_checkpoint(cursor, offset):
+        tmp_path = checkpoint + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"cursor": cursor, "offset": offset}, f)
+        os.replace(tmp_path, checkpoint)
+
+    exported = 0
+    with open(output, "r+b" if progress["cursor"] else "wb") as out:
+        out.truncate(progress["offset"])
+        out.seek(progress["offset"])
+        for record in iter_session_exports(start, end, progress["cursor"], include_deleted):
+            out.write((app.json.dumps(record) + "\n").encode("utf-8"))
+            exported += 1
+            if checkpoint and exported % 100 == 0:
+                out.flush()
+                save_checkpoint(record["cursor"], out.tell())
+        out.flush()
+        if checkpoint and exported:
+            save_checkpoint(record["cursor"], out.tell())
+    click.echo(f"Exported {exported} sessions.")
+
+
 # ----------------------------- GET HELP -----------------------------
 @app.route('/getHelp', methods=['POST'])
 def get_help():
@@ -707,14 +2856,7 @@ def get_help():
         return jsonify({"error": "session_id is required"}), 400
 
     try:
-        with engine.begin() as connection:
-            # Insert a row. 
-            # The table might have columns: (id PK, session_id, timestamp default GETDATE(), etc.)
-            insert_query = text("""
-                INSERT INTO Get_Help (session_id, timestamp)
-                VALUES (:session_id, GETDATE())
-            """)
-            connection.execute(insert_query, {"session_id": session_id})
+        record_event("help", {"session_id": session_id, "timestamp": event_timestamp()})
 
         return jsonify({"message": "Help request recorded successfully!"}), 200
 
@@ -722,6 +2864,150 @@ def get_help():
         print("Error in /getHelp:", e)
         return jsonify({"error": "Could not record help request"}), 500
 
+# ----------------------------- POOL METRICS -----------------------------
+@app.route('/poolMetrics', methods=['GET'])
+def pool_metrics():
+    """
+    Connection pool usage, to size workers against DB_POOL_SIZE / DB_MAX_OVERFLOW.
+    """
+    return jsonify(get_pool_metrics()), 200
+
+# ----------------------------- REQUEST METRICS -----------------------------
+# Every route records its total latency and per-phase breakdown (db, llm, prompt,
+# serialize; 'prompt' includes the DB reads it needs). Exposed at /metrics.
+@app.before_request
+def _start_request_metrics():
+    g.request_start = time.perf_counter()
+    metrics.start_request()
+
+
+@app.after_request
+def _finish_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.finish_request(endpoint, request.method, response.status_code, time.perf_counter() - g.request_start)
+    return response
+
+
+def _recommendation_cache_hits():
+    return recommendation_cache_stats["hits"]
+
+
+def _recommendation_cache_misses():
+    return recommendation_cache_stats["misses"]
+
+
+metrics.Gauge("db_pool_checked_out", "Connections currently checked out.", lambda: get_pool_metrics()["checked_out"])
+metrics.Gauge("db_pool_idle", "Idle connections in the pool.", lambda: get_pool_metrics()["idle"])
+metrics.Gauge("db_pool_overflow", "Overflow connections in use.", lambda: get_pool_metrics()["overflow"])
+metrics.Gauge("db_pool_wait_seconds_total", "Total time spent waiting for a connection.", lambda: get_pool_metrics()["wait_seconds_total"])
+metrics.Gauge("db_pool_wait_timeouts_total", "Connection checkouts that timed out.", lambda: get_pool_metrics()["wait_timeouts"])
+metrics.Gauge("recommendation_cache_hits_total", "Recommendation cache hits.", _recommendation_cache_hits)
+metrics.Gauge("recommendation_cache_misses_total", "Recommendation cache misses.", _recommendation_cache_misses)
+if telemetry_writer is not None:
+    metrics.Gauge("telemetry_queue_depth", "Telemetry events waiting to be written.", lambda: telemetry_writer.stats()["depth"])
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """
+    Prometheus text exposition of this worker's metrics.
+    """
+    return Response(metrics.render_all(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/ready', methods=['GET'])
+def readiness():
+    """
+    Readiness probe: 200 once this worker is warm (app imported, connection pool
+    filled, LLM clients built), 503 until then. The body is the startup report
+    (phases, slowest imports, checks).
+    """
+    ready = startup.is_ready()
+    response = jsonify(dict(startup.report(), ready=ready))
+    if not ready:
+        response.status_code = 503
+        response.headers["Retry-After"] = "1"
+    return response
+
+# ----------------------------- RESPONSE COMPRESSION -----------------------------
+# Buffered JSON/text responses of at least COMPRESSION_MIN_SIZE bytes are compressed
+# with the best encoding the client accepts (zstd, then gzip). Streamed responses
+# (SSE) are left alone. Registered after the metrics hook so that it runs first and
+# its time is recorded as the 'compress' phase.
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", 3))
+COMPRESSIBLE_MIMETYPES = {"application/json", "text/plain", "text/html", "text/csv"}
+
+response_bytes = metrics.Counter(
+    "http_response_bytes_total",
+    "Response body bytes before and after compression, by encoding.",
+    ["endpoint", "encoding", "stage"]
+)
+
+# Compressed bodies of responses with an ETag (e.g. /questions), keyed by (etag, encoding)
+_compressed_bodies = OrderedDict()
+_compressed_bodies_lock = threading.Lock()
+_COMPRESSED_BODIES_MAX = 32
+
+
+def compress_body(body, encoding):
+    if encoding == "zstd":
+        return zstandard.compress(body, COMPRESSION_ZSTD_LEVEL)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def cached_compress_body(body, encoding, etag):
+    """
+    Compresses a body, reusing the previous result for the same ETag and encoding.
+    """
+    if not etag:
+        return compress_body(body, encoding)
+    key = (etag, encoding)
+    with _compressed_bodies_lock:
+        compressed = _compressed_bodies.get(key)
+        if compressed is not None:
+            _compressed_bodies.move_to_end(key)
+            return compressed
+    compressed = compress_body(body, encoding)
+    with _compressed_bodies_lock:
+        _compressed_bodies[key] = compressed
+        while len(_compressed_bodies) > _COMPRESSED_BODIES_MAX:
+            _compressed_bodies.popitem(last=False)
+    return compressed
+
+
+@app.after_request
+def _compress_response(response):
+    if (not RESPONSE_COMPRESSION
+            or response.status_code < 200 or response.status_code >= 300
+            or response.is_streamed or response.direct_passthrough
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or "Content-Encoding" in response.headers):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = request.accept_encodings.best_match(["zstd", "gzip"])
+    body = response.get_data()
+    if not encoding or len(body) < COMPRESSION_MIN_SIZE:
+        return response
+
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    with metrics.timed_phase("compress"):
+        etag, weak = response.get_etag()
+        compressed = cached_compress_body(body, encoding, etag)
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    if etag and not weak:
+        # The bytes now depend on the encoding, so the validator becomes weak
+        response.set_etag(etag, weak=True)
+    response_bytes.inc(len(body), endpoint=endpoint, encoding=encoding, stage="uncompressed")
+    response_bytes.inc(len(compressed), endpoint=endpoint, encoding=encoding, stage="compressed")
+    return response
+
+startup.imported()
+
 # ----------------------------- MAIN ----------------------------- 
 if __name__ == '__main__':
     # Adjust the port or host as needed
@@ -0,0 +1,564 @@
+import startup  # first, so that the import times below are measured
+from fastapi import FastAPI, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.wsgi import WSGIMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import hashlib
+import time
+
+import app as flask_backend
+import metrics
+from llm_gateway import GatewayBusy
+
+# ASGI entry point: `gunicorn -k uvicorn.workers.UvicornWorker asgi:app`
+# (or `uvicorn asgi:app`). The LLM-bound routes are served natively here with
+# the async Azure OpenAI client, so a worker can keep hundreds of generations
+# in flight. Database work reuses the helpers from app.py on a thread pool.
+# Every other route is the unchanged Flask app, mounted below.
+
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=flask_backend.ALLOWED_ORIGINS,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=flask_backend.EXPOSE_HEADERS
+)
+
+# Paths served natively below; the mounted Flask app records its own request metrics
+NATIVE_PATHS = {"/recommendation", "/followup", "/assess"}
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    if request.url.path not in NATIVE_PATHS:
+        return await call_next(request)
+
+    start = time.perf_counter()
+    metrics.start_request()
+    response = await call_next(request)
+    metrics.finish_request(request.url.path, request.method, response.status_code, time.perf_counter() - start)
+    return response
+
+
+llm_gateway = flask_backend.llm_gateway
+
+
+def llm_busy_response(error, extra=None):
+    """
+    Twin of app.llm_busy_response.
+    """
+    return JSONResponse(
+        dict(extra or {}, error=flask_backend.LLM_BUSY_MESSAGE),
+        status_code=503,
+        headers={"Retry-After": str(error.retry_after)}
+    )
+
+
+def wants_stream(request, data):
+    """
+    Same opt-in rules as the Flask routes: ?stream=1, "stream": true, or Accept: text/event-stream.
+    """
+    if request.query_params.get("stream", "").lower() in ("1", "true", "yes"):
+        return True
+    if isinstance(data, dict) and data.get("stream") is True:
+        return True
+    return "text/event-stream" in request.headers.get("accept", "")
+
+
+def sse_response(generator):
+    return StreamingResponse(
+        generator,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+async def with_prelude(prelude, events):
+    """
+    Prepends a 'session' SSE event to a (sync or async) stream of events.
+    """
+    if prelude:
+        yield flask_backend.sse_event(prelude, event="session")
+    if hasattr(events, "__aiter__"):
+        async for event in events:
+            yield event
+    else:
+        for event in events:
+            yield event
+
+
+async def chat_completion(endpoint, session_id, **kwargs):
+    """
+    Async twin of app.chat_completion: returns the answer text and records the call.
+    """
+    async with llm_gateway.aslot(endpoint) as call:
+        start = time.perf_counter()
+        try:
+            with metrics.timed_phase("llm"):
+                raw = await llm_gateway.acreate(call, **kwargs)
+                response = raw.parse()
+        except Exception as e:
+            await run_in_threadpool(flask_backend.record_llm_call, endpoint, session_id, call.deployment_name, None,
+                                    time.perf_counter() - start, retries=call.retries,
+                                    status="throttled" if isinstance(e, GatewayBusy) else "error")
+            raise
+
+    # May write inline (queue full, write-behind off), so off the event loop
+    await run_in_threadpool(
+        flask_backend.record_llm_call,
+        endpoint, session_id, call.deployment_name, response.usage, time.perf_counter() - start,
+        retries=call.retries
+    )
+    return response.choices[0].message.content.strip()
+
+
+async def stream_chat_completion(endpoint, session_id, on_complete, **kwargs):
+    """
+    Async twin of app.stream_chat_completion: yields 'token' events as deltas arrive,
+    then persists the full text via on_complete (on a thread) and sends 'done'.
+    """
+    parts = []
+    call = None
+    start = None
+    ttft = None
+    usage = None
+    try:
+        async with llm_gateway.aslot(endpoint) as call:
+            start = time.perf_counter()
+            raw = await llm_gateway.acreate(call, stream=True, stream_options={"include_usage": True}, **kwargs)
+            async for chunk in raw.parse():
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                    parts.append(delta)
+                    yield flask_backend.sse_event({"delta": delta}, event="token")
+    except Exception as e:
+        print("Error streaming from Azure OpenAI:", str(e))
+        if start is not None:
+            await run_in_threadpool(flask_backend.record_llm_call, endpoint, session_id, call.deployment_name, usage,
+                                    time.perf_counter() - start, ttft=ttft, retries=call.retries, streamed=True,
+                                    status="throttled" if isinstance(e, GatewayBusy) else "error")
+        yield flask_backend.llm_error_event(e)
+        return
+
+    latency = time.perf_counter() - start
+    metrics.observe_phase(endpoint, "llm_stream", latency)
+    await run_in_threadpool(flask_backend.record_llm_call, endpoint, session_id, call.deployment_name, usage, latency,
+                            ttft=ttft, retries=call.retries, streamed=True)
+
+    full_text = "".join(parts).strip()
+    extra = await run_in_threadpool(on_complete, full_text) or {}
+    yield flask_backend.sse_event(dict({"text": full_text}, **extra), event="done")
+
+
+# ----------------------------- IDEMPOTENCY -----------------------------
+# Same Idempotency-Key semantics as app.idempotent, with the key store calls on the
+# thread pool and a non-blocking wait for an in-flight request.
+async def wait_for_idempotency_key(scope, request_hash):
+    deadline = time.monotonic() + flask_backend.IDEMPOTENCY_WAIT
+    delay = 0.1
+    while True:
+        state, row = await run_in_threadpool(flask_backend.claim_idempotency_key, scope, request_hash)
+        remaining = deadline - time.monotonic()
+        if state != "in_progress" or remaining <= 0:
+            return state, row
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, 2.0)
+
+
+class StreamRecorder:
+    """
+    Records a streamed body for replay. finish() runs as the response's background
+    task, which Starlette also runs when the client disconnects mid-stream.
+    """
+
+    def __init__(self, scope, content_type):
+        self.scope = scope
+        self.content_type = content_type
+        self.parts = []
+        self.completed = False
+
+    async def wrap(self, body_iterator):
+        async for chunk in body_iterator:
+            self.parts.append(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+            yield chunk
+        self.completed = True
+
+    async def finish(self):
+        body = b"".join(self.parts)
+        if self.completed and not flask_backend.is_failed_stream(body):
+            await run_in_threadpool(flask_backend.complete_idempotency_key, self.scope, 200, self.content_type, body)
+        else:
+            await run_in_threadpool(flask_backend.release_idempotency_key, self.scope)
+
+
+async def idempotent(request, handler):
+    key = request.headers.get("idempotency-key")
+    if not key or not flask_backend.IDEMPOTENCY_ENABLED:
+        return await handler(request)
+    if len(key) > flask_backend.MAX_IDEMPOTENCY_KEY_LENGTH:
+        return JSONResponse({"error": "Idempotency-Key is too long."}, status_code=400)
+
+    scope = flask_backend.idempotency_scope(request.url.path, key)
+    request_hash = flask_backend.idempotency_request_hash(await request.body(), request.url.query.encode("utf-8"))
+    try:
+        state, row = await wait_for_idempotency_key(scope, request_hash)
+    except Exception as e:
+        print("Error claiming idempotency key:", str(e))
+        return await handler(request)
+
+    if state == "replay":
+        return Response(
+            bytes(row.response_body),
+            status_code=row.status_code,
+            headers={"Content-Type": row.content_type, "Idempotent-Replayed": "true"}
+        )
+    if state != "claimed":
+        body, status = flask_backend.idempotency_error(state)
+        return JSONResponse(body, status_code=status, headers={"Retry-After": "5"} if status == 409 else None)
+
+    try:
+        response = await handler(request)
+    except BaseException:
+        await run_in_threadpool(flask_backend.release_idempotency_key, scope)
+        raise
+
+    if isinstance(response, StreamingResponse):
+        recorder = StreamRecorder(scope, response.headers.get("content-type"))
+        response.body_iterator = recorder.wrap(response.body_iterator)
+        previous_background = response.background
+
+        async def finish():
+            await recorder.finish()
+            if previous_background is not None:
+                await previous_background()
+
+        response.background = BackgroundTask(finish)
+    else:
+        await run_in_threadpool(
+            flask_backend.complete_idempotency_key,
+            scope, response.status_code, response.headers.get("content-type"), response.body
+        )
+    return response
+
+
+# ----------------------------- REQUEST COALESCING -----------------------------
+# Same semantics as app.coalesced. A streamed answer is read from the handler by its
+# own task (not by the leader's response), so it runs to completion for everyone
+# even when the leader's client disconnects; the leader and the followers all read
+# from the shared chunk list.
+_flights = {}
+
+
+# What a follower gets from the leader's response headers: how to read the body and
+# how it may be cached. Per-request headers (Set-Cookie, Date, ETag, Idempotent-Replayed)
+# stay with the leader, as in app.coalesced.
+COALESCE_SHARED_HEADERS = ("content-type", "content-encoding", "cache-control", "vary")
+
+
+class Flight:
+    def __init__(self):
+        self.followers = 0
+        self.ready = asyncio.Event()
+        self.landed = asyncio.Event()
+        self.done = False
+        self.failed = False
+        self.status = None
+        self.headers = None
+        self.streamed = False
+        self.chunks = []
+        self.pump = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def start(self, status, headers, streamed):
+        self.status, self.headers, self.streamed = status, headers, streamed
+        self.ready.set()
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, failed=False):
+        self.done = True
+        self.failed = failed
+        self.ready.set()
+        self.landed.set()
+        self._notify()
+
+    async def iter_chunks(self):
+        index = 0
+        while True:
+            changed = self._changed
+            if index < len(self.chunks):
+                index += 1
+                yield self.chunks[index - 1]
+            elif self.done:
+                if self.failed:
+                    # The generation broke off: end the stream the way a failed generation does
+                    yield flask_backend.llm_error_event()
+                return
+            else:
+                await changed.wait()
+
+
+async def follow_stream(flight, endpoint):
+    async for chunk in flight.iter_chunks():
+        yield chunk
+    # Counted once served to the end, like app._follow_stream
+    if not flight.failed:
+        flask_backend.coalesced_requests.inc(endpoint=endpoint)
+
+
+def land_flight(key, flight, failed=False):
+    flight.finish(failed)
+    if _flights.get(key) is flight:
+        del _flights[key]
+
+
+async def pump_flight(key, flight, body_iterator):
+    failed = False
+    try:
+        async for chunk in body_iterator:
+            flight.append(chunk)
+    except Exception as e:
+        print("Error in coalesced stream:", str(e))
+        failed = True
+    finally:
+        land_flight(key, flight, failed)
+
+
+def coalesced(handler):
+    async def wrapper(request):
+        if not flask_backend.COALESCE_ENABLED:
+            return await handler(request)
+
+        body = await request.body()
+        key = (request.url.path, hashlib.sha256(body + b"\n" + request.url.query.encode("utf-8")).hexdigest())
+        flight = _flights.get(key)
+
+        if flight is not None:
+            flight.followers += 1
+            try:
+                await asyncio.wait_for(flight.ready.wait(), flask_backend.COALESCE_WAIT)
+                if not flight.streamed:
+                    await asyncio.wait_for(flight.landed.wait(), flask_backend.COALESCE_WAIT)
+            except asyncio.TimeoutError:
+                return await handler(request)
+            # A failed answer is not replayed (like app.coalesced); a stream that failed
+            # after its first chunks is followed to its error event instead
+            if flight.failed and (not flight.streamed or not flight.chunks):
+                return await handler(request)
+            headers = dict(flight.headers, **{"X-Coalesced": "true"})
+            if flight.streamed:
+                return StreamingResponse(follow_stream(flight, request.url.path), status_code=flight.status,
+                                         headers=dict(headers, **{"X-Accel-Buffering": "no"}))
+            flask_backend.coalesced_requests.inc(endpoint=request.url.path)
+            return Response(b"".join(flight.chunks), status_code=flight.status, headers=headers)
+
+        flight = _flights[key] = Flight()
+        try:
+            response = await handler(request)
+        except BaseException:
+            land_flight(key, flight, failed=True)
+            raise
+
+        headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+        shared = {name: value for name, value in headers.items() if name in COALESCE_SHARED_HEADERS}
+        if isinstance(response, StreamingResponse):
+            flight.start(response.status_code, shared, streamed=True)
+            flight.pump = asyncio.create_task(pump_flight(key, flight, response.body_iterator))
+            return StreamingResponse(flight.iter_chunks(), status_code=response.status_code, headers=headers,
+                                     background=response.background)
+
+        flight.start(response.status_code, shared, streamed=False)
+        flight.append(response.body)
+        land_flight(key, flight, failed=response.status_code >= 500)
+        return response
+
+    return wrapper
+
+
+# ----------------------------- FOLLOWUP ENDPOINT -----------------------------
+@app.post('/followup')
+async def followup(request: Request):
+    return await idempotent(request, coalesced(handle_followup))
+
+
+async def handle_followup(request):
+    data = await request.json()
+    session_id = data.get("session_id")
+    user_message = data.get("message")
+
+    if not session_id or not user_message:
+        return JSONResponse({"error": "session_id and message are required."}, status_code=400)
+
+    with metrics.timed_phase("prompt"):
+        messages, followup_count = await run_in_threadpool(flask_backend.get_followup_context, session_id)
+
+    if followup_count >= flask_backend.MAX_FOLLOWUPS:
+        return JSONResponse(
+            {"error": f"Maximum of {flask_backend.MAX_FOLLOWUPS} follow-up questions reached."},
+            status_code=400
+        )
+
+    messages.append({"role": "user", "content": user_message})
+
+    if wants_stream(request, data):
+        return sse_response(stream_chat_completion(
+            "/followup",
+            session_id,
+            lambda answer: flask_backend.finish_followup(session_id, user_message, answer),
+            messages=messages,
+            max_tokens=1000,
+            temperature=0.7
+        ))
+
+    try:
+        followup_answer = await chat_completion(
+            "/followup",
+            session_id,
+            messages=messages,
+            max_tokens=1000,
+            temperature=0.7
+        )
+    except GatewayBusy as e:
+        print("Azure OpenAI busy:", str(e))
+        return llm_busy_response(e)
+    except Exception as e:
+        print("Error calling Azure OpenAI:", str(e))
+        return JSONResponse({"error": "Error with Azure OpenAI generation."}, status_code=500)
+
+    if not await run_in_threadpool(flask_backend.save_followup, session_id, user_message, followup_answer):
+        return JSONResponse(
+            {"error": f"Maximum of {flask_backend.MAX_FOLLOWUPS} follow-up questions reached."},
+            status_code=400
+        )
+
+    return JSONResponse({"answer": followup_answer})
+
+
+# ----------------------------- RECOMMENDATION ENDPOINT -----------------------------
+async def recommendation_response(request, data, session_id, responses, top5_features, extra=None):
+    """
+    Async twin of app.recommendation_response: 'extra' fields are added to the JSON
+    body, or sent first as a 'session' event when streaming.
+    """
+    endpoint = request.url.path
+    extra = extra or {}
+
+    with metrics.timed_phase("prompt"):
+        prompt = await run_in_threadpool(flask_backend.build_recommendation_prompt, responses, top5_features)
+
+    fingerprint = flask_backend.recommendation_fingerprint(responses, top5_features, endpoint)
+    cached = await run_in_threadpool(flask_backend.lookup_cached_recommendation, fingerprint)
+    if cached is not None:
+        await run_in_threadpool(flask_backend.save_llm_response, session_id, prompt, cached)
+        if wants_stream(request, data):
+            return sse_response(with_prelude(extra, flask_backend.cached_recommendation_stream(cached)))
+        return JSONResponse(dict(extra, recommendation=cached), headers={"X-Recommendation-Cache": "hit"})
+
+    messages = [
+        {"role": "system", "content": flask_backend.RECOMMENDATION_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+    if wants_stream(request, data):
+        return sse_response(with_prelude(extra, stream_chat_completion(
+            endpoint,
+            session_id,
+            lambda recommendation: flask_backend.finish_recommendation(session_id, prompt, fingerprint, recommendation),
+            messages=messages,
+            max_tokens=1000,
+            temperature=1
+        )))
+
+    recommendation = await chat_completion(
+        endpoint,
+        session_id,
+        messages=messages,
+        max_tokens=1000,
+        temperature=1
+    )
+
+    await run_in_threadpool(flask_backend.finish_recommendation, session_id, prompt, fingerprint, recommendation)
+
+    return JSONResponse(dict(extra, recommendation=recommendation))
+
+
+@app.post('/recommendation')
+async def get_recommendation(request: Request):
+    return await idempotent(request, coalesced(handle_recommendation))
+
+
+async def handle_recommendation(request):
+    try:
+        data = await request.json()
+        return await recommendation_response(
+            request,
+            data,
+            data.get("session_id"),
+            data.get("responses", []),
+            data.get("top5_features", [])
+        )
+    except GatewayBusy as e:
+        print("Azure OpenAI busy:", str(e))
+        return llm_busy_response(e)
+    except Exception as e:
+        print("Error generating recommendation:", str(e))
+        return JSONResponse({"error": "An error occurred while generating the recommendation."}, status_code=500)
+
+
+# ----------------------------- ASSESS ENDPOINT -----------------------------
+@app.post('/assess')
+async def assess(request: Request):
+    return await idempotent(request, coalesced(handle_assess))
+
+
+async def handle_assess(request):
+    data = await request.json()
+    if not isinstance(data, dict) or not isinstance(data.get("responses"), list) or not data["responses"]:
+        return JSONResponse({"error": "responses are required"}, status_code=400)
+
+    try:
+        session_id, session_name = await run_in_threadpool(flask_backend.start_assessment, data)
+    except Exception as e:
+        print("Error occurred while saving assessment:", str(e))
+        return JSONResponse({"error": "An error occurred while saving responses."}, status_code=500)
+
+    try:
+        return await recommendation_response(
+            request,
+            data,
+            session_id,
+            data["responses"],
+            data.get("top5_features", []),
+            extra={"session_id": session_id, "session_name": session_name}
+        )
+    except GatewayBusy as e:
+        print("Azure OpenAI busy:", str(e))
+        return llm_busy_response(e, extra={"session_id": session_id, "session_name": session_name})
+    except Exception as e:
+        print("Error generating recommendation:", str(e))
+        return JSONResponse({
+            "error": "An error occurred while generating the recommendation.",
+            "session_id": session_id,
+            "session_name": session_name
+        }, status_code=500)
+
+
+# ----------------------------- FLASK FALLBACK -----------------------------
+# Everything else (questions, submit, sessions, telemetry...) is served by the Flask app.
+app.mount("/", WSGIMiddleware(flask_backend.app))
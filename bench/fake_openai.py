@@ -0,0 +1,133 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+# Azure OpenAI-compatible stand-in for benchmarks: serves
+# POST /openai/deployments/<deployment>/chat/completions (blocking and streaming)
+# and GET /openai/models (the backend's warm-up call), with a configurable time to
+# first token, token rate and 429 rate.
+#
+#   python -m bench.fake_openai --port 8100 --latency 0.8 --tokens-per-second 60
+
+LATENCY = float(os.getenv("FAKE_OPENAI_LATENCY", 0.5))
+TOKENS_PER_SECOND = float(os.getenv("FAKE_OPENAI_TOKENS_PER_SECOND", 50))
+COMPLETION_TOKENS = int(os.getenv("FAKE_OPENAI_COMPLETION_TOKENS", 400))
+THROTTLE_RATE = float(os.getenv("FAKE_OPENAI_429_RATE", 0.0))
+
+WORDS = (
+    "Azure SQL Database Cosmos DB PostgreSQL AI Search vector index hybrid retrieval "
+    "recommend scenario latency throughput embeddings knowledge base operational data"
+).split()
+
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+
+
+def estimate_tokens(messages):
+    return sum(len(str(m.get("content", ""))) for m in messages) // 4
+
+
+def completion_chunk(completion_id, deployment, delta=None, finish_reason=None, usage=None):
+    choices = []
+    if delta is not None or finish_reason is not None:
+        choices.append({
+            "index": 0,
+            "delta": {"content": delta} if delta is not None else {},
+            "finish_reason": finish_reason
+        })
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": deployment,
+        "choices": choices,
+        "usage": usage
+    }
+
+
+@app.post("/openai/deployments/{deployment}/chat/completions")
+async def chat_completions(deployment: str, request: Request):
+    body = await request.json()
+    if THROTTLE_RATE and random.random() < THROTTLE_RATE:
+        return JSONResponse(
+            {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+            status_code=429,
+            headers={"Retry-After": "1"}
+        )
+
+    prompt_tokens = estimate_tokens(body.get("messages", []))
+    completion_tokens = min(COMPLETION_TOKENS, body.get("max_tokens") or COMPLETION_TOKENS)
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0}
+    }
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    words = [random.choice(WORDS) for _ in range(completion_tokens)]
+
+    if not body.get("stream"):
+        await asyncio.sleep(LATENCY + completion_tokens / TOKENS_PER_SECOND)
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": deployment,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(words)},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        })
+
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+    async def stream():
+        await asyncio.sleep(LATENCY)
+        for i, word in enumerate(words):
+            chunk = completion_chunk(completion_id, deployment, delta=word if i == 0 else " " + word)
+            yield f"data: {json.dumps(chunk)}\n\n"
+            await asyncio.sleep(1 / TOKENS_PER_SECOND)
+        yield f"data: {json.dumps(completion_chunk(completion_id, deployment, finish_reason='stop'))}\n\n"
+        if include_usage:
+            yield f"data: {json.dumps(completion_chunk(completion_id, deployment, usage=usage))}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+@app.get("/openai/models")
+async def models():
+    return {"object": "list", "data": []}
+
+
+def main():
+    global LATENCY, TOKENS_PER_SECOND, COMPLETION_TOKENS, THROTTLE_RATE
+
+    parser = argparse.ArgumentParser(description="Fake Azure OpenAI server for benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=TOKENS_PER_SECOND)
+    parser.add_argument("--completion-tokens", type=int, default=COMPLETION_TOKENS)
+    parser.add_argument("--throttle-rate", type=float, default=THROTTLE_RATE, help="fraction of calls answered with 429")
+    args = parser.parse_args()
+
+    LATENCY = args.latency
+    TOKENS_PER_SECOND = args.tokens_per_second
+    COMPLETION_TOKENS = args.completion_tokens
+    THROTTLE_RATE = args.throttle_rate
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
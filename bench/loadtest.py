@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import defaultdict
+
+import httpx
+
+# Drives realistic user journeys against a running backend and reports
+# p50/p95/p99 latency and throughput per endpoint:
+#
+#   recordLogin -> questions -> submit -> recordSession -> featureRanking
+#   -> recommendation -> followup x N -> sessionData -> mySessions -> feedback
+#
+# With --assess, the four calls from submit to recommendation become one /assess call.
+#
+#   python -m bench.loadtest --base-url http://127.0.0.1:8000 --users 20 --journeys 5
+
+FEATURES = ["Vector search", "Hybrid search", "Transactional workloads", "Multi-region writes", "Serverless option"]
+FOLLOWUP_MESSAGES = [
+    "How would this change if we need multi-region writes?",
+    "What would the vector index cost at 50M embeddings?",
+    "Can we keep chat history in the same database?",
+    "Which SDK should the team start with?"
+]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.wire_bytes = defaultdict(int)
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def record(self, endpoint, seconds, ok, wire_bytes=0):
+        self.samples[endpoint].append(seconds)
+        self.wire_bytes[endpoint] += wire_bytes
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def report(self):
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        rows = []
+        for endpoint in sorted(self.samples):
+            samples = sorted(self.samples[endpoint])
+            rows.append({
+                "endpoint": endpoint,
+                "count": len(samples),
+                "errors": self.errors[endpoint],
+                "p50_ms": round(percentile(samples, 50) * 1000, 1),
+                "p95_ms": round(percentile(samples, 95) * 1000, 1),
+                "p99_ms": round(percentile(samples, 99) * 1000, 1),
+                "avg_kb": round(self.wire_bytes[endpoint] / len(samples) / 1024, 2),
+                "rps": round(len(samples) / elapsed, 2) if elapsed else 0.0
+            })
+        return {"elapsed_seconds": round(elapsed, 2), "endpoints": rows}
+
+
+def percentile(sorted_samples, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_samples))))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def format_report(report):
+    lines = [f"{'endpoint':<28}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'avg KB':>9}{'req/s':>9}"]
+    for row in report["endpoints"]:
+        lines.append(
+            f"{row['endpoint']:<28}{row['count']:>8}{row['errors']:>8}"
+            f"{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}{row['avg_kb']:>9}{row['rps']:>9}"
+        )
+    lines.append(f"elapsed: {report['elapsed_seconds']} s")
+    return "\n".join(lines)
+
+
+async def call(client, recorder, name, method, url, stream=False, **kwargs):
+    """
+    Issues one request and records its latency (until the last byte for streams)
+    and its body size on the wire, i.e. after any content encoding.
+    """
+    start = time.perf_counter()
+    try:
+        if stream:
+            async with client.stream(method, url, **kwargs) as response:
+                async for _ in response.aiter_bytes():
+                    pass
+                ok = response.status_code < 400
+                recorder.record(name, time.perf_counter() - start, ok, response.num_bytes_downloaded)
+                return response, None
+        response = await client.request(method, url, **kwargs)
+        ok = response.status_code < 400
+        recorder.record(name, time.perf_counter() - start, ok, response.num_bytes_downloaded)
+        return response, response.json() if ok and response.content else None
+    except httpx.HTTPError as e:
+        recorder.record(name, time.perf_counter() - start, False)
+        print(f"{name} failed: {e}")
+        return None, None
+
+
+def build_answers(questions):
+    answers = []
+    for q in questions:
+        if q["Question"] == "Customer Name":
+            answer = f"Contoso {random.randint(1, 50)}"
+        elif q.get("options"):
+            answer = random.choice(q["options"].split("|"))
+        else:
+            answer = "Not sure yet"
+        answers.append({"question_id": q["id"], "question": q["Question"], "answer": answer})
+    answers.append({"question_id": -1, "question": "Free-form question", "answer": "We need a RAG chatbot over product manuals."})
+    return answers
+
+
+async def submit_then_recommend(client, recorder, args, params, email, answers, top5):
+    _, submitted = await call(client, recorder, "/submit", "POST", "/submit", json=answers)
+    if not submitted:
+        return None
+    session_id = submitted["session_id"]
+
+    await call(client, recorder, "/recordSession", "POST", "/recordSession", json={
+        "email": email, "session_id": session_id, "session_name": submitted["session_name"]
+    })
+
+    await call(client, recorder, "/featureRanking", "POST", "/featureRanking", json={
+        "session_id": session_id,
+        "feature_rankings": [{"rank_position": i + 1, "feature_name": f} for i, f in enumerate(top5)]
+    })
+
+    await call(client, recorder, "/recommendation", "POST", "/recommendation", stream=args.stream, params=params, json={
+        "session_id": session_id, "responses": answers, "top5_features": top5
+    })
+    return session_id
+
+
+async def assess(client, recorder, args, params, email, answers, top5):
+    body = {"email": email, "responses": answers, "top5_features": top5}
+    if not args.stream:
+        _, assessed = await call(client, recorder, "/assess", "POST", "/assess", json=body)
+        return assessed["session_id"] if assessed else None
+
+    # The session id arrives in the first ('session') event of the stream
+    start = time.perf_counter()
+    session_id = None
+    try:
+        async with client.stream("POST", "/assess", params=params, json=body) as response:
+            async for line in response.aiter_lines():
+                if session_id is None and line.startswith("data: "):
+                    session_id = json.loads(line[len("data: "):]).get("session_id")
+            recorder.record("/assess", time.perf_counter() - start, response.status_code < 400,
+                            response.num_bytes_downloaded)
+    except httpx.HTTPError as e:
+        recorder.record("/assess", time.perf_counter() - start, False)
+        print(f"/assess failed: {e}")
+    return session_id
+
+
+async def journey(client, recorder, args):
+    email = f"bench-{uuid.uuid4().hex[:8]}@example.com"
+    await call(client, recorder, "/recordLogin", "POST", "/recordLogin", json={"email": email})
+
+    _, questions = await call(client, recorder, "/questions", "GET", "/questions")
+    if not questions:
+        return
+    answers = build_answers(questions)
+
+    top5 = random.sample(FEATURES, 5)
+    params = {"stream": "1"} if args.stream else None
+    if args.assess:
+        session_id = await assess(client, recorder, args, params, email, answers, top5)
+    else:
+        session_id = await submit_then_recommend(client, recorder, args, params, email, answers, top5)
+    if not session_id:
+        return
+
+    for _ in range(args.followups):
+        await call(client, recorder, "/followup", "POST", "/followup", stream=args.stream, params=params, json={
+            "session_id": session_id, "message": random.choice(FOLLOWUP_MESSAGES)
+        })
+
+    await call(client, recorder, "/sessionData", "GET", f"/sessionData/{session_id}")
+    await call(client, recorder, "/mySessions", "GET", "/mySessions", params={"email": email})
+    await call(client, recorder, "/feedback", "POST", "/feedback", json={"session_id": session_id, "feedback": "thumbs_up"})
+
+
+async def user(client, recorder, args):
+    for _ in range(args.journeys):
+        await journey(client, recorder, args)
+        if args.think_time:
+            await asyncio.sleep(random.uniform(0, args.think_time))
+
+
+async def run(args):
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users * 2)
+    headers = {"Accept-Encoding": args.accept_encoding}
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits, headers=headers) as client:
+        await asyncio.gather(*(user(client, recorder, args) for _ in range(args.users)))
+    recorder.finished = time.perf_counter()
+    return recorder.report()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the recommendation backend with realistic journeys.")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--users", type=int, default=10, help="concurrent users")
+    parser.add_argument("--journeys", type=int, default=3, help="journeys per user")
+    parser.add_argument("--followups", type=int, default=3, help="follow-ups per journey")
+    parser.add_argument("--stream", action="store_true", help="use the SSE variants of /recommendation and /followup")
+    parser.add_argument("--assess", action="store_true", help="use the one-shot /assess instead of submit .. recommendation")
+    parser.add_argument("--think-time", type=float, default=0.0, help="max random pause between journeys (s)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--accept-encoding", default="zstd, gzip",
+                        help="Accept-Encoding sent with every request ('identity' disables response compression)")
+    parser.add_argument("--json", dest="json_path", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+    print(format_report(report))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import urllib.parse
+
+import httpx
+from sqlalchemy import create_engine, text
+
+from bench import loadtest
+
+# End-to-end benchmark: resets the local stand-in schema, starts the fake Azure
+# OpenAI server and the backend (sync Flask or ASGI mode), drives the user
+# journeys from bench/loadtest.py and prints per-endpoint latency percentiles.
+#
+#   docker compose -f bench/docker-compose.yml up -d
+#   python -m bench.run --mode sync --users 20 --journeys 5
+#
+# SQL_SERVER / SQL_DATABASE / SQL_USERNAME / SQL_PASSWORD default to the container above.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SQL_DEFAULTS = {
+    "SQL_SERVER": "localhost,1433",
+    "SQL_DATABASE": "advisor_bench",
+    "SQL_USERNAME": "sa",
+    "SQL_PASSWORD": "Bench_Passw0rd!",
+    "SQL_TRUST_SERVER_CERTIFICATE": "yes"
+}
+
+
+def sql_env():
+    return {key: os.getenv(key, default) for key, default in SQL_DEFAULTS.items()}
+
+
+def bench_engine(env, database):
+    odbc = (
+        "DRIVER={ODBC Driver 18 for SQL Server};"
+        f"SERVER={env['SQL_SERVER']};DATABASE={database};"
+        f"UID={env['SQL_USERNAME']};PWD={env['SQL_PASSWORD']};"
+        "Encrypt=yes;TrustServerCertificate=yes;"
+    )
+    return create_engine(
+        f"mssql+pyodbc:///?odbc_connect={urllib.parse.quote_plus(odbc)}",
+        isolation_level="AUTOCOMMIT"
+    )
+
+
+def run_script(engine, path):
+    """
+    Runs a T-SQL script, batch by batch (split on GO lines like sqlcmd does).
+    """
+    with open(path, encoding="utf-8") as f:
+        batches = re.split(r"^\s*GO\s*$", f.read(), flags=re.MULTILINE | re.IGNORECASE)
+    with engine.connect() as connection:
+        for batch in batches:
+            if batch.strip():
+                connection.exec_driver_sql(batch)
+
+
+def reset_database(env):
+    database = env["SQL_DATABASE"]
+    master = bench_engine(env, "master")
+    with master.connect() as connection:
+        connection.execute(text(f"IF DB_ID('{database}') IS NULL CREATE DATABASE [{database}]"))
+    master.dispose()
+
+    engine = bench_engine(env, database)
+    run_script(engine, os.path.join(ROOT, "bench", "schema.sql"))
+    for path in sorted(glob.glob(os.path.join(ROOT, "sql", "*.sql"))):
+        run_script(engine, path)
+    engine.dispose()
+
+
+def wait_until_ready(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{url} did not become ready within {timeout}s")
+
+
+def start_processes(args, env):
+    # One fake server per deployment, on consecutive ports
+    ports = [args.openai_port + i for i in range(args.llm_deployments)]
+    processes = [subprocess.Popen([
+        sys.executable, "-m", "bench.fake_openai",
+        "--port", str(port),
+        "--latency", str(args.llm_latency),
+        "--tokens-per-second", str(args.llm_tokens_per_second),
+        "--completion-tokens", str(args.llm_completion_tokens),
+        "--throttle-rate", str(args.llm_throttle_rate)
+    ], cwd=ROOT) for port in ports]
+
+    app_env = dict(
+        os.environ,
+        **env,
+        AZURE_OPENAI_ENDPOINT=f"http://127.0.0.1:{args.openai_port}",
+        AZURE_OPENAI_KEY="bench",
+        AZURE_OPENAI_DEPLOYMENT="bench-deployment"
+    )
+    if args.llm_deployments > 1:
+        app_env["AZURE_OPENAI_DEPLOYMENTS"] = json.dumps([
+            {"name": f"bench-{port}", "endpoint": f"http://127.0.0.1:{port}", "deployment": "bench-deployment"}
+            for port in ports
+        ])
+    worker_class = ["-k", "uvicorn.workers.UvicornWorker", "asgi:app"] if args.mode == "asgi" else ["app:app"]
+    backend = subprocess.Popen(
+        ["gunicorn", "--bind", f"127.0.0.1:{args.app_port}", "--workers", str(args.workers),
+         "--threads", str(args.threads), "--timeout", "300"] + worker_class,
+        cwd=ROOT,
+        env=app_env
+    )
+    return processes + [backend]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the backend benchmark end to end.")
+    parser.add_argument("--mode", choices=["sync", "asgi"], default="sync")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1, help="gunicorn threads per worker (sync mode)")
+    parser.add_argument("--app-port", type=int, default=8000)
+    parser.add_argument("--openai-port", type=int, default=8100)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50)
+    parser.add_argument("--llm-completion-tokens", type=int, default=400)
+    parser.add_argument("--llm-throttle-rate", type=float, default=0.0)
+    parser.add_argument("--llm-deployments", type=int, default=1, help="fake Azure OpenAI deployments to route between")
+    parser.add_argument("--skip-reset", action="store_true", help="keep the existing bench database")
+    args, loadtest_argv = parser.parse_known_args()
+
+    env = sql_env()
+    if not args.skip_reset:
+        reset_database(env)
+
+    processes = start_processes(args, env)
+    try:
+        wait_until_ready(f"http://127.0.0.1:{args.app_port}/ready")
+        loadtest.main(["--base-url", f"http://127.0.0.1:{args.app_port}"] + loadtest_argv)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=30)
+
+
+if __name__ == "__main__":
+    main()
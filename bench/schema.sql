@@ -0,0 +1,115 @@
+-- Local stand-in for the production schema, used by the benchmark harness (bench/run.py).
+-- Drops and recreates every table the backend touches, then seeds questions and the
+-- feature comparison table. The optional-feature migrations in sql/ are applied afterwards.
+
+DROP TABLE IF EXISTS dbo.responses;
+DROP TABLE IF EXISTS dbo.LLMResponses;
+DROP TABLE IF EXISTS dbo.FollowUps;
+DROP TABLE IF EXISTS dbo.FeatureRankings;
+DROP TABLE IF EXISTS dbo.Connections;
+DROP TABLE IF EXISTS dbo.Feedback;
+DROP TABLE IF EXISTS dbo.Get_Help;
+DROP TABLE IF EXISTS dbo.new_questions3;
+DROP TABLE IF EXISTS dbo.FeatureComparison_Detailed;
+DROP TABLE IF EXISTS dbo.RecommendationCache;
+DROP TABLE IF EXISTS dbo.FollowUpCounters;
+DROP TABLE IF EXISTS dbo.LLMCalls;
+DROP TABLE IF EXISTS dbo.Sessions;
+DROP TABLE IF EXISTS dbo.PromptContexts;
+DROP TABLE IF EXISTS dbo.IdempotencyKeys;
+DROP TABLE IF EXISTS dbo.FollowUpSummaries;
+GO
+
+CREATE TABLE dbo.new_questions3 (
+    id       INT            NOT NULL PRIMARY KEY,
+    Category NVARCHAR(100)  NOT NULL,
+    Question NVARCHAR(1000) NOT NULL,
+    options  NVARCHAR(MAX)  NULL
+);
+
+CREATE TABLE dbo.responses (
+    id            INT IDENTITY(1,1) PRIMARY KEY,
+    question_id   INT            NOT NULL,
+    response_text NVARCHAR(MAX)  NULL,
+    session_id    NVARCHAR(64)   NOT NULL
+);
+CREATE INDEX IX_responses_session_id ON dbo.responses (session_id, id);
+
+CREATE TABLE dbo.LLMResponses (
+    id            INT IDENTITY(1,1) PRIMARY KEY,
+    session_id    NVARCHAR(64)   NOT NULL,
+    prompt        NVARCHAR(MAX)  NULL,
+    response_text NVARCHAR(MAX)  NULL
+);
+CREATE INDEX IX_LLMResponses_session_id ON dbo.LLMResponses (session_id, id);
+
+CREATE TABLE dbo.FollowUps (
+    id                INT IDENTITY(1,1) PRIMARY KEY,
+    session_id        NVARCHAR(64)  NOT NULL,
+    user_message      NVARCHAR(MAX) NULL,
+    assistant_message NVARCHAR(MAX) NULL
+);
+
+CREATE TABLE dbo.FeatureRankings (
+    id            INT IDENTITY(1,1) PRIMARY KEY,
+    session_id    NVARCHAR(64)  NOT NULL,
+    rank_position INT           NOT NULL,
+    feature_name  NVARCHAR(200) NOT NULL
+);
+CREATE INDEX IX_FeatureRankings_session_id ON dbo.FeatureRankings (session_id);
+
+CREATE TABLE dbo.Connections (
+    id              INT IDENTITY(1,1) PRIMARY KEY,
+    email           NVARCHAR(320) NOT NULL,
+    event_type      NVARCHAR(32)  NOT NULL,
+    session_id      NVARCHAR(64)  NULL,
+    session_name    NVARCHAR(400) NULL,
+    event_timestamp DATETIME      NOT NULL DEFAULT GETDATE(),
+    is_deleted      BIT           NOT NULL DEFAULT 0
+);
+
+CREATE TABLE dbo.Feedback (
+    id         INT IDENTITY(1,1) PRIMARY KEY,
+    session_id NVARCHAR(64)   NOT NULL,
+    feedback   NVARCHAR(32)   NOT NULL,
+    comments   NVARCHAR(MAX)  NULL
+);
+
+CREATE TABLE dbo.Get_Help (
+    id         INT IDENTITY(1,1) PRIMARY KEY,
+    session_id NVARCHAR(64) NOT NULL,
+    timestamp  DATETIME     NOT NULL DEFAULT GETDATE()
+);
+
+CREATE TABLE dbo.FeatureComparison_Detailed (
+    Feature                       NVARCHAR(200) NOT NULL PRIMARY KEY,
+    AI_Search                     NVARCHAR(400) NULL,
+    Azure_Cosmos_DB_NoSQL         NVARCHAR(400) NULL,
+    Azure_Cosmos_DB_MongoDB_vCore NVARCHAR(400) NULL,
+    Azure_SQL_DB                  NVARCHAR(400) NULL,
+    Azure_PostgreSQL              NVARCHAR(400) NULL
+);
+GO
+
+INSERT INTO dbo.new_questions3 (id, Category, Question, options) VALUES
+(1,  'Customer',    'Customer Name', NULL),
+(2,  'Customer',    'What are the main use cases for the application?', 'RAG chatbot|Agents|Semantic search|Recommendations'),
+(3,  'Application', 'What framework does the application use?', 'LangChain|Semantic Kernel|LlamaIndex|None'),
+(4,  'Retrieval',   'Which retrieval techniques are needed?', 'Vector|Full text|Hybrid|Semantic ranking'),
+(5,  'Retrieval',   'What is the expected number of vectors?', '<1M|1M-10M|10M-100M|>100M'),
+(6,  'Knowledge',   'Which data types are in the knowledge base?', 'Text|PDF|Images|Structured rows'),
+(7,  'Knowledge',   'Where does the knowledge base data come from?', 'Blob storage|SharePoint|Operational database|Web'),
+(8,  'Operations',  'What latency does the application need?', '<50ms|<200ms|<1s'),
+(9,  'Operations',  'Is multi-region write required?', 'Yes|No'),
+(10, 'Application', 'Where does the application data live today?', 'Azure SQL|Cosmos DB|PostgreSQL|MongoDB|Other');
+
+INSERT INTO dbo.FeatureComparison_Detailed VALUES
+('Vector search',           'Yes (HNSW, exhaustive KNN)', 'Yes (DiskANN, flat, quantized flat)', 'Yes (HNSW, IVF, DiskANN)', 'Yes (vector type, DiskANN)', 'Yes (pgvector, pg_diskann)'),
+('Full-text search',        'Yes (BM25)',                  'Yes (BM25)',                           'Yes (text indexes)',       'Yes (full-text indexes)',    'Yes (tsvector)'),
+('Hybrid search',           'Yes (RRF)',                   'Yes (RRF)',                            'Manual',                   'Manual',                     'Manual'),
+('Semantic ranking',        'Yes',                         'Preview',                              'No',                       'No',                         'Yes (extension)'),
+('Transactional workloads', 'No',                          'Yes',                                  'Yes',                      'Yes',                        'Yes'),
+('Multi-region writes',     'No',                          'Yes',                                  'No',                       'No',                         'No'),
+('Integrated vectorization','Yes',                         'No',                                   'No',                       'No',                         'Yes (azure_ai extension)'),
+('Serverless option',       'No',                          'Yes',                                  'No',                       'Yes',                        'No');
+GO
@@ -324,65 +324,24 @@ function App() {
     });
 
     try {
-      // Submit => new session
-      const submitResp = await fetch(`${API_BASE_URL}/submit`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify(payload),
-      });
-      if (!submitResp.ok) throw new Error("Failed to submit data");
-      const data = await submitResp.json();
-
-      setSessionId(data.session_id);
-      setSessionName(data.session_name || "");
-      console.log(sessionName); // keep
-
-      // record session
-      if (userEmail && data.session_id) {
-        fetch(`${API_BASE_URL}/recordSession`, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({
-            email: userEmail,
-            session_id: data.session_id,
-            session_name: data.session_name,
-          }),
-        }).catch(console.error);
-      }
-
-      // If top5 => featureRanking
-      if (optionalTop5Features.length > 0) {
-        const fr = optionalTop5Features.map((feat, idx) => ({
-          rank_position: idx + 1,
-          feature_name: feat,
-        }));
-        const frResp = await fetch(`${API_BASE_URL}/featureRanking`, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({
-            session_id: data.session_id,
-            feature_rankings: fr,
-          }),
-        });
-        if (!frResp.ok) {
-          const eD = await frResp.json();
-          alert(`Failed to record feature ranking: ${eD.error}`);
-        }
-      }
-
-      // Get final recommendation
-      const recResp = await fetch(`${API_BASE_URL}/recommendation`, {
+      // Save answers, session and top 5 features, then get the final recommendation, in one call
+      const assessResp = await fetch(`${API_BASE_URL}/assess`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify({
+          email: userEmail,
           responses: payload,
-          session_id: data.session_id,
           top5_features: optionalTop5Features,
         }),
       });
-      if (!recResp.ok) throw new Error("Fetching recommendation failed");
-      const recData = await recResp.json();
-      setRecommendation(recData.recommendation);
+      const data = await assessResp.json();
+      if (data.session_id) {
+        setSessionId(data.session_id);
+        setSessionName(data.session_name || "");
+        console.log(sessionName); // keep
+      }
+      if (!assessResp.ok) throw new Error("Fetching recommendation failed");
+      setRecommendation(data.recommendation);
 
       // Refresh sessions
       await fetchSessionsForUser();
@@ -0,0 +1,376 @@
+import asyncio
+import collections
+import contextlib
+import email.utils
+import math
+import random
+import threading
+import time
+
+from tenacity import AsyncRetrying, Retrying, retry_if_exception, stop_after_attempt
+from tenacity.wait import wait_base, wait_random_exponential
+
+import metrics
+import startup
+
+# Imported on first use with STARTUP_MODE=lazy (see startup.py)
+openai = startup.lazy_import("openai")
+
+# Single front door for Azure OpenAI calls: caps how many calls a process has in
+# flight, queues the rest (bounded, FIFO, with a timeout), sends each attempt to the
+# deployment the router (llm_router.py) picks, and retries throttled or failed calls
+# on another deployment right away or, when none is left, with jittered backoff that
+# honours Retry-After.
+#
+#   with gateway.slot(endpoint) as call:
+#       raw = gateway.create(call, messages=..., max_tokens=...)
+#       call.deployment_name, call.retries
+#
+# A streamed answer keeps its slot (and its deployment) until the stream has been read to the end.
+
+llm_queue_wait = metrics.Histogram(
+    "llm_queue_wait_seconds", "Time spent waiting for an LLM slot.", ("endpoint",),
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+)
+llm_rejected = metrics.Counter("llm_rejected_total", "LLM calls turned away by the gateway.", ("endpoint", "reason"))
+llm_retries = metrics.Counter("llm_retries_total", "Retried LLM call attempts.", ("endpoint", "reason"))
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+class GatewayBusy(Exception):
+    """
+    No capacity for the call: the wait queue was full ('queue_full'), no slot freed
+    up in time ('queue_timeout'), or Azure kept answering 429 ('throttled').
+    retry_after is a hint in seconds for the client.
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"LLM gateway busy ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def is_retryable(error):
+    if isinstance(error, openai.APIConnectionError):  # includes timeouts
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    return False
+
+
+def retry_reason(error):
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    return str(getattr(error, "status_code", "error"))
+
+
+def retry_after(error):
+    """
+    Seconds the server asked us to wait (retry-after-ms or Retry-After), or None.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        value = response.headers.get("retry-after-ms")
+        if value:
+            return max(0.0, float(value) / 1000)
+        value = response.headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class wait_failover(wait_base):
+    """
+    No wait when another deployment can take the retry, otherwise the given strategy.
+    """
+
+    def __init__(self, can_fail_over, fallback):
+        self.can_fail_over = can_fail_over
+        self.fallback = fallback
+
+    def __call__(self, retry_state):
+        return 0 if self.can_fail_over() else self.fallback(retry_state)
+
+
+class wait_retry_after(wait_base):
+    """
+    Waits what the server asked for (plus up to 20% jitter so throttled callers do
+    not come back in lockstep), otherwise falls back to the given strategy.
+    Never waits longer than max_wait.
+    """
+
+    def __init__(self, fallback, max_wait):
+        self.fallback = fallback
+        self.max_wait = max_wait
+
+    def __call__(self, retry_state):
+        delay = retry_after(retry_state.outcome.exception())
+        if delay is None:
+            return self.fallback(retry_state)
+        return min(self.max_wait, delay * random.uniform(1.0, 1.2))
+
+
+class SlotQueue:
+    """
+    At most limit holders; up to max_waiting threads wait in FIFO order and a
+    released slot is handed straight to the oldest waiter.
+    """
+
+    def __init__(self, limit, max_waiting):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    def waiting(self):
+        return len(self._waiters)
+
+    def acquire(self, timeout):
+        with self._lock:
+            if self.in_flight < self.limit and not self._waiters:
+                self.in_flight += 1
+                return
+            if len(self._waiters) >= self.max_waiting:
+                raise GatewayBusy("queue_full", max(1, int(timeout)))
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        if waiter.wait(timeout):
+            return
+        with self._lock:
+            # Handed a slot just as the wait timed out
+            if waiter.is_set():
+                return
+            self._waiters.remove(waiter)
+        raise GatewayBusy("queue_timeout", max(1, int(timeout)))
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self.in_flight -= 1
+
+
+class AsyncSlotQueue:
+    """
+    asyncio twin of SlotQueue, for one event loop.
+    """
+
+    def __init__(self, limit, max_waiting):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self._waiters = collections.deque()
+
+    def waiting(self):
+        return len(self._waiters)
+
+    async def acquire(self, timeout):
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_waiting:
+            raise GatewayBusy("queue_full", max(1, int(timeout)))
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                return
+            self._waiters.remove(waiter)
+            raise GatewayBusy("queue_timeout", max(1, int(timeout)))
+        except asyncio.CancelledError:
+            # Client went away: pass on a slot we were just handed, or leave the queue
+            if waiter.done():
+                self.release()
+            else:
+                waiter.cancel()
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+
+class LLMCall:
+    """
+    One call through the gateway: the deployment serving it and the retries it took.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.deployment = None
+        self.failed = []
+        self.retries = 0
+
+    @property
+    def deployment_name(self):
+        deployment = self.deployment or (self.failed[-1] if self.failed else None)
+        return deployment.name if deployment is not None else None
+
+
+class LLMGateway:
+    """
+    Concurrency limit, wait queue, routing and retry policy shared by every LLM call
+    of the process. Threads (Flask) get max_in_flight slots and coroutines (asgi.py)
+    max_in_flight_async (default: max_in_flight); a process only ever serves LLM
+    routes through one of the two.
+    """
+
+    def __init__(self, router, max_in_flight=16, max_queue=64, queue_timeout=30.0, max_attempts=4,
+                 max_retry_wait=20.0, max_in_flight_async=None):
+        self.router = router
+        self.queue_timeout = queue_timeout
+        self.max_attempts = max_attempts
+        self.max_retry_wait = max_retry_wait
+        self._slots = SlotQueue(max_in_flight, max_queue)
+        self._async_slots = AsyncSlotQueue(max_in_flight_async or max_in_flight, max_queue)
+
+    def stats(self):
+        return {
+            "in_flight": self._slots.in_flight + self._async_slots.in_flight,
+            "waiting": self._slots.waiting() + self._async_slots.waiting()
+        }
+
+    # ----------------------------- SLOTS -----------------------------
+    @contextlib.contextmanager
+    def slot(self, endpoint):
+        """
+        Holds one LLM slot for the duration of the block and yields its LLMCall.
+        Raises GatewayBusy.
+        """
+        start = time.perf_counter()
+        try:
+            self._slots.acquire(self.queue_timeout)
+        except GatewayBusy as e:
+            llm_rejected.inc(endpoint=endpoint, reason=e.reason)
+            raise
+        finally:
+            llm_queue_wait.observe(time.perf_counter() - start, endpoint=endpoint)
+        call = LLMCall(endpoint)
+        try:
+            yield call
+        finally:
+            self._finish(call)
+            self._slots.release()
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, endpoint):
+        start = time.perf_counter()
+        try:
+            await self._async_slots.acquire(self.queue_timeout)
+        except GatewayBusy as e:
+            llm_rejected.inc(endpoint=endpoint, reason=e.reason)
+            raise
+        finally:
+            llm_queue_wait.observe(time.perf_counter() - start, endpoint=endpoint)
+        call = LLMCall(endpoint)
+        try:
+            yield call
+        finally:
+            self._finish(call)
+            self._async_slots.release()
+
+    # ----------------------------- ATTEMPTS -----------------------------
+    def create(self, call, **kwargs):
+        """
+        chat.completions.with_raw_response.create(**kwargs) on the routed deployment
+        ('model' is filled in), retrying throttled, timed-out and 5xx attempts.
+        Still throttled after the last attempt: GatewayBusy.
+        """
+        try:
+            for attempt in Retrying(**self._retry_options(call)):
+                with attempt:
+                    call.retries = attempt.retry_state.attempt_number - 1
+                    deployment, start = self._start_attempt(call, kwargs)
+                    try:
+                        result = deployment.client.chat.completions.with_raw_response.create(
+                            model=deployment.deployment, **kwargs
+                        )
+                    except Exception as e:
+                        self._attempt_failed(call, e)
+                        raise
+                    self._attempt_succeeded(call, start, kwargs, result)
+        except openai.RateLimitError as e:
+            raise self._throttled(call.endpoint, e) from e
+        return result
+
+    async def acreate(self, call, **kwargs):
+        try:
+            async for attempt in AsyncRetrying(**self._retry_options(call)):
+                with attempt:
+                    call.retries = attempt.retry_state.attempt_number - 1
+                    deployment, start = self._start_attempt(call, kwargs)
+                    try:
+                        result = await deployment.async_client.chat.completions.with_raw_response.create(
+                            model=deployment.deployment, **kwargs
+                        )
+                    except BaseException as e:
+                        self._attempt_failed(call, e)
+                        raise
+                    self._attempt_succeeded(call, start, kwargs, result)
+        except openai.RateLimitError as e:
+            raise self._throttled(call.endpoint, e) from e
+        return result
+
+    def _start_attempt(self, call, kwargs):
+        # Rough prompt size (4 characters per token) plus the completion budget
+        tokens = (kwargs.get("max_tokens") or 0) + sum(len(str(m.get("content", ""))) for m in kwargs.get("messages", [])) // 4
+        call.deployment = self.router.choose(call.endpoint, streamed=bool(kwargs.get("stream")), tokens=tokens,
+                                             exclude=call.failed)
+        return call.deployment, time.perf_counter()
+
+    def _attempt_succeeded(self, call, start, kwargs, result):
+        self.router.succeeded(call.deployment, time.perf_counter() - start, bool(kwargs.get("stream")),
+                              getattr(result, "headers", None))
+
+    def _attempt_failed(self, call, error):
+        deployment, call.deployment = call.deployment, None
+        if isinstance(error, Exception):
+            self.router.failed(deployment, error, retry_after(error))
+        self.router.release(deployment)
+        call.failed.append(deployment)
+
+    def _finish(self, call):
+        # Failed attempts released theirs already; the deployment stays on the call for telemetry
+        if call.deployment is not None:
+            self.router.release(call.deployment)
+
+    def _retry_options(self, call):
+        def before_sleep(retry_state):
+            reason = retry_reason(retry_state.outcome.exception())
+            llm_retries.inc(endpoint=call.endpoint, reason=reason)
+            print(f"Retrying Azure OpenAI call for {call.endpoint} ({reason}) in {retry_state.next_action.sleep:.1f}s")
+
+        backoff = wait_retry_after(wait_random_exponential(multiplier=0.5, max=self.max_retry_wait), self.max_retry_wait)
+        return {
+            "retry": retry_if_exception(is_retryable),
+            "stop": stop_after_attempt(self.max_attempts),
+            "wait": wait_failover(lambda: self.router.can_fail_over(call.endpoint, call.failed), backoff),
+            "before_sleep": before_sleep,
+            "reraise": True
+        }
+
+    def _throttled(self, endpoint, error):
+        llm_rejected.inc(endpoint=endpoint, reason="throttled")
+        delay = retry_after(error)
+        return GatewayBusy("throttled", max(1, math.ceil(delay if delay is not None else 5)))
@@ -0,0 +1,227 @@
+import json
+import os
+import random
+import threading
+import time
+
+import metrics
+import startup
+
+# Imported on first use with STARTUP_MODE=lazy (see startup.py)
+openai = startup.lazy_import("openai")
+
+# Picks the Azure OpenAI deployment for each LLM call attempt.
+#
+# Deployments are grouped (e.g. 'large', 'fast'); a route maps an endpoint to an
+# ordered list of groups, so /followup can prefer a small model and fall back to the
+# large one. Within a group the choice is 'power of two choices': two healthy
+# deployments are sampled and the one with the better score (observed latency,
+# calls in flight, error rate, remaining token quota) wins. A deployment that
+# answered 429 rests for its Retry-After; one that failed FAILURE_THRESHOLD times
+# in a row rests for FAILURE_COOLDOWN seconds. Either way traffic fails over to the
+# others in the meantime.
+
+EWMA_ALPHA = 0.2
+FAILURE_THRESHOLD = 3
+FAILURE_COOLDOWN = 30.0
+THROTTLE_COOLDOWN = 10.0
+# Quota headers are per-minute windows; older readings say nothing
+QUOTA_READING_TTL = 60.0
+
+llm_deployment_calls = metrics.Counter(
+    "llm_deployment_calls_total", "Azure OpenAI call attempts per deployment.", ("deployment", "outcome")
+)
+llm_failovers = metrics.Counter("llm_failovers_total", "Attempts moved to another deployment.", ("endpoint",))
+
+
+def _header_int(headers, name):
+    try:
+        return int(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class Deployment:
+    """
+    One Azure OpenAI deployment (endpoint + deployment name) and what has been
+    observed about it. Clients are created on first use.
+    """
+
+    def __init__(self, name, endpoint, api_key, deployment, api_version, group="default"):
+        self.name = name
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.deployment = deployment
+        self.api_version = api_version
+        self.group = group
+
+        self.in_flight = 0
+        self.latency = {}  # EWMA seconds, by streamed / not streamed
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.cool_until = 0.0
+        self.remaining_tokens = None
+        self.remaining_at = 0.0
+        self._client = None
+        self._async_client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = openai.AzureOpenAI(
+                api_key=self.api_key, azure_endpoint=self.endpoint, api_version=self.api_version, max_retries=0
+            )
+        return self._client
+
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = openai.AsyncAzureOpenAI(
+                api_key=self.api_key, azure_endpoint=self.endpoint, api_version=self.api_version, max_retries=0
+            )
+        return self._async_client
+
+    def score(self, streamed, tokens, now):
+        """
+        Lower is better. Deployments without a latency reading yet score best, so they get tried.
+        """
+        score = (self.latency.get(streamed, 0.0) + 0.05) * (1 + self.in_flight) * (1 + 4 * self.error_rate)
+        if self.remaining_tokens is not None and now - self.remaining_at < QUOTA_READING_TTL \
+                and self.remaining_tokens < tokens:
+            score *= 4
+        return score
+
+
+class LLMRouter:
+    def __init__(self, deployments, routes=None):
+        if not deployments:
+            raise ValueError("At least one Azure OpenAI deployment is required.")
+        self.deployments = deployments
+        self.routes = routes or {}
+        self._lock = threading.Lock()
+        for endpoint, groups in self.routes.items():
+            for group in groups:
+                if not self._candidates(group):
+                    raise ValueError(f"LLM route {endpoint} names group '{group}', which has no deployment.")
+
+    # ----------------------------- CHOICE -----------------------------
+    def _route_groups(self, endpoint):
+        return self.routes.get(endpoint) or self.routes.get("*") or [None]
+
+    def _candidates(self, group):
+        return [d for d in self.deployments if group is None or d.group == group]
+
+    def route_models(self, endpoint):
+        """
+        Deployment (model) names the endpoint's preferred group would use.
+        """
+        return sorted({d.deployment for d in self._candidates(self._route_groups(endpoint)[0])})
+
+    def choose(self, endpoint, streamed=False, tokens=0, exclude=()):
+        """
+        Picks a deployment for the next attempt and counts it as in flight (see release()).
+        exclude holds deployments that already failed this call.
+        """
+        now = time.monotonic()
+        with self._lock:
+            chosen = None
+            for group in self._route_groups(endpoint):
+                healthy = [d for d in self._candidates(group) if d not in exclude and d.cool_until <= now]
+                if len(healthy) > 2:
+                    healthy = random.sample(healthy, 2)
+                if healthy:
+                    chosen = min(healthy, key=lambda d: d.score(streamed, tokens, now))
+                    break
+            if chosen is None:
+                # Everything is resting: take the one that is back first
+                pool = [d for group in self._route_groups(endpoint) for d in self._candidates(group)]
+                chosen = min(pool, key=lambda d: (d in exclude, d.cool_until))
+            if exclude and chosen not in exclude:
+                llm_failovers.inc(endpoint=endpoint)
+            chosen.in_flight += 1
+            return chosen
+
+    def can_fail_over(self, endpoint, exclude):
+        """
+        True when a deployment that has not failed this call is available right now.
+        """
+        now = time.monotonic()
+        return any(
+            d not in exclude and d.cool_until <= now
+            for group in self._route_groups(endpoint) for d in self._candidates(group)
+        )
+
+    def release(self, deployment):
+        with self._lock:
+            deployment.in_flight -= 1
+
+    # ----------------------------- FEEDBACK -----------------------------
+    def succeeded(self, deployment, latency, streamed, headers=None):
+        with self._lock:
+            previous = deployment.latency.get(streamed)
+            deployment.latency[streamed] = latency if previous is None else previous + EWMA_ALPHA * (latency - previous)
+            deployment.error_rate *= 1 - EWMA_ALPHA
+            deployment.consecutive_failures = 0
+            self._read_quota(deployment, headers)
+        llm_deployment_calls.inc(deployment=deployment.name, outcome="ok")
+
+    def failed(self, deployment, error, retry_after=None):
+        status = getattr(error, "status_code", None)
+        if status is not None and status < 500 and status not in (408, 429):
+            # The request itself was bad; says nothing about the deployment
+            llm_deployment_calls.inc(deployment=deployment.name, outcome="rejected")
+            return
+
+        with self._lock:
+            deployment.error_rate += EWMA_ALPHA * (1 - deployment.error_rate)
+            deployment.consecutive_failures += 1
+            now = time.monotonic()
+            if status == 429:
+                deployment.cool_until = now + (retry_after if retry_after is not None else THROTTLE_COOLDOWN)
+                deployment.remaining_tokens, deployment.remaining_at = 0, now
+            elif deployment.consecutive_failures >= FAILURE_THRESHOLD:
+                deployment.cool_until = now + FAILURE_COOLDOWN
+            response = getattr(error, "response", None)
+            if response is not None and status != 429:
+                self._read_quota(deployment, response.headers)
+        llm_deployment_calls.inc(deployment=deployment.name, outcome="throttled" if status == 429 else "error")
+
+    def _read_quota(self, deployment, headers):
+        remaining = _header_int(headers, "x-ratelimit-remaining-tokens") if headers is not None else None
+        if remaining is not None:
+            deployment.remaining_tokens, deployment.remaining_at = remaining, time.monotonic()
+
+
+def load_deployments(default_endpoint, default_key, default_deployment, api_version):
+    """
+    Deployments from AZURE_OPENAI_DEPLOYMENTS (a JSON list), or the single
+    AZURE_OPENAI_ENDPOINT / AZURE_OPENAI_KEY / AZURE_OPENAI_DEPLOYMENT one.
+    Each entry: {"name", "endpoint", "deployment", "key" or "key_env", "group", "api_version"};
+    only "deployment" is required, the rest default to the single-deployment settings.
+    """
+    raw = os.getenv("AZURE_OPENAI_DEPLOYMENTS")
+    if not raw:
+        return [Deployment(default_deployment, default_endpoint, default_key, default_deployment, api_version)]
+
+    deployments = []
+    for entry in json.loads(raw):
+        key = os.getenv(entry["key_env"]) if entry.get("key_env") else entry.get("key", default_key)
+        deployments.append(Deployment(
+            entry.get("name") or f"{entry.get('endpoint', default_endpoint)}/{entry['deployment']}",
+            entry.get("endpoint", default_endpoint),
+            key,
+            entry["deployment"],
+            entry.get("api_version", api_version),
+            group=entry.get("group", "default")
+        ))
+    return deployments
+
+
+def load_routes():
+    """
+    LLM_ROUTES: JSON object mapping an endpoint (or "*") to its ordered groups,
+    e.g. {"/followup": ["fast", "large"], "*": ["large"]}. Unset: every deployment serves everything.
+    """
+    raw = os.getenv("LLM_ROUTES")
+    routes = json.loads(raw) if raw else {}
+    return {endpoint: [groups] if isinstance(groups, str) else list(groups) for endpoint, groups in routes.items()}
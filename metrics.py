@@ -0,0 +1,169 @@
+import contextlib
+import contextvars
+import threading
+import time
+from collections import defaultdict
+
+# Minimal Prometheus text-format metrics (no client library needed).
+# Values are per process: with several gunicorn workers each worker reports its own.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+REGISTRY = []
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    labels = _format_labels(self.labelnames, key, ("le", repr(float(bound))))
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(self.labelnames, key, ("le", "+Inf"))
+                lines.append(f"{self.name}_bucket{labels} {series['count']}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {series['sum']}")
+                lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = defaultdict(float)
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    Gauge whose value is read from a callback at scrape time.
+    """
+
+    def __init__(self, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        REGISTRY.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            lines.append(f"{self.name} {float(self.callback())}")
+        except Exception as e:
+            print(f"Error reading gauge {self.name}:", str(e))
+        return lines
+
+
+def render_all():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ----------------------------- REQUEST PHASES -----------------------------
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Total request latency.",
+    ("endpoint", "method", "status")
+)
+request_phase_duration = Histogram(
+    "http_request_phase_seconds",
+    "Time spent per request in each phase (db, llm, prompt, serialize, compress).",
+    ("endpoint", "phase", "status")
+)
+
+# Phase timings of the current request. A ContextVar (rather than flask.g) so that
+# ASGI routes and work offloaded with run_in_threadpool accumulate into the same dict.
+_phases = contextvars.ContextVar("request_phases", default=None)
+
+
+def start_request():
+    _phases.set(defaultdict(float))
+
+
+def add_phase(phase, seconds):
+    phases = _phases.get()
+    if phases is not None:
+        phases[phase] += seconds
+
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase(phase, time.perf_counter() - start)
+
+
+def finish_request(endpoint, method, status, seconds):
+    """
+    Records the total latency and every phase of the current request.
+    """
+    status = str(status)
+    request_duration.observe(seconds, endpoint=endpoint, method=method, status=status)
+    phases = _phases.get()
+    if phases:
+        for phase, phase_seconds in phases.items():
+            request_phase_duration.observe(phase_seconds, endpoint=endpoint, phase=phase, status=status)
+    _phases.set(None)
+
+
+def observe_phase(endpoint, phase, seconds, status="200"):
+    """
+    Records a phase that finishes after the response has started (e.g. a streamed LLM answer).
+    """
+    request_phase_duration.observe(seconds, endpoint=endpoint, phase=phase, status=str(status))
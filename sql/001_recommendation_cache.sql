@@ -0,0 +1,17 @@
+-- Cache of generated recommendations keyed by the questionnaire fingerprint
+-- (see recommendation_fingerprint() in app.py). Enabled with RECOMMENDATION_CACHE_ENABLED=true.
+IF OBJECT_ID('dbo.RecommendationCache', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.RecommendationCache (
+        fingerprint   CHAR(64)       NOT NULL PRIMARY KEY,
+        response_text NVARCHAR(MAX)  NOT NULL,
+        hit_count     INT            NOT NULL DEFAULT 0,
+        miss_count    INT            NOT NULL DEFAULT 0,
+        created_at    DATETIME2      NOT NULL DEFAULT SYSUTCDATETIME(),
+        expires_at    DATETIME2      NOT NULL,
+        last_hit_at   DATETIME2      NULL
+    );
+
+    CREATE INDEX IX_RecommendationCache_expires_at ON dbo.RecommendationCache (expires_at);
+END
+GO
@@ -0,0 +1,23 @@
+-- Per-session follow-up counter, bumped in the same transaction as each FollowUps insert
+-- so the follow-up limit is enforced without scanning FollowUps (see save_followup() in app.py).
+IF OBJECT_ID('dbo.FollowUpCounters', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.FollowUpCounters (
+        session_id     NVARCHAR(64) NOT NULL PRIMARY KEY,
+        followup_count INT          NOT NULL DEFAULT 0
+    );
+END
+GO
+
+-- Backfill counters for sessions that already have follow-ups
+INSERT INTO dbo.FollowUpCounters (session_id, followup_count)
+SELECT f.session_id, COUNT(*)
+FROM dbo.FollowUps f
+WHERE NOT EXISTS (SELECT 1 FROM dbo.FollowUpCounters c WHERE c.session_id = f.session_id)
+GROUP BY f.session_id;
+GO
+
+-- Session lookups on FollowUps no longer need a scan
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_FollowUps_session_id' AND object_id = OBJECT_ID('dbo.FollowUps'))
+    CREATE INDEX IX_FollowUps_session_id ON dbo.FollowUps (session_id, id);
+GO
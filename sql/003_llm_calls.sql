@@ -0,0 +1,42 @@
+-- One row per Azure OpenAI call made by /recommendation and /followup
+-- (see record_llm_call() in app.py), plus a per-day rollup view.
+IF OBJECT_ID('dbo.LLMCalls', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.LLMCalls (
+        id                BIGINT IDENTITY(1,1) PRIMARY KEY,
+        session_id        NVARCHAR(64)  NULL,
+        endpoint          NVARCHAR(64)  NOT NULL,
+        deployment        NVARCHAR(128) NULL,
+        streamed          BIT           NOT NULL DEFAULT 0,
+        status            NVARCHAR(16)  NOT NULL,
+        prompt_tokens     INT           NULL,
+        completion_tokens INT           NULL,
+        cached_tokens     INT           NULL,
+        latency_ms        INT           NOT NULL,
+        ttft_ms           INT           NULL,
+        retry_count       INT           NOT NULL DEFAULT 0,
+        created_at        DATETIME2     NOT NULL DEFAULT SYSUTCDATETIME()
+    );
+
+    CREATE INDEX IX_LLMCalls_created_at ON dbo.LLMCalls (created_at);
+    CREATE INDEX IX_LLMCalls_session_id ON dbo.LLMCalls (session_id);
+END
+GO
+
+CREATE OR ALTER VIEW dbo.LLMCallsDaily AS
+SELECT
+    CAST(created_at AS DATE)                 AS call_date,
+    endpoint,
+    deployment,
+    COUNT(*)                                 AS calls,
+    SUM(CASE WHEN status = 'ok' THEN 0 ELSE 1 END) AS errors,
+    SUM(CAST(prompt_tokens AS BIGINT))       AS prompt_tokens,
+    SUM(CAST(completion_tokens AS BIGINT))   AS completion_tokens,
+    SUM(CAST(cached_tokens AS BIGINT))       AS cached_tokens,
+    AVG(CAST(latency_ms AS FLOAT))           AS avg_latency_ms,
+    MAX(latency_ms)                          AS max_latency_ms,
+    AVG(CAST(ttft_ms AS FLOAT))              AS avg_ttft_ms,
+    SUM(retry_count)                         AS retries
+FROM dbo.LLMCalls
+GROUP BY CAST(created_at AS DATE), endpoint, deployment;
+GO
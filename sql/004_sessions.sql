@@ -0,0 +1,28 @@
+-- One row per session, maintained by /submit, /recordSession and /deleteSession, so
+-- /mySessions no longer groups the whole Connections event log (see my_sessions() in app.py).
+IF OBJECT_ID('dbo.Sessions', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.Sessions (
+        session_id   NVARCHAR(64)  NOT NULL PRIMARY KEY,
+        email        NVARCHAR(320) NULL,
+        session_name NVARCHAR(400) NULL,
+        created_at   DATETIME2(3)  NOT NULL DEFAULT SYSUTCDATETIME(),
+        is_deleted   BIT           NOT NULL DEFAULT 0
+    );
+END
+GO
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Sessions_email' AND object_id = OBJECT_ID('dbo.Sessions'))
+    CREATE INDEX IX_Sessions_email ON dbo.Sessions (email, is_deleted, created_at DESC, session_id DESC)
+        INCLUDE (session_name);
+GO
+
+-- Backfill from the session_created events already in Connections
+INSERT INTO dbo.Sessions (session_id, email, session_name, created_at, is_deleted)
+SELECT c.session_id, MAX(c.email), MAX(c.session_name), MIN(c.event_timestamp), MAX(CAST(c.is_deleted AS INT))
+FROM dbo.Connections c
+WHERE c.event_type = 'session_created'
+  AND c.session_id IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM dbo.Sessions s WHERE s.session_id = c.session_id)
+GROUP BY c.session_id;
+GO
@@ -0,0 +1,21 @@
+-- Compact prompt storage (see PROMPT STORAGE in app.py): the static context shared by
+-- recommendation prompts is stored once per version, and LLMResponses keeps only the
+-- per-session part (zstd-compressed) plus the context hash. Existing rows keep their
+-- full prompt and can be moved over with: flask --app app compact-prompts
+IF OBJECT_ID('dbo.PromptContexts', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.PromptContexts (
+        context_hash CHAR(64)       NOT NULL PRIMARY KEY,
+        body         VARBINARY(MAX) NOT NULL,
+        created_at   DATETIME2(3)   NOT NULL DEFAULT SYSUTCDATETIME()
+    );
+END
+GO
+
+IF COL_LENGTH('dbo.LLMResponses', 'prompt_vars') IS NULL
+    ALTER TABLE dbo.LLMResponses ADD prompt_vars VARBINARY(MAX) NULL;
+GO
+
+IF COL_LENGTH('dbo.LLMResponses', 'prompt_context_hash') IS NULL
+    ALTER TABLE dbo.LLMResponses ADD prompt_context_hash CHAR(64) NULL;
+GO
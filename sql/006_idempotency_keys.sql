@@ -0,0 +1,21 @@
+-- Results of requests sent with an Idempotency-Key header (see IDEMPOTENCY in app.py).
+-- scope is the SHA-256 of the path and the key; rows expire after IDEMPOTENCY_TTL
+-- seconds and are deleted in batches by the backend.
+IF OBJECT_ID('dbo.IdempotencyKeys', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.IdempotencyKeys (
+        scope         CHAR(64)       NOT NULL PRIMARY KEY,
+        request_hash  CHAR(64)       NOT NULL,
+        status        VARCHAR(16)    NOT NULL,
+        status_code   INT            NULL,
+        content_type  NVARCHAR(200)  NULL,
+        response_body VARBINARY(MAX) NULL,
+        created_at    DATETIME2(3)   NOT NULL DEFAULT SYSUTCDATETIME(),
+        expires_at    DATETIME2(3)   NOT NULL
+    );
+END
+GO
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_IdempotencyKeys_expires_at' AND object_id = OBJECT_ID('dbo.IdempotencyKeys'))
+    CREATE INDEX IX_IdempotencyKeys_expires_at ON dbo.IdempotencyKeys (expires_at);
+GO
@@ -0,0 +1,13 @@
+-- Rolling summary of the older follow-up turns of a session (see FOLLOW-UP SUMMARIES
+-- in app.py). The first summarized_turns follow-ups (by FollowUps.id) are covered by
+-- summary; later ones are still sent to the model verbatim.
+IF OBJECT_ID('dbo.FollowUpSummaries', 'U') IS NULL
+BEGIN
+    CREATE TABLE dbo.FollowUpSummaries (
+        session_id       NVARCHAR(64)  NOT NULL PRIMARY KEY,
+        summary          NVARCHAR(MAX) NOT NULL,
+        summarized_turns INT           NOT NULL,
+        updated_at       DATETIME2(3)  NOT NULL DEFAULT SYSUTCDATETIME()
+    );
+END
+GO
@@ -0,0 +1,9 @@
+-- Version column for the feature table cache (see get_table_version() in app.py).
+-- SQL Server bumps a ROWVERSION on every insert and update, so the probe sees every
+-- edit, including ones to NVARCHAR(MAX)/text columns that BINARY_CHECKSUM skips.
+-- Workers pick the column up at their next start.
+IF COL_LENGTH('dbo.FeatureComparison_Detailed', 'row_version') IS NULL
+BEGIN
+    ALTER TABLE dbo.FeatureComparison_Detailed ADD row_version ROWVERSION;
+END
+GO
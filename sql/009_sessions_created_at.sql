@@ -0,0 +1,6 @@
+-- Keyset pages of the session export (see SESSION EXPORT in app.py) seek on
+-- (created_at, session_id) instead of scanning and sorting Sessions.
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_Sessions_created_at' AND object_id = OBJECT_ID('dbo.Sessions'))
+    CREATE INDEX IX_Sessions_created_at ON dbo.Sessions (created_at, session_id)
+        INCLUDE (email, session_name, is_deleted);
+GO
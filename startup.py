@@ -0,0 +1,213 @@
+import builtins
+import importlib
+import os
+import sys
+import threading
+import time
+
+import metrics
+
+# Cold start: what a worker spends before it can serve, and when it is ready to.
+#
+# Import this module before anything else: it starts the clock and, with
+# STARTUP_PROFILE_IMPORTS, times each top-level package imported until imported()
+# is called (cumulative, like python -X importtime). The timer is removed again
+# afterwards, so requests do not pay for it.
+#
+# STARTUP_MODE=lazy (the default) defers heavy packages (openai) until first use:
+#
+#   openai = startup.lazy_import("openai")
+#
+# and app.py warms them up in the background. STARTUP_MODE=eager imports them right away.
+#
+# Readiness is a set of named checks ('import', 'db_pool', 'llm_clients', ...); the
+# process is ready once every expected check has passed. The first time it is, a
+# one-line startup report is printed; report() has the details (GET /ready).
+
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy").lower()
+STARTUP_PROFILE_IMPORTS = os.getenv("STARTUP_PROFILE_IMPORTS", "true").lower() == "true"
+# Imports faster than this are left out of the report
+STARTUP_REPORT_MIN_IMPORT = float(os.getenv("STARTUP_REPORT_MIN_IMPORT", 0.005))
+
+_started = time.perf_counter()
+_lock = threading.Lock()
+_phases = {}
+_imports = {}
+_checks = {"import": "pending"}
+_ready_after = None
+
+
+def since_start():
+    return time.perf_counter() - _started
+
+
+# ----------------------------- IMPORT TIMES -----------------------------
+_original_import = builtins.__import__
+_importing = threading.local()
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    top = name.partition(".")[0]
+    if level or top in sys.modules or getattr(_importing, "active", False):
+        return _original_import(name, globals, locals, fromlist, level)
+    # Only the outermost import is timed; nested ones are part of its cumulative time
+    _importing.active = True
+    start = time.perf_counter()
+    try:
+        return _original_import(name, globals, locals, fromlist, level)
+    finally:
+        _importing.active = False
+        _record_import(top, time.perf_counter() - start, deferred=False)
+
+
+def _record_import(name, seconds, deferred):
+    with _lock:
+        if name not in _imports:
+            _imports[name] = {"seconds": round(seconds, 4), "at": round(since_start(), 4), "deferred": deferred}
+
+
+if STARTUP_PROFILE_IMPORTS:
+    builtins.__import__ = _timed_import
+
+
+class LazyModule:
+    """
+    Stands in for a module that is imported on first attribute access.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            # Whatever it imports in turn is part of its time, as in _timed_import
+            active, _importing.active = getattr(_importing, "active", False), True
+            start = time.perf_counter()
+            try:
+                module = importlib.import_module(self._name)
+            finally:
+                _importing.active = active
+            _record_import(self._name, time.perf_counter() - start, deferred=True)
+            self._module = module
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+        return f"<lazy module '{self._name}'{' (loaded)' if self._module is not None else ''}>"
+
+
+def lazy_import(name):
+    """
+    The module, or with STARTUP_MODE=lazy a LazyModule that imports it on first use.
+    """
+    if STARTUP_MODE == "lazy":
+        return LazyModule(name)
+    return importlib.import_module(name)
+
+
+def load(module):
+    """
+    Imports a lazy module now (e.g. from a warm-up thread); returns the real module.
+    """
+    return module._load() if isinstance(module, LazyModule) else module
+
+
+# ----------------------------- PHASES -----------------------------
+class phase:
+    """
+    Context manager recording how long a startup phase took.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        with _lock:
+            _phases[self.name] = round(time.perf_counter() - self.start, 4)
+        return False
+
+
+def imported():
+    """
+    Called at the end of app.py: records the import phase, removes the import timer
+    and passes the 'import' check.
+    """
+    if builtins.__import__ is _timed_import:
+        builtins.__import__ = _original_import
+    with _lock:
+        _phases["import"] = round(since_start(), 4)
+    passed("import")
+
+
+# ----------------------------- READINESS -----------------------------
+def expect(name):
+    """
+    Registers a check that has to pass before the process reports ready.
+    """
+    with _lock:
+        _checks.setdefault(name, "pending")
+
+
+def passed(name):
+    global _ready_after
+    with _lock:
+        _checks[name] = "ready"
+        if _ready_after is not None or any(state != "ready" for state in _checks.values()):
+            return
+        _ready_after = round(since_start(), 4)
+    print(summary())
+
+
+def failed(name, error):
+    with _lock:
+        if _checks.get(name) != "ready":
+            _checks[name] = f"error: {error}"
+
+
+def is_ready():
+    with _lock:
+        return bool(_checks) and all(state == "ready" for state in _checks.values())
+
+
+# ----------------------------- REPORT -----------------------------
+def report():
+    with _lock:
+        imports = {
+            name: dict(entry) for name, entry in sorted(_imports.items(), key=lambda item: -item[1]["seconds"])
+            if entry["seconds"] >= STARTUP_REPORT_MIN_IMPORT
+        }
+        return {
+            "mode": STARTUP_MODE,
+            "pid": os.getpid(),
+            "uptime_seconds": round(since_start(), 4),
+            "ready_after_seconds": _ready_after,
+            "checks": dict(_checks),
+            "phases": dict(_phases),
+            "imports": imports
+        }
+
+
+def summary():
+    """
+    One line: when the process became ready, its phases and its slowest imports.
+    """
+    data = report()
+    phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in data["phases"].items())
+    imports = ", ".join(
+        f"{name} {entry['seconds']:.2f}s{' (deferred)' if entry['deferred'] else ''}"
+        for name, entry in list(data["imports"].items())[:5]
+    )
+    return f"Worker {data['pid']} ready after {data['ready_after_seconds']:.2f}s [{data['mode']}]: " \
+           f"{phases}; slowest imports: {imports or 'none'}"
+
+
+metrics.Gauge("startup_ready_seconds", "Seconds from worker start until it was ready (0 until then).",
+              lambda: _ready_after or 0)
+metrics.Gauge("startup_ready", "1 once every readiness check has passed.", lambda: 1 if is_ready() else 0)
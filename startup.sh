@@ -1,2 +1,7 @@
 #!/bin/bash
-gunicorn --bind 0.0.0.0:8000 app:app
\ No newline at end of file
+# SERVER_MODE=asgi serves the LLM routes from async workers (see asgi.py)
+if [ "$SERVER_MODE" = "asgi" ]; then
+    gunicorn --bind 0.0.0.0:8000 -k uvicorn.workers.UvicornWorker asgi:app
+else
+    gunicorn --bind 0.0.0.0:8000 app:app
+fi
@@ -0,0 +1,228 @@
+import atexit
+import collections
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import exc, text
+
+
+class WriteBehindQueue:
+    """
+    Bounded in-process queue of fire-and-forget INSERTs, flushed in bulk by a
+    background thread when batch_size events are pending or every flush_interval seconds.
+
+    statements maps an event kind to its INSERT statement; events of the same kind
+    are written with one executemany call, each kind in its own transaction. When
+    that fails, its events are retried one at a time; an event that still fails
+    after max_attempts flushes goes to the dead_letter_path file (one JSON line per
+    event) instead of holding up the queue. When the database cannot be reached at
+    all, events go back to the queue without using up their attempts.
+
+    With spill_dir set, every queued event is also appended to a per-process
+    journal (events-<pid>-<random>.jsonl) that is truncated once the queue has been
+    written. Journals left behind by a crashed process are replayed at start, also when
+    the restarted process got the same pid (as PID 1 in a container usually does).
+    """
+
+    def __init__(self, engine, statements, max_size=10000, batch_size=200, flush_interval=1.0, spill_dir=None,
+                 max_attempts=3, dead_letter_path="telemetry-dead-letter.jsonl"):
+        self.engine = engine
+        self.statements = statements
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_dir = spill_dir
+        self.max_attempts = max_attempts
+        self.dead_letter_path = dead_letter_path
+
+        self._queue = collections.deque()
+        self._cond = threading.Condition()
+        self._inflight = 0
+        self._stopping = False
+        self._thread = None
+        self._spill_file = None
+        self._stats = {"queued": 0, "written": 0, "overflowed": 0, "failed_flushes": 0, "replayed": 0,
+                       "dead_lettered": 0}
+
+    # ----------------------------- LIFECYCLE -----------------------------
+    def start(self):
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self._spill_path = os.path.join(self.spill_dir, f"events-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl")
+            self._spill_file = open(self._spill_path, "a+", encoding="utf-8")
+            # Held for the life of the process so no other worker replays a live journal
+            fcntl.flock(self._spill_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._replay_orphaned_journals()
+
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        return self
+
+    def stop(self, timeout=10):
+        """
+        Stops the background thread and writes whatever is still queued.
+        """
+        with self._cond:
+            if self._stopping:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+        if self._write_pending() and self._spill_file is not None:
+            self._spill_file.close()
+            os.remove(self._spill_path)
+            self._spill_file = None
+
+    # ----------------------------- PRODUCERS -----------------------------
+    def submit(self, kind, params):
+        """
+        Queues one event. Returns False when the queue is full (or stopped),
+        in which case the caller should write synchronously.
+        """
+        with self._cond:
+            if self._stopping or len(self._queue) >= self.max_size:
+                self._stats["overflowed"] += 1
+                return False
+            if self._spill_file is not None:
+                self._spill_file.write(json.dumps({"kind": kind, "params": params}) + "\n")
+                self._spill_file.flush()
+            self._queue.append((kind, params, 0))
+            self._stats["queued"] += 1
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, depth=len(self._queue) + self._inflight)
+
+    # ----------------------------- WRITER -----------------------------
+    def _run(self):
+        backoff = self.flush_interval
+        while True:
+            with self._cond:
+                if not self._stopping and len(self._queue) < self.batch_size:
+                    self._cond.wait(backoff)
+                if self._stopping:
+                    return
+
+            if self._write_pending():
+                backoff = self.flush_interval
+            else:
+                backoff = min(backoff * 2, 30)
+
+    def _write_pending(self):
+        """
+        Writes everything queued so far in batches. Returns False if a batch could not
+        be written completely; its remaining events go back to the front of the queue
+        for the next attempt.
+        """
+        while True:
+            with self._cond:
+                if not self._queue:
+                    return True
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                self._inflight = len(batch)
+
+            written, retry = self._write_batch(batch)
+
+            with self._cond:
+                self._inflight = 0
+                self._stats["written"] += written
+                if retry:
+                    self._queue.extendleft(reversed(retry))
+                    self._stats["failed_flushes"] += 1
+                    return False
+                if not self._queue and self._spill_file is not None:
+                    self._spill_file.seek(0)
+                    self._spill_file.truncate()
+
+    def _write_batch(self, batch):
+        """
+        Writes a batch, one transaction per kind. Returns the number of events written
+        and the events to retry later.
+        """
+        events_by_kind = collections.OrderedDict()
+        for event in batch:
+            events_by_kind.setdefault(event[0], []).append(event)
+
+        written, retry = 0, []
+        pending = list(events_by_kind.items())
+        while pending:
+            kind, events = pending.pop(0)
+            try:
+                self._execute(kind, [params for _, params, _ in events])
+                written += len(events)
+                continue
+            except Exception as e:
+                print(f"Error flushing write-behind queue ({kind}):", str(e))
+                if _is_outage(e):
+                    return written, retry + events + [event for _, rest in pending for event in rest]
+
+            # Find the event(s) that fail the batch
+            for i, (_, params, attempts) in enumerate(events):
+                try:
+                    self._execute(kind, [params])
+                    written += 1
+                except Exception as e:
+                    if _is_outage(e):
+                        return written, retry + events[i:] + [event for _, rest in pending for event in rest]
+                    if attempts + 1 >= self.max_attempts:
+                        self._dead_letter(kind, params, e)
+                    else:
+                        retry.append((kind, params, attempts + 1))
+        return written, retry
+
+    def _execute(self, kind, rows):
+        with self.engine.begin() as connection:
+            connection.execute(text(self.statements[kind]), rows)
+
+    def _dead_letter(self, kind, params, error):
+        print(f"Giving up on a {kind} event after {self.max_attempts} attempts:", str(error))
+        line = json.dumps({"kind": kind, "params": params, "error": str(error), "failed_at": time.time()}, default=str)
+        try:
+            with open(self.dead_letter_path, "a", encoding="utf-8") as dead_letters:
+                # Workers share the file
+                fcntl.flock(dead_letters, fcntl.LOCK_EX)
+                dead_letters.write(line + "\n")
+        except OSError as e:
+            print("Error writing the dead-letter file:", str(e), line)
+        with self._cond:
+            self._stats["dead_lettered"] += 1
+
+    def _replay_orphaned_journals(self):
+        for path in glob.glob(os.path.join(self.spill_dir, "events-*.jsonl")):
+            if path == self._spill_path:
+                continue
+            with open(path, "r+", encoding="utf-8") as journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # Another live process owns it
+                    continue
+                events = [json.loads(line) for line in journal if line.strip()]
+                for event in events:
+                    # Re-journal under this process before the orphan is removed
+                    self._spill_file.write(json.dumps(event) + "\n")
+                    self._queue.append((event["kind"], event["params"], 0))
+                self._spill_file.flush()
+                self._stats["replayed"] += len(events)
+            os.remove(path)
+            print(f"Replayed {len(events)} queued events from {path}")
+
+
+def _is_outage(error):
+    """
+    True when the database could not be reached (as opposed to one bad row).
+    """
+    if isinstance(error, (exc.OperationalError, exc.InterfaceError, exc.TimeoutError)):
+        return True
+    return bool(getattr(error, "connection_invalidated", False))